@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Benchmark how long the CLI takes to start
+
+Runs ``datacube-alchemist --version`` in fresh interpreters, and lists the slowest
+imports, so that heavy dependencies creeping back into the CLI's import path
+are easy to spot.
+
+    python -m benchmarks.bench_cli_startup --runs 10
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+COMMAND = [sys.executable, "-m", "datacube_alchemist.cli", "--version"]
+
+
+def _slowest_imports(count: int) -> list[tuple[int, str]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import datacube_alchemist.cli"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only modules imported directly by the CLI, nested imports are indented further
+        if len(name) - len(name.lstrip()) == 3:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+@click.command()
+@click.option("--runs", type=int, default=5, help="Number of interpreter starts")
+@click.option("--top", type=int, default=10, help="Number of slow imports to list")
+def main(runs, top):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(COMMAND, capture_output=True, check=True)
+        timings.append(time.perf_counter() - start)
+
+    click.echo(
+        f"datacube-alchemist --version: median {statistics.median(timings):.3f}s, "
+        f"min {min(timings):.3f}s over {runs} runs"
+    )
+    click.echo("Slowest imports made by datacube_alchemist.cli:")
+    for microseconds, name in _slowest_imports(top):
+        click.echo(f"{microseconds / 1000:>10.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
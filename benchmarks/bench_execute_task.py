@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Benchmark ``Alchemist.execute_task`` end to end
+
+Synthetic COG-backed datasets are written to local disk and indexed into an
+in-memory ODC index, then processed with ``FakeTransformation`` to a local output
+location. No database or network access is required.
+
+    python -m benchmarks.bench_execute_task --size 4096 --bands 6 --dtype int16
+"""
+
+import json
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+import click
+import datacube
+import structlog
+
+from benchmarks.synthetic import (
+    alchemist_settings,
+    index_synthetic_datasets,
+    memory_index_config,
+    write_synthetic_datasets,
+)
+from datacube_alchemist._metrics import STAGES, directory_size
+from datacube_alchemist.worker import Alchemist
+
+
+def _drop_events(logger, method_name, event_dict):
+    raise structlog.DropEvent
+
+
+@click.command()
+@click.option("--size", type=int, default=2048, help="Width and height in pixels")
+@click.option("--bands", type=int, default=3, help="Number of bands per dataset")
+@click.option("--dtype", default="uint16", help="Numpy dtype of the source bands")
+@click.option("--count", type=int, default=3, help="Number of datasets to process")
+@click.option("--chunk", type=int, default=1024, help="Dask chunk size in y")
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Where to write inputs and outputs, defaults to a temporary directory",
+)
+@click.option(
+    "--json-output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Also write the results as JSON, for comparing between runs",
+)
+def main(size, bands, dtype, count, chunk, workdir, json_output):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = workdir or Path(temp_dir)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        click.echo(
+            f"Writing {count} synthetic datasets of {bands}x{size}x{size} {dtype}"
+        )
+        docs = write_synthetic_datasets(
+            workdir / "inputs", count=count, size=size, bands=bands, dtype=dtype
+        )
+        # An in-memory index, so no database is needed
+        dc = datacube.Datacube(
+            config=str(memory_index_config(workdir)), env="benchmark"
+        )
+        datasets = index_synthetic_datasets(dc, docs, bands, dtype)
+        input_bytes = directory_size(workdir / "inputs") / count
+
+        names = list(datasets[0].measurements)
+        alchemist = Alchemist(
+            config=alchemist_settings(workdir / "outputs", names, chunk), dc=dc
+        )
+
+        # Keep the per-stage logging out of the results, and put it back after, as
+        # this also runs inside other processes such as the test suite
+        logging_config = structlog.get_config()
+        structlog.configure(processors=[_drop_events])
+        summaries = []
+        try:
+            for dataset in datasets:
+                task = alchemist.generate_task(dataset)
+                alchemist.execute_task(task)
+                summaries.append(task.metrics.summary())
+        finally:
+            structlog.configure(**logging_config)
+
+        output_bytes = directory_size(workdir / "outputs") / count
+
+    stages = defaultdict(list)
+    for summary in summaries:
+        for stage in STAGES:
+            if f"{stage}_seconds" in summary:
+                stages[stage].append(summary[f"{stage}_seconds"])
+
+    mean_total = sum(s["total_seconds"] for s in summaries) / count
+    results = {
+        "size": size,
+        "bands": bands,
+        "dtype": dtype,
+        "count": count,
+        "stages": {k: sum(v) / len(v) for k, v in stages.items()},
+        "total_seconds": mean_total,
+        "peak_rss_mb": max(s["peak_rss_bytes"] for s in summaries) / 2**20,
+        "input_mb_per_s": input_bytes / 2**20 / mean_total,
+        "output_mb_per_s": output_bytes / 2**20 / mean_total,
+    }
+
+    click.echo(f"{'stage':<12}{'mean seconds':>14}")
+    for stage, seconds in results["stages"].items():
+        click.echo(f"{stage:<12}{seconds:>14.3f}")
+    click.echo(f"{'total':<12}{mean_total:>14.3f}")
+    click.echo(f"Peak RSS: {results['peak_rss_mb']:.0f} MB")
+    click.echo(
+        f"Throughput: {results['input_mb_per_s']:.1f} MB/s read, "
+        f"{results['output_mb_per_s']:.1f} MB/s written"
+    )
+
+    if json_output:
+        json_output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
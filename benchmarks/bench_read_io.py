@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Benchmark reading source data under different ``processing.read`` settings
+
+Synthetic COG-backed datasets are served from local disk, both directly and over
+a local HTTP server that supports range requests and can add latency to each
+request, to stand in for S3. Each read profile runs in a fresh process so that
+GDAL's caches start cold, and each reads every dataset ``--repeats`` times, as a
+worker would when several tasks or transforms share inputs.
+
+    python -m benchmarks.bench_read_io --size 4096 --bands 6 --latency 20
+"""
+
+import json
+import multiprocessing
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import cattr
+import click
+
+from benchmarks.synthetic import write_synthetic_datasets
+
+PROFILES = {
+    "default": {},
+    "tuned": {
+        "block_cache_mb": 512,
+        "vsi_cache_mb": 64,
+        "curl_cache_mb": 256,
+        "merge_consecutive_ranges": True,
+        "keep_alive": True,
+        "dataset_pool_size": 450,
+    },
+}
+
+_RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves single byte ranges like S3 does, counting requests and bytes"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def _send(self, body: bool) -> None:
+        server = self.server
+        time.sleep(server.latency)
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = _RANGE.fullmatch(self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]) if match[2] else end, end)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        sent = 0
+        if body:
+            with open(path, "rb") as f:
+                f.seek(start)
+                sent = self.wfile.write(f.read(end - start + 1))
+        with server.lock:
+            server.requests += 1
+            server.bytes_sent += sent
+
+    def do_GET(self):
+        self._send(body=True)
+
+    def do_HEAD(self):
+        self._send(body=False)
+
+
+def serve(directory: Path, latency: float) -> ThreadingHTTPServer:
+    """Serve ``directory`` over HTTP on a free local port, from a daemon thread."""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(RangeRequestHandler, directory=str(directory))
+    )
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.bytes_sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _time_reads(workdir, docs, bands, dtype, read_settings, repeats) -> list[float]:
+    """Index and read every dataset, in what must be a fresh process"""
+    import datacube
+    from datacube.testutils.io import native_load
+    from datacube.utils.aws import configure_s3_access
+
+    from benchmarks.synthetic import index_synthetic_datasets, memory_index_config
+    from datacube_alchemist.settings import ReadSettings
+
+    dc = datacube.Datacube(
+        config=str(memory_index_config(Path(workdir))), env="benchmark"
+    )
+    datasets = index_synthetic_datasets(dc, docs, bands, dtype)
+    options = cattr.structure(read_settings, ReadSettings).to_gdal_options()
+    configure_s3_access(aws_unsigned=True, cloud_defaults=True, **options)
+
+    passes = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for dataset in datasets:
+            native_load(dataset, dask_chunks={"x": -1, "y": 1024}).compute()
+        passes.append(time.perf_counter() - start)
+    return passes
+
+
+@click.command()
+@click.option("--size", type=int, default=2048, help="Width and height in pixels")
+@click.option("--bands", type=int, default=3, help="Number of bands per dataset")
+@click.option("--dtype", default="uint16", help="Numpy dtype of the source bands")
+@click.option("--count", type=int, default=3, help="Number of datasets to read")
+@click.option("--repeats", type=int, default=2, help="Times to read each dataset")
+@click.option(
+    "--latency", type=float, default=10, help="Milliseconds added to each HTTP request"
+)
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Where to write inputs, defaults to a temporary directory",
+)
+@click.option(
+    "--json-output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Also write the results as JSON, for comparing between runs",
+)
+def main(size, bands, dtype, count, repeats, latency, workdir, json_output):
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = workdir or Path(temp_dir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        inputs = workdir / "inputs"
+
+        click.echo(
+            f"Writing {count} synthetic datasets of {bands}x{size}x{size} {dtype}"
+        )
+        docs = write_synthetic_datasets(
+            inputs, count=count, size=size, bands=bands, dtype=dtype
+        )
+        server = serve(inputs, latency / 1000)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        sources = {
+            "file": docs,
+            "http": [
+                {
+                    **doc,
+                    "location": doc["location"].replace(inputs.as_uri(), base_url),
+                }
+                for doc in docs
+            ],
+        }
+
+        spawn = multiprocessing.get_context("spawn")
+        for source, source_docs in sources.items():
+            for profile, read_settings in PROFILES.items():
+                server.requests = server.bytes_sent = 0
+                with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                    passes = pool.submit(
+                        _time_reads,
+                        str(workdir),
+                        source_docs,
+                        bands,
+                        dtype,
+                        read_settings,
+                        repeats,
+                    ).result()
+                results.append(
+                    {
+                        "source": source,
+                        "profile": profile,
+                        "first_seconds": passes[0],
+                        "repeat_seconds": sum(passes[1:]) / max(len(passes) - 1, 1),
+                        "requests": server.requests,
+                        "mb_transferred": server.bytes_sent / 2**20,
+                    }
+                )
+        server.shutdown()
+
+    click.echo(
+        f"{'source':<8}{'profile':<10}{'first s':>10}{'repeat s':>10}"
+        f"{'requests':>10}{'MB over HTTP':>14}"
+    )
+    for r in results:
+        click.echo(
+            f"{r['source']:<8}{r['profile']:<10}{r['first_seconds']:>10.3f}"
+            f"{r['repeat_seconds']:>10.3f}{r['requests']:>10}{r['mb_transferred']:>14.1f}"
+        )
+
+    if json_output:
+        json_output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Synthetic ODC datasets for benchmarking and tests
+- write_synthetic_datasets
+- index_synthetic_datasets
+- memory_index_config
+- alchemist_settings
+"""
+
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import cattr
+import numpy as np
+import rasterio
+from affine import Affine
+from datacube import Datacube
+from datacube.index.hl import prep_eo3
+from datacube.model import Dataset
+
+from datacube_alchemist.settings import AlchemistSettings
+
+PRODUCT_NAME = "alchemist_synthetic"
+CRS = "EPSG:32755"
+RESOLUTION = 30
+ORIGIN = (500_000, 7_000_000)
+
+
+def band_names(bands: int) -> list[str]:
+    return [f"band_{i + 1:02d}" for i in range(bands)]
+
+
+def product_definition(bands: int, dtype: str, nodata: int = 0) -> dict:
+    return {
+        "name": PRODUCT_NAME,
+        "description": "Synthetic COG-backed product for benchmarking",
+        "metadata_type": "eo3",
+        "license": "CC-BY-4.0",
+        "metadata": {"product": {"name": PRODUCT_NAME}},
+        "measurements": [
+            {"name": name, "dtype": dtype, "nodata": nodata, "units": "1"}
+            for name in band_names(bands)
+        ],
+    }
+
+
+def _write_cog(path: Path, data: np.ndarray, transform: Affine, nodata) -> None:
+    with rasterio.open(
+        path,
+        "w",
+        driver="COG",
+        width=data.shape[1],
+        height=data.shape[0],
+        count=1,
+        dtype=data.dtype,
+        crs=CRS,
+        transform=transform,
+        nodata=nodata,
+        compress="deflate",
+        blocksize=512,
+    ) as dst:
+        dst.write(data, 1)
+
+
+def write_synthetic_datasets(
+    directory: Path,
+    count: int = 1,
+    size: int = 2048,
+    bands: int = 3,
+    dtype: str = "uint16",
+    nodata: int = 0,
+    seed: int = 42,
+) -> list[dict]:
+    """Write ``count`` datasets of ``bands`` COGs each, returning their eo3 documents.
+
+    Pixels are random so that compression ratios resemble real imagery rather than
+    the degenerate case of constant arrays.
+    """
+    rng = np.random.default_rng(seed)
+    info = np.iinfo(dtype) if np.issubdtype(dtype, np.integer) else None
+    transform = Affine(RESOLUTION, 0, ORIGIN[0], 0, -RESOLUTION, ORIGIN[1])
+    x0, y0 = ORIGIN
+    x1, y1 = x0 + size * RESOLUTION, y0 - size * RESOLUTION
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    docs = []
+    for i in range(count):
+        dataset_dir = directory / f"synthetic_{i:04d}"
+        dataset_dir.mkdir(parents=True, exist_ok=True)
+        measurements = {}
+        for name in band_names(bands):
+            if info is not None:
+                data = rng.integers(
+                    max(info.min, nodata + 1), min(info.max, 10_000), (size, size)
+                ).astype(dtype)
+            else:
+                data = rng.random((size, size), dtype="float32").astype(dtype)
+            _write_cog(dataset_dir / f"{name}.tif", data, transform, nodata)
+            measurements[name] = {"path": f"{name}.tif"}
+
+        docs.append(
+            {
+                "$schema": "https://schemas.opendatacube.org/dataset",
+                "id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{PRODUCT_NAME}/{i}")),
+                "product": {"name": PRODUCT_NAME},
+                "crs": CRS,
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]],
+                },
+                "grids": {
+                    "default": {"shape": [size, size], "transform": list(transform)}
+                },
+                "properties": {
+                    "datetime": (start + timedelta(days=16 * i)).isoformat(),
+                    "eo:platform": "landsat-8",
+                    "eo:instrument": "OLI_TIRS",
+                    # Needed by eodatasets3 to abbreviate the instrument in names
+                    "landsat:landsat_scene_id": "LC80900842020001LGN00",
+                    "odc:processing_datetime": start.isoformat(),
+                    "odc:product_family": "synthetic",
+                    "odc:region_code": f"{i % 10:03d}{i // 10:03d}",
+                    "odc:file_format": "GeoTIFF",
+                },
+                "measurements": measurements,
+                "lineage": {},
+                "location": (dataset_dir / "metadata.odc-metadata.yaml").as_uri(),
+            }
+        )
+    return docs
+
+
+def index_synthetic_datasets(
+    dc: Datacube, docs: list[dict], bands: int, dtype: str, nodata: int = 0
+) -> list[Dataset]:
+    """Add the synthetic product and datasets to an (ideally in-memory) index."""
+    product = dc.index.products.add_document(
+        product_definition(bands, dtype, nodata=nodata)
+    )
+    datasets = []
+    for doc in docs:
+        doc = dict(doc)
+        location = doc.pop("location")
+        dataset = Dataset(product, prep_eo3(doc), uris=[location])
+        datasets.append(dc.index.datasets.add(dataset, with_lineage=False))
+    return datasets
+
+
+def memory_index_config(directory: Path) -> Path:
+    """Write a datacube config for an in-memory index, as the ``benchmark`` env."""
+    config_path = directory / "datacube.conf"
+    config_path.write_text("[benchmark]\nindex_driver: memory\n")
+    return config_path
+
+
+def alchemist_settings(output: Path, bands: list[str], chunk: int) -> AlchemistSettings:
+    """Settings to copy ``bands`` of the synthetic product to ``output`` unchanged."""
+    output_settings = {
+        "location": str(output),
+        "nodata": 0,
+        "write_data_settings": {"overview_resampling": "average"},
+        "write_stac": True,
+        "explorer_url": "https://explorer.example.com",
+        "metadata": {
+            "product_family": "benchmark",
+            "producer": "ga.gov.au",
+            "dataset_version": "1.0.0",
+        },
+    }
+    if len(bands) >= 3:
+        output_settings["preview_image"] = {
+            "red": bands[0],
+            "green": bands[1],
+            "blue": bands[2],
+        }
+    return cattr.structure(
+        {
+            "specification": {
+                "product": PRODUCT_NAME,
+                "measurements": bands,
+                "transform": "datacube_alchemist._utils.FakeTransformation",
+            },
+            "output": output_settings,
+            "processing": {"dask_chunks": {"x": -1, "y": chunk}},
+        },
+        AlchemistSettings,
+    )
@@ -0,0 +1,132 @@
+"""Assembling datasets without reading back the files that make them up
+- write_hashed
+- Assembler
+"""
+
+import hashlib
+import io
+import json
+from pathlib import Path
+from typing import Optional
+
+import attr
+from eodatasets3 import DatasetAssembler, documents, serialise
+from eodatasets3.model import DatasetDoc
+from eodatasets3.scripts.tostac import dc_to_stac, json_fallback
+from shapely.geometry import shape
+
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+RASTER_EXTENSION = "https://stac-extensions.github.io/raster/v1.1.0/schema.json"
+
+
+def write_hashed(path: Path, data) -> str:
+    """Write a buffer to a file, returning the SHA1 of what was written"""
+    sha1 = hashlib.sha1()
+    view = memoryview(data).cast("B")
+    with path.open("wb") as f:
+        for start in range(0, len(view), _CHUNK_SIZE):
+            chunk = view[start : start + _CHUNK_SIZE]
+            sha1.update(chunk)
+            f.write(chunk)
+    return sha1.hexdigest()
+
+
+class Assembler(DatasetAssembler):
+    """
+    A DatasetAssembler that's told the checksums of the files written into it, so
+    that it doesn't read each of them again to checksum them, and that makes the
+    STAC item from the metadata it has in memory rather than from the YAML on disk.
+
+    It hooks into private parts of eodatasets3 0.30, which is why that's the only
+    series it's installed with. ``test_assembler_internals`` checks them.
+    """
+
+    # Declared here, as the assembler refuses fields it doesn't already have
+    _hashes: Optional[dict[Path, str]] = None
+    _dataset_doc: Optional[DatasetDoc] = None
+    _stac_settings: Optional[tuple[str, Optional[str]]] = None
+    _raster_bands: Optional[dict[str, dict]] = None
+    stac: Optional[dict] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hashes = {}
+        self._raster_bands = {}
+
+    def note_hash(self, path: Path, sha1: str) -> None:
+        """Record the checksum of a file, for when it's noted as part of the dataset"""
+        self._hashes[Path(path).absolute()] = sha1
+
+    def note_stac(self, destination_path: str, explorer_url: Optional[str]) -> None:
+        """
+        Write a STAC item for the dataset when it's done, which is then available
+        as ``stac``.
+
+        :param destination_path: where the dataset's folder is going to be
+        """
+        self._stac_settings = (destination_path, explorer_url)
+
+    def note_raster_band(self, name: str, raster_band: dict) -> None:
+        """Describe a measurement's asset in the STAC item with ``raster:bands``"""
+        self._raster_bands[name] = raster_band
+
+    def note_accessory_file(self, name: str, path) -> None:
+        sha1 = self._hashes.pop(Path(path).absolute(), None)
+        if sha1 is None:
+            super().note_accessory_file(name, path)
+            return
+        # Skip our parent, which would read the file again to checksum it
+        super(DatasetAssembler, self).note_accessory_file(name, path)
+        self._checksum._append_hash(path, sha1)  # noqa: SLF001
+
+    def to_dataset_doc(self, *args, **kwargs) -> DatasetDoc:
+        # done() sets the locations on this before it writes it
+        self._dataset_doc = super().to_dataset_doc(*args, **kwargs)
+        return self._dataset_doc
+
+    def _write_yaml(self, doc: dict, path: Path, allow_external_paths=False):
+        documents.make_paths_relative(
+            doc, path.parent, allow_paths_outside_base=allow_external_paths
+        )
+        stream = io.StringIO()
+        serialise._init_yaml().dump_all([doc], stream)  # noqa: SLF001
+        sha1 = write_hashed(path, stream.getvalue().encode())
+        # Like our parent, checksum it now, and again if it's noted as an accessory
+        self._checksum._append_hash(path, sha1)  # noqa: SLF001
+        self.note_hash(path, sha1)
+
+        # The metadata document is the last thing written before the checksums
+        if self._stac_settings and path == self._work_path / self.names.metadata_file:
+            self._write_stac(path)
+
+    def _write_stac(self, metadata_path: Path) -> None:
+        destination_path, explorer_url = self._stac_settings
+        stac_path = metadata_path.with_name(
+            metadata_path.name.replace("odc-metadata.yaml", "stac-item.json")
+        )
+        # It's as it would be read from the YAML, apart from the geometry perhaps
+        # being a datacube one rather than a shapely one
+        dataset = self._dataset_doc
+        if dataset.geometry is not None:
+            dataset = attr.evolve(dataset, geometry=shape(dataset.geometry))
+        # Make sure destination path has a / at the end. Clumsy, but necessary.
+        self.stac = dc_to_stac(
+            dataset,
+            metadata_path,
+            stac_path,
+            destination_path.rstrip("/") + "/",
+            explorer_url,
+            False,
+        )
+        if self._raster_bands:
+            for name, raster_band in self._raster_bands.items():
+                self.stac["assets"][name]["raster:bands"] = [raster_band]
+            self.stac["stac_extensions"].append(RASTER_EXTENSION)
+        self.note_hash(
+            stac_path,
+            write_hashed(
+                stac_path, json.dumps(self.stac, default=json_fallback).encode()
+            ),
+        )
+        self.note_accessory_file("metadata:stac", stac_path)
@@ -0,0 +1,346 @@
+"""Writing measurements as COGs with overviews built in memory
+- overview_levels
+- write_cog
+- write_measurements
+"""
+
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import rasterio
+import xarray as xr
+from eodatasets3 import DatasetAssembler, images
+from eodatasets3.properties import FileFormat
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+
+from datacube_alchemist._assemble import write_hashed
+
+# Resampling methods that can be done here, rather than by GDAL re-reading the file
+IN_MEMORY_RESAMPLING = (Resampling.nearest, Resampling.average, Resampling.mode)
+
+_GDAL_TYPES = {
+    "uint8": "Byte",
+    "int16": "Int16",
+    "uint16": "UInt16",
+    "int32": "Int32",
+    "uint32": "UInt32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+# Overview pixels reduced at a time, to bound the memory used for gathered blocks
+_STRIP_PIXELS = 2**14
+
+
+def _block_indices(src: int, dst: int) -> tuple[np.ndarray, np.ndarray]:
+    # The source pixels behind each overview pixel, spread like GDAL's, which
+    # scales by src/dst rather than the nominal factor so the extent is unchanged
+    ratio = src / dst
+    starts = (np.arange(dst) * ratio + 0.5).astype(int)
+    ends = np.minimum((np.arange(1, dst + 1) * ratio + 0.5).astype(int), src)
+    ends = np.maximum(ends, starts + 1)
+    index = starts[:, None] + np.arange((ends - starts).max())
+    return np.minimum(index, src - 1), index < ends[:, None]
+
+
+def _is_valid(blocks: np.ndarray, nodata) -> np.ndarray:
+    # As in GDAL, NaN is only skipped when it's the nodata value
+    if nodata is None:
+        return np.ones(blocks.shape, dtype=bool)
+    if np.isnan(nodata):
+        return ~np.isnan(blocks)
+    return blocks != nodata
+
+
+def _fill_value(dtype: np.dtype, nodata):
+    if nodata is not None:
+        return nodata
+    return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+
+def _next_to(dtype: np.dtype, nodata):
+    if np.issubdtype(dtype, np.floating):
+        return np.nextafter(dtype.type(nodata), dtype.type(np.inf))
+    return nodata + 1 if nodata < np.iinfo(dtype).max else nodata - 1
+
+
+def _average(blocks: np.ndarray, valid: np.ndarray, nodata) -> np.ndarray:
+    count = valid.sum(axis=-1)
+    total = np.where(valid, blocks, 0).sum(axis=-1, dtype="float64")
+    # Blocks without valid pixels are NaN until they're filled below
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        if not np.issubdtype(blocks.dtype, np.floating):
+            mean = np.floor(mean + 0.5)
+        mean = mean.astype(blocks.dtype)
+    if nodata is not None and not np.isnan(nodata):
+        # Like GDAL, don't let an average of valid pixels come out as nodata
+        mean[mean == nodata] = _next_to(blocks.dtype, nodata)
+    return np.where(count > 0, mean, _fill_value(blocks.dtype, nodata)).astype(
+        blocks.dtype
+    )
+
+
+def _sorted_mode(blocks: np.ndarray, valid: np.ndarray, nodata) -> np.ndarray:
+    # A stable sort of each block by value, with invalid pixels last, puts equal
+    # values in runs in their original order. The longest run wins, and ties go to
+    # the value that reached that count first in scan order, like GDAL.
+    size = blocks.shape[-1]
+    index_type = np.int16 if size < 2**15 else np.int64
+    if blocks.dtype.itemsize == 1:
+        # Stable sorts of 16 bit integers are radix sorts, much faster than lexsort
+        keys = np.where(valid, blocks.view(np.uint8).astype(np.uint16), 256)
+        order = np.argsort(keys, axis=-1, kind="stable")
+    else:
+        order = np.lexsort((blocks, ~valid), axis=-1)
+    ordered = np.take_along_axis(blocks, order, axis=-1)
+    ordered_valid = np.take_along_axis(valid, order, axis=-1)
+    starts = (ordered[..., 1:] != ordered[..., :-1]) | (
+        ordered_valid[..., 1:] != ordered_valid[..., :-1]
+    )
+    order = order.astype(index_type)
+    position = np.arange(size, dtype=index_type)
+    run_start = np.zeros(ordered.shape, dtype=index_type)
+    run_start[..., 1:] = np.where(starts, position[1:], 0)
+    run_start = np.maximum.accumulate(run_start, axis=-1)
+    count = np.where(ordered_valid, position - run_start + 1, 0).astype(index_type)
+    # Only the last pixel of a longest run has the highest count
+    longest = count == count.max(axis=-1, keepdims=True)
+    best = np.where(longest, order, size).argmin(axis=-1)[..., None]
+    mode = np.take_along_axis(ordered, best, axis=-1)[..., 0]
+    return np.where(
+        ordered_valid.any(axis=-1), mode, _fill_value(blocks.dtype, nodata)
+    ).astype(blocks.dtype)
+
+
+def _mode(blocks: np.ndarray, valid: np.ndarray, nodata) -> np.ndarray:
+    # Classified outputs are mostly made of blocks of a single class, which don't
+    # need sorting
+    mode = blocks[..., 0].copy()
+    mixed = ~(valid[..., 0] & ((blocks == blocks[..., :1]) | ~valid).all(axis=-1))
+    if mixed.any():
+        mode[mixed] = _sorted_mode(blocks[mixed], valid[mixed], nodata)
+    return mode
+
+
+def _blocks(array, strip, rows, rows_valid, cols, cols_valid):
+    # (rows, block rows, cols, block cols) -> (rows, cols, block pixels)
+    out_rows, out_cols = len(rows[strip]), len(cols)
+    if rows_valid.all() and cols_valid.all():
+        # Evenly divided, so the blocks are a view of the source rows
+        source = array[rows[strip][0, 0] : rows[strip][-1, -1] + 1]
+        blocks = source.reshape(out_rows, rows.shape[1], out_cols, cols.shape[1])
+        in_block = None
+    else:
+        blocks = array[rows[strip][:, :, None, None], cols[None, None]]
+        in_block = rows_valid[strip][:, None, :, None] & cols_valid[None, :, None, :]
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(out_rows, out_cols, -1)
+    if in_block is not None:
+        in_block = in_block.reshape(blocks.shape)
+    return blocks, in_block
+
+
+def _reduce(array: np.ndarray, shape: tuple[int, int], resampling, nodata):
+    height, width = array.shape
+    rows, rows_valid = _block_indices(height, shape[0])
+    cols, cols_valid = _block_indices(width, shape[1])
+    if resampling == Resampling.nearest:
+        # GDAL takes the top left pixel of each block
+        return array[np.ix_(rows[:, 0], cols[:, 0])]
+
+    reduce = _average if resampling == Resampling.average else _mode
+    level = np.empty(shape, dtype=array.dtype)
+    strip_rows = max(1, _STRIP_PIXELS // shape[1])
+    for start in range(0, shape[0], strip_rows):
+        strip = slice(start, start + strip_rows)
+        blocks, in_block = _blocks(array, strip, rows, rows_valid, cols, cols_valid)
+        valid = _is_valid(blocks, nodata)
+        if in_block is not None:
+            valid &= in_block
+        level[strip] = reduce(blocks, valid, nodata)
+    return level
+
+
+def overview_levels(
+    array: np.ndarray,
+    factors: tuple[int, ...],
+    resampling: Resampling,
+    nodata=None,
+) -> list[np.ndarray]:
+    """
+    Reduce a 2D array to each overview level with vectorised block reductions.
+    Levels are sized like GDAL's and each is reduced from the one before, so they
+    match what GDAL's ``build_overviews`` writes where the factors divide the array
+    evenly. Elsewhere blocks are made of whole pixels, where GDAL weights partial
+    ones: nearest still matches, averages are within about 1% of the data's range
+    of GDAL's, and modes can differ along the edges between classes. Nodata pixels
+    are left out, and a block with no valid pixels is nodata.
+    """
+    if resampling not in IN_MEMORY_RESAMPLING:
+        raise ValueError(f"Can't build {resampling.name} overviews in memory")
+    height, width = array.shape
+    levels = []
+    source = array
+    for factor in sorted(factors):
+        shape = (-(-height // factor), -(-width // factor))
+        source = _reduce(source, shape, resampling, nodata)
+        levels.append(source)
+    return levels
+
+
+def _mem_dataset(array: np.ndarray) -> str:
+    # A GDAL MEM dataset over the array's own buffer, so GDAL reads it without a
+    # copy. The array has to outlive every use of the name.
+    height, width = array.shape
+    return (
+        f"MEM:::DATAPOINTER={array.__array_interface__['data'][0]},"
+        f"PIXELS={width},LINES={height},BANDS=1,"
+        f"DATATYPE={_GDAL_TYPES[array.dtype.name]}"
+    )
+
+
+def _vrt_with_overviews(full: str, overviews: list[str], array, grid, nodata) -> str:
+    height, width = array.shape
+    vrt = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    if grid.crs is not None:
+        ET.SubElement(vrt, "SRS").text = grid.crs.to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(
+        repr(v) for v in grid.transform.to_gdal()
+    )
+    band = ET.SubElement(
+        vrt, "VRTRasterBand", dataType=_GDAL_TYPES[array.dtype.name], band="1"
+    )
+    if nodata is not None:
+        ET.SubElement(band, "NoDataValue").text = repr(float(nodata))
+    source = ET.SubElement(band, "SimpleSource")
+    ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = full
+    ET.SubElement(source, "SourceBand").text = "1"
+    for name in overviews:
+        overview = ET.SubElement(band, "Overview")
+        ET.SubElement(overview, "SourceFilename", relativeToVRT="0").text = name
+        ET.SubElement(overview, "SourceBand").text = "1"
+    return ET.tostring(vrt, encoding="unicode")
+
+
+def write_cog(
+    path: Path,
+    array: np.ndarray,
+    grid: images.GridSpec,
+    nodata=None,
+    overviews: tuple[int, ...] = images.DEFAULT_OVERVIEWS,
+    overview_resampling: Resampling = Resampling.average,
+    blocksize: int = 512,
+    overview_blocksize: int = 512,
+) -> str:
+    """
+    Write a 2D array as a COG with the same layout and compression as eodatasets3,
+    but with its overviews built from the array in memory instead of by GDAL
+    re-reading the full resolution file from disk.
+
+    GDAL reads the array and its overviews in place, so the only extra memory is
+    the overviews themselves, about a third of the array at most, and the
+    compressed file, which is assembled in memory so that it can be checksummed
+    as it's written out.
+
+    :returns: the SHA1 of the written file
+    """
+    if array.dtype.name not in _GDAL_TYPES:
+        raise TypeError(f"Datatype not supported: {array.dtype.name}")
+    if nodata is None and np.issubdtype(array.dtype, np.floating):
+        nodata = np.nan
+
+    options = {
+        "compress": "deflate",
+        "zlevel": 4,
+        "predictor": images.FileWrite.PREDICTOR_DEFAULTS[array.dtype.name],
+        "copy_src_overviews": "yes",
+    }
+    if array.shape[0] >= blocksize or array.shape[1] >= blocksize:
+        options.update(tiled="yes", blockxsize=blocksize, blockysize=blocksize)
+
+    array = np.ascontiguousarray(array)
+    levels = overview_levels(array, overviews, overview_resampling, nodata)
+    vrt = _vrt_with_overviews(
+        _mem_dataset(array),
+        [_mem_dataset(level) for level in levels],
+        array,
+        grid,
+        nodata,
+    )
+    with (
+        rasterio.Env(
+            GDAL_MEM_ENABLE_OPEN="YES", GDAL_TIFF_OVR_BLOCKSIZE=overview_blocksize
+        ),
+        MemoryFile() as memory_file,
+    ):
+        rio_copy(vrt, memory_file.name, driver="GTiff", **options)
+        return write_hashed(path, memory_file.getbuffer())
+
+
+def write_measurements(
+    dataset_assembler: DatasetAssembler,
+    dataset: xr.Dataset,
+    nodata: Optional[Union[float, int]] = None,
+    overviews=images.DEFAULT_OVERVIEWS,
+    overview_resampling=Resampling.average,
+    expand_valid_data=True,
+    file_id: Optional[str] = None,
+):
+    """
+    A drop-in for ``DatasetAssembler.write_measurements_odc_xarray`` that builds
+    overviews in memory where it can, and leaves the rest to eodatasets3.
+    """
+    grid_spec = images.GridSpec.from_odc_xarray(dataset)
+    for name, dataarray in dataset.data_vars.items():
+        nodata_value = dataarray.attrs.get("nodata", None) if nodata is None else nodata
+        array = np.asarray(dataarray.data)
+        if array.dtype == bool:
+            array = array.astype("uint8")
+
+        if (
+            not overviews
+            or overview_resampling not in IN_MEMORY_RESAMPLING
+            or array.ndim != 2
+            or array.dtype.name not in _GDAL_TYPES
+        ):
+            dataset_assembler.write_measurement_numpy(
+                name,
+                array,
+                grid_spec,
+                nodata=nodata_value,
+                overviews=overviews,
+                overview_resampling=overview_resampling,
+                expand_valid_data=expand_valid_data,
+                file_id=file_id,
+            )
+            continue
+
+        work_path = dataset_assembler._work_path  # noqa: SLF001
+        path = work_path / dataset_assembler.names.measurement_filename(
+            name, "tif", file_id=file_id
+        )
+        sha1 = write_cog(
+            path, array, grid_spec, nodata_value, overviews, overview_resampling
+        )
+
+        file_format = FileFormat.GeoTIFF.name
+        if "odc:file_format" not in dataset_assembler.properties:
+            dataset_assembler.properties["odc:file_format"] = file_format
+        if file_format != dataset_assembler.properties["odc:file_format"]:
+            raise RuntimeError(
+                f"Inconsistent file formats between bands. "
+                f"Was {dataset_assembler.properties['odc:file_format']!r}, now {file_format!r}"
+            )
+        dataset_assembler.note_measurement(
+            name,
+            path,
+            expand_valid_data=expand_valid_data,
+            grid=grid_spec,
+            pixels=array,
+            nodata=nodata_value,
+        )
+        dataset_assembler._checksum._append_hash(path, sha1)  # noqa: SLF001
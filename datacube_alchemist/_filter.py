@@ -0,0 +1,184 @@
+"""Dropping datasets that aren't worth queueing
+- load_aoi
+- matches
+- DatasetFilter
+"""
+
+import itertools
+import json
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import suppress
+from typing import Any, Optional
+
+import fsspec
+import numpy as np
+import shapely
+from datacube.model import Dataset, Range
+from datacube.utils.geometry import CRS, Geometry
+from shapely.geometry import shape
+
+from datacube_alchemist.settings import FilterSettings
+
+# How many datasets' footprints are intersected with the area of interest at once
+BATCH_SIZE = 1000
+
+
+def load_aoi(path: str) -> Geometry:
+    """
+    The union of the geometries in a GeoJSON file, which is in WGS84 unless it has
+    an old-style ``crs`` member
+    """
+    with fsspec.open(path, mode="r") as f:
+        doc = json.load(f)
+    if doc.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in doc["features"]]
+    elif doc.get("type") == "Feature":
+        geometries = [doc["geometry"]]
+    else:
+        geometries = [doc]
+    crs = doc.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+    return Geometry(
+        shapely.union_all([shape(geometry) for geometry in geometries]), crs=crs
+    )
+
+
+def _matches(value, term) -> bool:
+    if value is None:
+        return False
+    if isinstance(term, Range):
+        # Range fields, like time, match when they overlap, as they do in a search
+        if isinstance(value, Range):
+            return value.begin <= term.end and term.begin <= value.end
+        return term.begin <= value <= term.end
+    return value == term
+
+
+def _within(narrow, wide) -> bool:
+    # Whether everything that matches the narrow term matches the wide one too
+    try:
+        if isinstance(wide, Range):
+            if isinstance(narrow, Range):
+                return wide.begin <= narrow.begin and narrow.end <= wide.end
+            return _matches(narrow, wide)
+        return not isinstance(narrow, Range) and narrow == wide
+    except TypeError:
+        return False
+
+
+def _intersect(term, other):
+    # The term that matches what both match, or None if there's none to search by
+    if _within(term, other):
+        return term
+    if _within(other, term):
+        return other
+    if isinstance(term, Range) and isinstance(other, Range):
+        with suppress(TypeError):
+            begin, end = max(term.begin, other.begin), min(term.end, other.end)
+            if begin <= end:
+                return Range(begin, end)
+    return None
+
+
+def matches(dataset: Dataset, terms: Mapping[str, Any]) -> bool:
+    """Whether the dataset's search fields match parsed search expressions"""
+    for name, term in terms.items():
+        try:
+            value = getattr(dataset.metadata, name)
+        except AttributeError:
+            # A search would find nothing with a field its metadata type lacks
+            return False
+        if not _matches(value, term):
+            return False
+    return True
+
+
+class DatasetFilter:
+    """
+    Filters datasets by a :class:`FilterSettings`, keeping those that match its
+    search expressions and whose footprints intersect its area of interest.
+
+    The expressions and the area's bounds can be added to an index search with
+    :meth:`search_query`, so the index does most of the work. What's left of the
+    area of interest is intersected a batch at a time, against every footprint in
+    the same CRS at once, rather than reprojecting each footprint.
+    """
+
+    def __init__(self, settings: FilterSettings, batch_size: int = BATCH_SIZE):
+        from datacube.ui.expression import parse_expressions
+
+        self.terms = parse_expressions(*settings.expressions)
+        self.aoi = load_aoi(settings.aoi) if settings.aoi else None
+        self.batch_size = batch_size
+        # How many datasets were dropped by the expressions and by the area
+        self.dropped: Counter = Counter()
+        self._aoi_by_crs: dict[str, Any] = {}
+
+    def search_query(self, query: Mapping[str, Any]) -> dict:
+        """
+        A search query with the filter's terms, and the bounds of its area of
+        interest, added to it. A term already in the query is narrowed to where it
+        overlaps the filter's, or left as it is if it can't be, in which case
+        :meth:`__call__` still checks the filter's term.
+        """
+        query = dict(query)
+        for name, term in self.terms.items():
+            if name not in query:
+                query[name] = term
+            else:
+                query[name] = _intersect(query[name], term) or query[name]
+        if self.aoi is not None and "lat" not in query and "lon" not in query:
+            bounds = self.aoi.to_crs("EPSG:4326").boundingbox
+            query["lon"] = Range(bounds.left, bounds.right)
+            query["lat"] = Range(bounds.bottom, bounds.top)
+        return query
+
+    def _aoi_in(self, crs: CRS):
+        key = str(crs)
+        if key not in self._aoi_by_crs:
+            geom = self.aoi.to_crs(crs).geom
+            shapely.prepare(geom)
+            self._aoi_by_crs[key] = geom
+        return self._aoi_by_crs[key]
+
+    def _intersecting(self, datasets: list[Dataset]) -> list[Dataset]:
+        extents = [dataset.extent for dataset in datasets]
+        # Datasets without a footprint can't be ruled out
+        keep = np.ones(len(datasets), dtype=bool)
+        by_crs = defaultdict(list)
+        for i, extent in enumerate(extents):
+            if extent is not None:
+                by_crs[extent.crs].append(i)
+        for crs, indices in by_crs.items():
+            keep[indices] = shapely.intersects(
+                self._aoi_in(crs), [extents[i].geom for i in indices]
+            )
+        self.dropped["aoi"] += int((~keep).sum())
+        return [dataset for dataset, kept in zip(datasets, keep) if kept]
+
+    def __call__(
+        self, datasets: Iterable[Dataset], searched: Optional[Mapping[str, Any]] = None
+    ) -> Iterator[Dataset]:
+        """
+        The datasets that pass the filter
+
+        :param searched: the query from :meth:`search_query` that the datasets were
+            found with, so they already match the expressions it holds
+        """
+        # Only the terms the search didn't narrow to need checking
+        terms = {
+            name: term
+            for name, term in self.terms.items()
+            if searched is None
+            or name not in searched
+            or not _within(searched[name], term)
+        }
+        datasets = iter(datasets)
+        while batch := list(itertools.islice(datasets, self.batch_size)):
+            if terms:
+                kept = [dataset for dataset in batch if matches(dataset, terms)]
+                self.dropped["expressions"] += len(batch) - len(kept)
+                batch = kept
+            if self.aoi is not None:
+                batch = self._intersecting(batch)
+            yield from batch
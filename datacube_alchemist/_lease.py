@@ -0,0 +1,140 @@
+"""Leases that stop workers running the same task at once
+- FileLeases
+- S3Leases
+- get_leases
+"""
+
+import json
+import os
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+from datacube_alchemist._queue import SQLITE_SCHEME, get_queue, lease_owner
+
+# Where leases are kept, under the output location
+LEASE_DIRECTORY = ".alchemist-leases"
+
+
+def _lease_body(owner: str, ttl: float) -> str:
+    return json.dumps({"owner": owner, "expires": time.time() + ttl})
+
+
+def _expired(body) -> bool:
+    try:
+        return json.loads(body)["expires"] <= time.time()
+    except (ValueError, KeyError, TypeError):
+        # Still being written by the worker that's taking it
+        return False
+
+
+class FileLeases:
+    """Leases as files in a directory, created only if they don't already exist"""
+
+    def __init__(self, directory, owner: Optional[str] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.owner = owner or lease_owner()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.lease"
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        path = self._path(key)
+        # A second try, if the lease there is one left by a worker that died
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    body = path.read_text()
+                except FileNotFoundError:
+                    continue
+                if not _expired(body):
+                    return False
+                with suppress(FileNotFoundError):
+                    path.unlink()
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(_lease_body(self.owner, ttl))
+            return True
+        return False
+
+    def release_lease(self, key: str) -> None:
+        path = self._path(key)
+        with suppress(FileNotFoundError, ValueError, KeyError):
+            if json.loads(path.read_text())["owner"] == self.owner:
+                path.unlink()
+
+
+class S3Leases:
+    """Leases as S3 objects, written only if they don't already exist"""
+
+    def __init__(self, prefix: str, owner: Optional[str] = None):
+        import boto3
+
+        parsed = urlparse(prefix)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.owner = owner or lease_owner()
+        self._s3 = boto3.client("s3")
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}.lease".lstrip("/")
+
+    def _body(self, key: str) -> Optional[bytes]:
+        try:
+            response = self._s3.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self._s3.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        from botocore.exceptions import ClientError
+
+        for _ in range(2):
+            try:
+                self._s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self._key(key),
+                    Body=_lease_body(self.owner, ttl).encode(),
+                    IfNoneMatch="*",
+                )
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                body = self._body(key)
+                if body is not None and not _expired(body):
+                    return False
+                if body is not None:
+                    self._s3.delete_object(Bucket=self.bucket, Key=self._key(key))
+                continue
+            return True
+        return False
+
+    def release_lease(self, key: str) -> None:
+        body = self._body(key)
+        with suppress(ValueError, KeyError, TypeError):
+            if body is not None and json.loads(body)["owner"] == self.owner:
+                self._s3.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def get_leases(queue: str, location: str):
+    """
+    The leases for workers of a queue: a SQLite queue's own, or else ones in the
+    output location, on S3 or a shared filesystem. Each has ``acquire_lease(key,
+    ttl)`` and ``release_lease(key)``.
+
+    A lease saves work rather than guarding correctness: in the rare race where two
+    workers both break the same expired lease, both write the same output, as they
+    would without one.
+    """
+    if queue.startswith(SQLITE_SCHEME):
+        return get_queue(queue)
+    directory = f"{location.rstrip('/')}/{LEASE_DIRECTORY}"
+    if urlparse(location).scheme == "s3":
+        return S3Leases(directory)
+    return FileLeases(directory)
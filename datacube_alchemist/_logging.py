@@ -0,0 +1,24 @@
+"""Logging setup
+
+Kept apart from ``_utils`` so that the CLI can configure logging without
+importing datacube and eodatasets3.
+"""
+
+import structlog
+
+
+def _configure_logger():
+    processors = [
+        structlog.stdlib.add_log_level,
+        structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S"),
+        structlog.processors.StackInfoRenderer(),
+        structlog.processors.format_exc_info,
+        structlog.dev.ConsoleRenderer(),
+    ]
+
+    structlog.configure(
+        processors=processors,
+        context_class=dict,
+        cache_logger_on_first_use=True,
+        logger_factory=structlog.PrintLoggerFactory(),
+    )
@@ -0,0 +1,175 @@
+"""Per-task timing and resource instrumentation
+- TaskMetrics
+- textfile_path
+- write_prometheus_textfile
+"""
+
+import os
+import re
+import resource
+import tempfile
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+# The stages of execute_task, in the order they happen
+STAGES = (
+    "lookup",
+    "precheck",
+    "admit",
+    "load",
+    "graph",
+    "compute",
+    "encode",
+    "thumbnail",
+    "metadata",
+    "upload",
+    "publish",
+)
+
+
+def _reset_peak_rss() -> None:
+    # Linux lets us reset the high water mark, so we get a per-task peak
+    # rather than the peak of the whole process.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, but this is only a fallback
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TaskMetrics:
+    """
+    Collects stage durations, bytes moved and peak memory for a single task
+    """
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # "written", or if the task failed its precheck, "empty" or "skipped"
+        self.outcome = "written"
+        self._start = time.perf_counter()
+
+    def begin(self) -> None:
+        """Mark the start of execution, resetting the wall clock and peak memory"""
+        self._start = time.perf_counter()
+        _reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def summary(self) -> dict:
+        """Flat fields suitable for attaching to a structured log event"""
+        fields = {
+            f"{stage}_seconds": round(self.stages[stage], 3)
+            for stage in STAGES
+            if stage in self.stages
+        }
+        fields["total_seconds"] = round(time.perf_counter() - self._start, 3)
+        fields["bytes_read"] = self.bytes_read
+        fields["bytes_written"] = self.bytes_written
+        fields["peak_rss_bytes"] = _peak_rss_bytes()
+        fields["outcome"] = self.outcome
+        return fields
+
+
+def directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def textfile_path(path: str, transform: str) -> Path:
+    """
+    The textfile for this process and transform, next to the configured ``path``.
+
+    Each worker process and each transform of a group writes its own file, as the
+    textfile collector reads every ``*.prom`` file in its directory and a single
+    shared file would only ever hold the last writer's series.
+    """
+    path = Path(path)
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", transform)
+    return path.with_name(f"{path.stem}.{name}.{os.getpid()}{path.suffix}")
+
+
+def write_prometheus_textfile(
+    path: str,
+    metrics: TaskMetrics,
+    labels: Optional[dict] = None,
+    outcomes: Optional[Mapping[str, int]] = None,
+) -> None:
+    """
+    Write the metrics of the last task in the Prometheus text format, for the
+    node exporter's textfile collector, along with the process's running count of
+    task ``outcomes``, if it's given.
+
+    The file is replaced atomically, so the collector never sees a partial write.
+    """
+    labels = labels or {}
+    summary = metrics.summary()
+    lines = [
+        "# HELP alchemist_task_stage_seconds Time spent in each stage of the last task.",
+        "# TYPE alchemist_task_stage_seconds gauge",
+    ]
+    lines.extend(
+        f"alchemist_task_stage_seconds{_format_labels({**labels, 'stage': stage})} "
+        f"{metrics.stages[stage]:.6f}"
+        for stage in STAGES
+        if stage in metrics.stages
+    )
+    for name, help_text in (
+        ("total_seconds", "Wall time of the last task."),
+        ("bytes_read", "Bytes of source data loaded by the last task."),
+        ("bytes_written", "Bytes of output written by the last task."),
+        ("peak_rss_bytes", "Peak resident memory during the last task."),
+    ):
+        lines.append(f"# HELP alchemist_task_{name} {help_text}")
+        lines.append(f"# TYPE alchemist_task_{name} gauge")
+        lines.append(f"alchemist_task_{name}{_format_labels(labels)} {summary[name]}")
+    if outcomes:
+        lines.append(
+            "# HELP alchemist_tasks_total Tasks written, written empty or skipped."
+        )
+        lines.append("# TYPE alchemist_tasks_total counter")
+        lines.extend(
+            f"alchemist_tasks_total{_format_labels({**labels, 'outcome': outcome})} "
+            f"{count}"
+            for outcome, count in sorted(outcomes.items())
+        )
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
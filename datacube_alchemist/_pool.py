@@ -0,0 +1,107 @@
+"""A pool of long-lived worker processes for executing tasks
+- execute_in_pool
+"""
+
+import multiprocessing
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import structlog
+
+from datacube_alchemist._logging import _configure_logger
+from datacube_alchemist._profiling import profile_task
+from datacube_alchemist.settings import AlchemistSettings
+
+_LOG = structlog.get_logger()
+
+# The executor of each worker process, built once by _init_worker
+_EXECUTOR = None
+
+
+def _init_worker(configs: Sequence[AlchemistSettings]) -> None:
+    global _EXECUTOR
+    from datacube_alchemist.worker import Alchemist, AlchemistGroup
+
+    _configure_logger()
+    alchemists = [Alchemist(config=config) for config in configs]
+    _EXECUTOR = alchemists[0] if len(alchemists) == 1 else AlchemistGroup(alchemists)
+
+
+def _run_task(task, dryrun, sns_arn, profile_dir, profile_rate, profiler):
+    with profile_task(task.dataset.id, profile_dir, profile_rate, profiler):
+        _EXECUTOR.execute_task(task, dryrun, sns_arn)
+    # The parent deletes the message once this returns, so the STAC must be sent,
+    # and a failure to send it is this task's
+    for future in task.published:
+        future.result()
+
+
+def execute_in_pool(
+    tasks_and_messages: Iterable[tuple],
+    configs: Sequence[AlchemistSettings],
+    workers: int,
+    dryrun: bool = False,
+    sns_arn: Optional[str] = None,
+    profile_dir: Optional[str] = None,
+    profile_rate: float = 1.0,
+    profiler: str = "cprofile",
+) -> Iterator[tuple]:
+    """
+    Execute tasks on ``workers`` processes, yielding ``(task, message, error)`` as
+    each one finishes, where ``error`` is None for a success.
+
+    Each worker builds its Alchemist (or AlchemistGroup, for several configs) once
+    and keeps it, so imports, transform instances and GDAL caches stay warm. Tasks
+    are only taken from ``tasks_and_messages`` when a worker is free, so messages
+    aren't left waiting out their visibility timeout in the parent.
+
+    If a worker dies, or fails to build its Alchemist, the pool is broken: the tasks
+    in flight are yielded with a ``BrokenProcessPool`` error and no more are taken.
+
+    Closing the generator early cancels tasks that haven't started, and waits for
+    the running ones.
+    """
+    # Spawned rather than forked, so workers don't inherit the parent's index
+    # connection or the thread state of GDAL and boto3
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(list(configs),),
+    )
+    in_flight = {}
+    tasks_and_messages = iter(tasks_and_messages)
+    broken = False
+    try:
+        while True:
+            for task, message in () if broken else tasks_and_messages:
+                try:
+                    future = pool.submit(
+                        _run_task,
+                        task,
+                        dryrun,
+                        sns_arn,
+                        profile_dir,
+                        profile_rate,
+                        profiler,
+                    )
+                except BrokenProcessPool as e:
+                    broken = True
+                    yield task, message, e
+                    break
+                in_flight[future] = (task, message)
+                if len(in_flight) >= workers:
+                    break
+            if not in_flight:
+                return
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, message = in_flight.pop(future)
+                error = future.exception()
+                broken = broken or isinstance(error, BrokenProcessPool)
+                yield task, message, error
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
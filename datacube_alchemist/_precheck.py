@@ -0,0 +1,110 @@
+"""Cheap checks for source datasets that aren't worth processing
+- cloud_cover
+- valid_fraction
+- usable_fraction
+- precheck
+- empty_output
+"""
+
+import math
+from collections.abc import Mapping, Sequence
+from typing import Optional
+
+import numpy as np
+import xarray as xr
+from affine import Affine
+from datacube import Datacube
+from datacube.model import Dataset, Measurement
+from datacube.testutils.io import native_geobox
+from datacube.utils.geometry import GeoBox
+
+from datacube_alchemist.settings import PrecheckSettings
+
+
+def cloud_cover(dataset: Dataset) -> Optional[float]:
+    """The dataset's eo:cloud_cover percentage, if its metadata has one"""
+    try:
+        value = dataset.metadata.cloud_cover
+    except AttributeError:
+        value = dataset.metadata_doc.get("properties", {}).get("eo:cloud_cover")
+    return None if value is None else float(value)
+
+
+def valid_fraction(dataset: Dataset, basis: Optional[str] = None) -> Optional[float]:
+    """How much of the dataset's grid its valid-data geometry covers"""
+    extent = dataset.extent
+    if extent is None:
+        return None
+    grid = native_geobox(dataset, basis=basis).extent
+    return extent.intersection(grid).area / grid.area
+
+
+def usable_fraction(
+    dataset: Dataset,
+    measurement: str,
+    usable_values: Sequence[int],
+    decimation: int = 10,
+) -> float:
+    """
+    The fraction of a mask band's pixels with usable values, read at a fraction of
+    its resolution so that it only needs the file's overviews
+    """
+    native = native_geobox(dataset, measurements=[measurement])
+    geobox = GeoBox(
+        math.ceil(native.width / decimation),
+        math.ceil(native.height / decimation),
+        native.transform * Affine.scale(decimation),
+        native.crs,
+    )
+    mask = Datacube.load_data(
+        Datacube.group_datasets([dataset], "time"),
+        geobox,
+        measurements=dataset.type.lookup_measurements([measurement]),
+        resampling="nearest",
+    )[measurement].values
+    return float(np.isin(mask, usable_values).mean())
+
+
+def precheck(
+    dataset: Dataset, settings: PrecheckSettings, basis: Optional[str] = None
+) -> Optional[str]:
+    """
+    Why the dataset isn't worth processing, or None if it is, going through the
+    checks from its metadata to the read of its mask band
+    """
+    if settings.max_cloud_cover is not None:
+        cover = cloud_cover(dataset)
+        if cover is not None and cover > settings.max_cloud_cover:
+            return "cloud_cover"
+
+    if settings.min_valid_fraction is not None:
+        fraction = valid_fraction(dataset, basis)
+        if fraction is not None and fraction < settings.min_valid_fraction:
+            return "valid_fraction"
+
+    # A group's configs can share a product without sharing its mask band
+    if settings.mask_measurement in dataset.type.measurements and (
+        usable_fraction(
+            dataset,
+            settings.mask_measurement,
+            settings.mask_usable_values,
+            settings.mask_decimation,
+        )
+        <= settings.min_usable_fraction
+    ):
+        return "mask"
+    return None
+
+
+def empty_output(
+    dataset: Dataset,
+    measurements: Mapping[str, Measurement],
+    source_measurements: Sequence[str],
+    basis: Optional[str] = None,
+) -> xr.Dataset:
+    """
+    Output ``measurements`` filled with their nodata, on the grid the dataset's
+    ``source_measurements`` would have been loaded on
+    """
+    geobox = native_geobox(dataset, measurements=source_measurements, basis=basis)
+    return Datacube.create_storage({}, geobox, list(measurements.values()))
@@ -0,0 +1,215 @@
+"""Background download of source files for upcoming tasks
+- Prefetcher
+"""
+
+import copy
+import shutil
+import tempfile
+import urllib.request
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+import attr
+import structlog
+from botocore.exceptions import ClientError
+from datacube.model import Dataset
+from datacube.utils.uris import uri_resolve
+
+from datacube_alchemist.settings import AlchemistTask
+
+_LOG = structlog.get_logger()
+
+_REMOTE_SCHEMES = ("s3", "http", "https")
+
+
+class Prefetcher:
+    """
+    Download the source files of the next ``depth`` tasks to local scratch while the
+    current task runs, and hand out tasks that read from those local copies.
+
+    S3 objects are fetched with many concurrent range GETs. Any file that can't be
+    fetched is read from its original location instead.
+    """
+
+    def __init__(
+        self,
+        depth: int = 1,
+        directory: Optional[str] = None,
+        concurrency: int = 16,
+        aws_unsigned: bool = True,
+    ):
+        if directory:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+        self.depth = depth
+        self._root = Path(tempfile.mkdtemp(prefix="alchemist-prefetch-", dir=directory))
+        self._concurrency = concurrency
+        self._aws_unsigned = aws_unsigned
+        # Whole files are fetched in parallel, and each one in parallel ranges
+        self._files = ThreadPoolExecutor(max_workers=concurrency)
+        self._s3 = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._files.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self._root, ignore_errors=True)
+
+    def _s3_client(self):
+        if self._s3 is None:
+            import boto3
+            from botocore import UNSIGNED
+            from botocore.config import Config
+
+            config = Config(max_pool_connections=self._concurrency * 4)
+            if self._aws_unsigned:
+                config = config.merge(Config(signature_version=UNSIGNED))
+            self._s3 = boto3.client("s3", config=config)
+        return self._s3
+
+    def _download(self, uri: str, destination: Path) -> Path:
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        url = urlparse(uri)
+        if url.scheme == "s3":
+            from boto3.s3.transfer import TransferConfig
+
+            self._s3_client().download_file(
+                url.netloc,
+                url.path.lstrip("/"),
+                str(destination),
+                Config=TransferConfig(
+                    max_concurrency=self._concurrency,
+                    multipart_chunksize=8 * 2**20,
+                ),
+            )
+        else:
+            with urllib.request.urlopen(uri) as response, open(destination, "wb") as f:
+                shutil.copyfileobj(response, f)
+        return destination
+
+    def _start_dataset(self, dataset: Dataset, directory: Path, measurements):
+        futures = {}
+        if not dataset.uris:
+            return futures
+        for name in measurements:
+            name = dataset.product.canonical_measurement(name)
+            measurement = dataset.measurements.get(name)
+            if measurement is None:
+                continue
+            uri = uri_resolve(dataset.uris[0], measurement["path"])
+            if urlparse(uri).scheme not in _REMOTE_SCHEMES:
+                continue
+            destination = directory / name / Path(urlparse(uri).path).name
+            futures[name] = self._files.submit(self._download, uri, destination)
+        return futures
+
+    def _start(self, task: AlchemistTask) -> list[dict[str, Future]]:
+        # The files of each of a grouped task's datasets
+        directory = self._root / str(task.dataset.id)
+        measurements = task.settings.specification.measurements
+        if not task.group:
+            return [self._start_dataset(task.dataset, directory, measurements)]
+        return [
+            self._start_dataset(dataset, directory / str(dataset.id), measurements)
+            for dataset in task.group
+        ]
+
+    def _localise_dataset(
+        self, task: AlchemistTask, source: Dataset, futures: dict[str, Future]
+    ) -> Dataset:
+        doc = copy.deepcopy(source.metadata_doc)
+        dataset = Dataset(
+            source.product,
+            doc,
+            uris=source.uris,
+            sources=source.sources,
+            indexed_by=source.indexed_by,
+            indexed_time=source.indexed_time,
+            archived_time=source.archived_time,
+        )
+        for name, future in futures.items():
+            try:
+                path = future.result()
+            except Exception as e:
+                _LOG.warning(
+                    "Couldn't prefetch, reading it remotely",
+                    task=task.dataset.id,
+                    dataset=source.id,
+                    measurement=name,
+                    error=str(e),
+                )
+                continue
+            # Absolute URIs take precedence over the dataset's location
+            dataset.measurements[name]["path"] = path.as_uri()
+        return dataset
+
+    def _localise(self, task: AlchemistTask, futures: list[dict[str, Future]]):
+        datasets = [
+            self._localise_dataset(task, source, source_futures)
+            for source, source_futures in zip(task.datasets, futures)
+        ]
+        if not task.group:
+            return attr.evolve(task, dataset=datasets[0])
+        return attr.evolve(task, dataset=datasets[-1], group=datasets)
+
+    def _extend_visibility(self, messages, visibility_timeout: int) -> None:
+        for message in messages:
+            if message is None:
+                continue
+            try:
+                message.change_visibility(VisibilityTimeout=visibility_timeout)
+            except ClientError as e:
+                _LOG.warning(
+                    "Couldn't extend the visibility of a prefetched message",
+                    message=message.message_id,
+                    error=str(e),
+                )
+
+    def prefetch(
+        self,
+        tasks_and_messages: Iterable[tuple],
+        visibility_timeout: Optional[int] = None,
+    ) -> Iterator[tuple]:
+        """
+        Yield the ``(task, message)`` pairs with each task reading from local copies,
+        fetching up to ``depth`` tasks ahead of the one being yielded.
+
+        Messages are received before their tasks are due, so if ``visibility_timeout``
+        is given, each time a task is yielded the visibility of its message and those
+        still waiting is reset to it. They then stay invisible as long as no one task
+        takes longer than the timeout.
+
+        Call ``release()`` with each task once it has been executed.
+        """
+        pending = deque()
+        items = iter(tasks_and_messages)
+
+        def fill(count):
+            while len(pending) < count:
+                try:
+                    task, message = next(items)
+                except StopIteration:
+                    return
+                pending.append((task, message, self._start(task)))
+
+        fill(self.depth + 1)
+        while pending:
+            task, message, futures = pending.popleft()
+            # Start the next downloads before waiting on this task's
+            fill(self.depth)
+            if visibility_timeout is not None:
+                self._extend_visibility(
+                    [message] + [m for _, m, _ in pending], visibility_timeout
+                )
+            yield self._localise(task, futures), message
+
+    def release(self, task: AlchemistTask) -> None:
+        """Remove a task's local copies"""
+        shutil.rmtree(self._root / str(task.dataset.id), ignore_errors=True)
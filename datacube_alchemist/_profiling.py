@@ -0,0 +1,108 @@
+"""Opt-in per-task profiling
+- profile_task
+"""
+
+import cProfile
+import random
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Optional
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+def _copy_artifact(path: Path, directory: str) -> str:
+    """Copy a local file into a local directory or an S3 prefix"""
+    if directory.startswith("s3://"):
+        import boto3
+        from odc.aws import s3_url_parse
+
+        destination = f"{directory.rstrip('/')}/{path.name}"
+        bucket, key = s3_url_parse(destination)
+        boto3.client("s3").upload_file(str(path), bucket, key)
+        return destination
+
+    destination = Path(directory) / path.name
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(path, destination)
+    return str(destination)
+
+
+def _dask_performance_report(filename: Path):
+    """A Dask performance_report, if there's a distributed client to report on"""
+    try:
+        from distributed import default_client, performance_report
+    except ImportError:
+        return None
+
+    try:
+        default_client()
+    except ValueError:
+        # No client, so everything runs in the local scheduler
+        return None
+    return performance_report(filename=str(filename))
+
+
+@contextmanager
+def profile_task(
+    task_id,
+    directory: Optional[str],
+    rate: float = 1.0,
+    profiler: str = "cprofile",
+):
+    """
+    Profile the enclosed block for a random ``rate`` fraction of tasks, writing
+    ``<task_id>.prof`` (or ``.html`` for pyinstrument) and, when a Dask client is
+    in use, ``<task_id>-dask-report.html`` to ``directory``.
+
+    Profiling is skipped entirely when ``directory`` is not set.
+    """
+    if not directory or random.random() >= rate:
+        yield
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            _LOG.warning("pyinstrument is not installed, falling back to cProfile")
+            profiler = "cprofile"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        artifacts = []
+        try:
+            with ExitStack() as stack:
+                dask_report = Path(temp_dir) / f"{task_id}-dask-report.html"
+                report = _dask_performance_report(dask_report)
+                if report is not None:
+                    stack.enter_context(report)
+                    artifacts.append(dask_report)
+
+                if profiler == "pyinstrument":
+                    # Callbacks run in reverse, so this stops and then writes
+                    sampler = Profiler()
+                    artifact = Path(temp_dir) / f"{task_id}.html"
+                    stack.callback(lambda: artifact.write_text(sampler.output_html()))
+                    stack.callback(sampler.stop)
+                    sampler.start()
+                else:
+                    cprofiler = cProfile.Profile()
+                    artifact = Path(temp_dir) / f"{task_id}.prof"
+                    stack.callback(cprofiler.dump_stats, artifact)
+                    stack.callback(cprofiler.disable)
+                    cprofiler.enable()
+                artifacts.append(artifact)
+
+                yield
+        finally:
+            # Keep profiles of failed tasks too, they're often the interesting ones
+            for path in artifacts:
+                if path.exists():
+                    location = _copy_artifact(path, directory)
+                    _LOG.info("Wrote profile", task=task_id, location=location)
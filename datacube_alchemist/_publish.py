@@ -0,0 +1,217 @@
+"""Publishing STAC documents to SNS, in batches and off the critical path
+- sns_attributes
+- SnsPublisher
+- publisher
+- flush
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import structlog
+from eodatasets3.scripts.tostac import json_fallback
+from toolz.dicttoolz import get_in
+
+_LOG = structlog.get_logger()
+
+# The most entries, and the most bytes of messages, that PublishBatch takes
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+def sns_attributes(stac: dict) -> dict:
+    """The SNS message attributes of a STAC document, for subscribers to filter on"""
+    bbox = stac["bbox"]
+    link_ref = next(
+        filter(lambda x: x.get("rel", "") == "self", get_in(["links"], stac, [])), {}
+    ).get("href", "")
+
+    product_name = get_in(["properties", "odc:product"], stac, None)
+    if product_name is None:
+        product_name = stac.get("collection")
+
+    if product_name is None:
+        raise ValueError("No 'odc:product_name' or 'collection' found in STAC doc")
+
+    attributes = {
+        "action": {"DataType": "String", "StringValue": "ADDED"},
+        "datetime": {
+            "DataType": "String",
+            "StringValue": str(get_in(["properties", "datetime"], stac)),
+        },
+        "product": {
+            "DataType": "String",
+            "StringValue": product_name,
+        },
+        "version": {
+            "DataType": "String",
+            "StringValue": str(get_in(["properties", "odc:dataset_version"], stac, "")),
+        },
+        "path": {
+            "DataType": "String",
+            "StringValue": link_ref,
+        },
+        "bbox.ll_lon": {"DataType": "Number", "StringValue": str(bbox[0])},
+        "bbox.ll_lat": {"DataType": "Number", "StringValue": str(bbox[1])},
+        "bbox.ur_lon": {"DataType": "Number", "StringValue": str(bbox[2])},
+        "bbox.ur_lat": {"DataType": "Number", "StringValue": str(bbox[3])},
+    }
+
+    maturity = get_in(["properties", "dea:dataset_maturity"], stac)
+
+    if maturity is not None:
+        attributes["maturity"] = {"DataType": "String", "StringValue": maturity}
+    return attributes
+
+
+def _entry_error(entry: dict) -> Exception:
+    # A failed entry is an AWS error like any other, so it's handled like one
+    from botocore.exceptions import ClientError
+
+    return ClientError(
+        {"Error": {"Code": entry.get("Code", ""), "Message": entry.get("Message", "")}},
+        "PublishBatch",
+    )
+
+
+class SnsPublisher:
+    """
+    Publishes STAC documents to an SNS topic from a background thread, with one
+    long-lived client.
+
+    Documents published while a batch is being sent wait for the next one, so a
+    single task's document goes straight away, and when tasks finish faster than
+    documents are sent, they go up to ten to a ``PublishBatch``. Entries that fail
+    are retried on their own, with backoff.
+
+    Each document has a future, which is its message ID once it's sent, or the
+    ``ClientError`` that stopped it, so a caller can tell which task's document
+    failed.
+    """
+
+    def __init__(self, sns_arn: str, max_attempts: int = 5, backoff: float = 0.5):
+        self.sns_arn = sns_arn
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._client = None
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+        self._draining: Optional[Future] = None
+        # Its thread finishes sending what's pending before the interpreter exits
+        self._sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sns")
+        self._count = 0
+
+    def _sns(self):
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("sns")
+        return self._client
+
+    def publish(self, stac: dict) -> Future:
+        """Queue a STAC document to be sent, returning its future without waiting"""
+        entry = {
+            "Message": json.dumps(stac, separators=(",", ":"), default=json_fallback),
+            "MessageAttributes": sns_attributes(stac),
+        }
+        future: Future = Future()
+        with self._lock:
+            self._count += 1
+            entry["Id"] = str(self._count)
+            self._pending.append((entry, future))
+            if self._draining is None:
+                self._draining = self._sender.submit(self._drain)
+        return future
+
+    def flush(self) -> None:
+        """Wait for every document published so far to be sent, or to fail"""
+        while True:
+            with self._lock:
+                draining = self._draining
+            if draining is None:
+                break
+            draining.result()
+
+    def _next_batch(self) -> list:
+        with self._lock:
+            if not self._pending:
+                # Anything published from now on needs another drain
+                self._draining = None
+                return []
+            batch, size = [], 0
+            while self._pending and len(batch) < MAX_BATCH_ENTRIES:
+                entry_size = len(self._pending[0][0]["Message"].encode())
+                if batch and size + entry_size > MAX_BATCH_BYTES:
+                    break
+                batch.append(self._pending.popleft())
+                size += entry_size
+            return batch
+
+    def _drain(self) -> None:
+        while batch := self._next_batch():
+            try:
+                self._send(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("SNS didn't report the message"))
+                if future.exception() is not None:
+                    _LOG.error(
+                        "Couldn't publish to SNS",
+                        sns_arn=self.sns_arn,
+                        error=str(future.exception()),
+                    )
+
+    def _send(self, batch: list) -> None:
+        futures = {entry["Id"]: future for entry, future in batch}
+        entries = [entry for entry, _ in batch]
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self._sns().publish_batch(
+                    TopicArn=self.sns_arn, PublishBatchRequestEntries=entries
+                )
+            except Exception:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                continue
+            for sent in response.get("Successful", []):
+                futures[sent["Id"]].set_result(sent.get("MessageId"))
+            failed = {failure["Id"]: failure for failure in response.get("Failed", [])}
+            retry = []
+            for entry in entries:
+                failure = failed.get(entry["Id"])
+                if failure is None:
+                    continue
+                # Faults of ours, like a bad attribute, would only fail again
+                if failure["SenderFault"] or attempt + 1 == self.max_attempts:
+                    futures[entry["Id"]].set_exception(_entry_error(failure))
+                else:
+                    retry.append(entry)
+            entries = retry
+            if not entries:
+                break
+
+
+_PUBLISHERS: dict[str, SnsPublisher] = {}
+
+
+def publisher(sns_arn: str) -> SnsPublisher:
+    """This process's publisher for a topic, which every Alchemist in it shares"""
+    if sns_arn not in _PUBLISHERS:
+        _PUBLISHERS[sns_arn] = SnsPublisher(sns_arn)
+    return _PUBLISHERS[sns_arn]
+
+
+def flush() -> None:
+    """Wait for everything this process has published to be sent, or to fail"""
+    for sns_publisher in _PUBLISHERS.values():
+        sns_publisher.flush()
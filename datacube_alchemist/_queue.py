@@ -0,0 +1,498 @@
+"""Work queues: AWS SQS, or a local SQLite database
+- lease_owner
+- get_queue
+- SqliteQueue
+- redrive
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import attr
+import structlog
+
+_LOG = structlog.get_logger()
+
+SQLITE_SCHEME = "sqlite://"
+
+# The most messages SQS receives, sends or deletes in one request
+MAX_BATCH = 10
+
+_SCHEMA = """
+create table if not exists queues (
+    name text primary key,
+    dead_letter text,
+    max_receives integer
+);
+create table if not exists messages (
+    id text primary key,
+    queue text not null,
+    body text not null,
+    group_id text,
+    sent real not null,
+    visible_at real not null,
+    receive_count integer not null default 0,
+    receipt text
+);
+create index if not exists messages_visible on messages (queue, visible_at, sent);
+create table if not exists leases (
+    key text primary key,
+    owner text not null,
+    expires real not null
+);
+"""
+
+
+def lease_owner() -> str:
+    """A name for this process, to tell whose a lease is"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def get_queue(queue: str):
+    """
+    An SQS queue resource by name, or a ``SqliteQueue`` for a URL like
+    ``sqlite:///path/to/queues.db?queue=name``
+    """
+    if queue.startswith(SQLITE_SCHEME):
+        return SqliteQueue.from_url(queue)
+
+    from odc.aws.queue import get_queue as get_sqs_queue
+
+    return get_sqs_queue(queue)
+
+
+class SqliteMessage:
+    """A received message, with the parts of the boto3 SQS Message API we use"""
+
+    def __init__(self, queue, message_id, body, receipt_handle, receive_count, group):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.attributes = {"ApproximateReceiveCount": str(receive_count)}
+        if group is not None:
+            self.attributes["MessageGroupId"] = group
+        self.message_attributes = None
+
+    def delete(self):
+        return self.queue.delete_messages(
+            Entries=[{"Id": self.message_id, "ReceiptHandle": self.receipt_handle}]
+        )
+
+    def change_visibility(self, VisibilityTimeout):  # noqa: N803
+        with self.queue._transaction() as db:  # noqa: SLF001
+            db.execute(
+                "update messages set visible_at = ? where id = ? and receipt = ?",
+                (time.time() + VisibilityTimeout, self.message_id, self.receipt_handle),
+            )
+
+
+class _DeadLetterSources:
+    def __init__(self, queue):
+        self._queue = queue
+
+    def all(self):
+        with self._queue._transaction() as db:  # noqa: SLF001
+            rows = db.execute(
+                "select name from queues where dead_letter = ?", (self._queue.name,)
+            ).fetchall()
+        return [SqliteQueue(self._queue.path, name) for (name,) in rows]
+
+
+class SqliteQueue:
+    """
+    A work queue in a SQLite database, with the parts of the boto3 SQS Queue API that
+    Alchemist uses: batched send, receive and delete, visibility timeouts, and
+    dead-lettering after ``max_receives`` receives. A batch of received messages is
+    filled from the same ``MessageGroupId`` as the oldest message where possible.
+    It also keeps leases, so that workers sharing the database don't run the same
+    task at once.
+
+    Every operation is its own short transaction, so any number of processes can
+    share a queue, but only on one machine: the database must be on a local
+    filesystem, as SQLite's locking isn't reliable on network filesystems, and
+    workers on other hosts could be given the same messages and leases.
+    """
+
+    def __init__(
+        self,
+        path,
+        name: str = "default",
+        dead_letter: Optional[str] = None,
+        max_receives: Optional[int] = None,
+    ):
+        self.path = Path(path)
+        self.name = name
+        self.owner = lease_owner()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # executescript commits as it goes, so it can't be part of a transaction
+        db = self._connect()
+        try:
+            db.executescript(_SCHEMA)
+        finally:
+            db.close()
+        with self._transaction() as db:
+            db.execute("insert or ignore into queues (name) values (?)", (name,))
+            if dead_letter is not None:
+                db.execute(
+                    "insert or ignore into queues (name) values (?)", (dead_letter,)
+                )
+                db.execute(
+                    "update queues set dead_letter = ?, max_receives = ? where name = ?",
+                    (dead_letter, max_receives or 1, name),
+                )
+
+    @classmethod
+    def from_url(cls, url: str) -> "SqliteQueue":
+        parsed = urlparse(url)
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        max_receives = params.get("max_receives")
+        return cls(
+            parsed.path,
+            name=params.get("queue", "default"),
+            dead_letter=params.get("dead_letter"),
+            max_receives=int(max_receives) if max_receives else None,
+        )
+
+    @property
+    def url(self) -> str:
+        return f"{SQLITE_SCHEME}{self.path}?queue={self.name}"
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connect()
+        try:
+            db.execute("begin immediate")
+            try:
+                yield db
+            except BaseException:
+                db.execute("rollback")
+                raise
+            db.execute("commit")
+        finally:
+            db.close()
+
+    @property
+    def attributes(self) -> dict:
+        now = time.time()
+        with self._transaction() as db:
+            visible, in_flight = db.execute(
+                "select count(*) filter (where visible_at <= ?),"
+                " count(*) filter (where visible_at > ?)"
+                " from messages where queue = ?",
+                (now, now, self.name),
+            ).fetchone()
+        # SQS returns these as strings too
+        return {
+            "ApproximateNumberOfMessages": str(visible),
+            "ApproximateNumberOfMessagesNotVisible": str(in_flight),
+        }
+
+    @property
+    def dead_letter_source_queues(self) -> _DeadLetterSources:
+        return _DeadLetterSources(self)
+
+    def send_messages(self, Entries):  # noqa: N803
+        now = time.time()
+        successful = []
+        with self._transaction() as db:
+            for entry in Entries:
+                message_id = str(uuid.uuid4())
+                db.execute(
+                    "insert into messages (id, queue, body, group_id, sent, visible_at)"
+                    " values (?, ?, ?, ?, ?, ?)",
+                    (
+                        message_id,
+                        self.name,
+                        entry["MessageBody"],
+                        entry.get("MessageGroupId"),
+                        now,
+                        now + entry.get("DelaySeconds", 0),
+                    ),
+                )
+                successful.append({"Id": entry["Id"], "MessageId": message_id})
+        return {"Successful": successful, "Failed": []}
+
+    def send_message(self, MessageBody, **kwargs):  # noqa: N803
+        response = self.send_messages(
+            Entries=[{"Id": "0", "MessageBody": MessageBody, **kwargs}]
+        )
+        return {
+            "MessageId": response["Successful"][0]["MessageId"],
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+        }
+
+    def _receive(self, count: int, visibility_timeout: float) -> list[SqliteMessage]:
+        now = time.time()
+        received = []
+        with self._transaction() as db:
+            dead_letter, max_receives = db.execute(
+                "select dead_letter, max_receives from queues where name = ?",
+                (self.name,),
+            ).fetchone()
+            oldest = db.execute(
+                "select group_id from messages where queue = ? and visible_at <= ?"
+                " order by sent, rowid limit 1",
+                (self.name, now),
+            ).fetchone()
+            # Fill the batch from the oldest message's group first, so that a
+            # worker gets a run of spatially adjacent scenes
+            rows = db.execute(
+                "select id, body, receive_count, group_id from messages"
+                " where queue = ? and visible_at <= ?"
+                " order by group_id is ? desc, sent, rowid limit ?",
+                (self.name, now, oldest[0] if oldest else None, count),
+            )
+            for message_id, body, receive_count, group in rows.fetchall():
+                if dead_letter and receive_count >= max_receives:
+                    # Received too many times without being deleted
+                    db.execute(
+                        "update messages set queue = ?, receive_count = 0,"
+                        " visible_at = ?, receipt = null where id = ?",
+                        (dead_letter, now, message_id),
+                    )
+                    continue
+                receipt = str(uuid.uuid4())
+                db.execute(
+                    "update messages set receive_count = ?, visible_at = ?,"
+                    " receipt = ? where id = ?",
+                    (receive_count + 1, now + visibility_timeout, receipt, message_id),
+                )
+                received.append(
+                    SqliteMessage(
+                        self, message_id, body, receipt, receive_count + 1, group
+                    )
+                )
+        return received
+
+    def receive_messages(
+        self,
+        MaxNumberOfMessages=1,  # noqa: N803
+        VisibilityTimeout=30,  # noqa: N803
+        WaitTimeSeconds=0,  # noqa: N803
+        **kwargs,
+    ) -> list[SqliteMessage]:
+        deadline = time.monotonic() + WaitTimeSeconds
+        while True:
+            messages = self._receive(MaxNumberOfMessages, VisibilityTimeout)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(min(0.2, WaitTimeSeconds))
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        """
+        Take the lease on ``key`` for ``ttl`` seconds, unless another owner holds
+        it. Any queue in the database shares its leases.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            # A lease that's expired was left by a worker that died
+            db.execute("delete from leases where key = ? and expires <= ?", (key, now))
+            taken = db.execute(
+                "insert or ignore into leases (key, owner, expires) values (?, ?, ?)",
+                (key, self.owner, now + ttl),
+            ).rowcount
+        return taken == 1
+
+    def release_lease(self, key: str) -> None:
+        """Give up the lease on ``key``, if this queue holds it"""
+        with self._transaction() as db:
+            db.execute(
+                "delete from leases where key = ? and owner = ?", (key, self.owner)
+            )
+
+    def delete_messages(self, Entries):  # noqa: N803
+        with self._transaction() as db:
+            db.executemany(
+                "delete from messages where id = ? and receipt = ?",
+                [(entry["Id"], entry["ReceiptHandle"]) for entry in Entries],
+            )
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+@attr.s(auto_attribs=True)
+class RedriveStats:
+    """What a redrive did, and how fast"""
+
+    sent: int = 0
+    duplicates: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Messages moved, sent or dropped as duplicates, per second"""
+        moved = self.sent + self.duplicates
+        return moved / self.seconds if self.seconds else 0.0
+
+
+def _dedupe_key(body: str) -> str:
+    # The dataset ID, or IDs of a group, that a message is a task for, whether it's
+    # a message of ours, a STAC item, or either wrapped in an SNS notification
+    try:
+        doc = json.loads(body)
+        if "id" not in doc and "Message" in doc:
+            doc = json.loads(doc["Message"])
+        return json.dumps([doc.get("transform"), doc.get("group") or doc["id"]])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return body
+
+
+class _Redrive:
+    # The state shared by the threads of a redrive
+    def __init__(self, dead_queue, alive_queue, limit, dedupe, visibility_timeout):
+        self.dead_queue = dead_queue
+        self.alive_queue = alive_queue
+        self.limit = limit
+        self.visibility_timeout = visibility_timeout
+        self.fifo = alive_queue.url.endswith(".fifo")
+        # Only FIFO and local queues keep messages in groups
+        self.grouped = self.fifo or alive_queue.url.startswith(SQLITE_SCHEME)
+        self.seen: Optional[set] = set() if dedupe else None
+        self.stats = RedriveStats()
+        self.stopped = False
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> int:
+        # How many messages a thread may take next, so threads stop at the limit
+        with self._lock:
+            if self.stopped:
+                return 0
+            count = MAX_BATCH
+            if self.limit is not None:
+                count = min(count, self.limit - self._reserved)
+            self._reserved += count
+            return count
+
+    def _unreserve(self, count: int) -> None:
+        with self._lock:
+            self._reserved -= count
+
+    def _entry(self, message) -> dict:
+        entry = {"Id": message.message_id, "MessageBody": message.body}
+        if message.message_attributes:
+            entry["MessageAttributes"] = message.message_attributes
+        group = (message.attributes or {}).get("MessageGroupId")
+        if self.grouped and group is not None:
+            entry["MessageGroupId"] = group
+        if self.fifo:
+            entry.setdefault("MessageGroupId", "redrive")
+            entry["MessageDeduplicationId"] = hashlib.sha256(
+                message.body.encode()
+            ).hexdigest()
+        return entry
+
+    def _duplicates(self, messages: list) -> tuple[list, list]:
+        if self.seen is None:
+            return messages, []
+        unique, duplicates = [], []
+        with self._lock:
+            for message in messages:
+                key = _dedupe_key(message.body)
+                if key in self.seen:
+                    duplicates.append(message)
+                else:
+                    self.seen.add(key)
+                    unique.append(message)
+        return unique, duplicates
+
+    def _delete(self, messages: list) -> None:
+        if not messages:
+            return
+        response = self.dead_queue.delete_messages(
+            Entries=[
+                {"Id": m.message_id, "ReceiptHandle": m.receipt_handle}
+                for m in messages
+            ]
+        )
+        for failure in response.get("Failed", []):
+            # It will be received again once its visibility timeout passes
+            _LOG.warning("Couldn't delete redriven message", failure=failure)
+
+    def run(self) -> None:
+        while count := self._reserve():
+            messages = self.dead_queue.receive_messages(
+                MaxNumberOfMessages=count,
+                VisibilityTimeout=self.visibility_timeout,
+                WaitTimeSeconds=1,
+                AttributeNames=["MessageGroupId"],
+                MessageAttributeNames=["All"],
+            )
+            self._unreserve(count - len(messages))
+            if not messages:
+                return
+            unique, duplicates = self._duplicates(messages)
+            sent = []
+            if unique:
+                response = self.alive_queue.send_messages(
+                    Entries=[self._entry(message) for message in unique]
+                )
+                successful = {entry["Id"] for entry in response.get("Successful", [])}
+                sent = [m for m in unique if m.message_id in successful]
+                for failure in response.get("Failed", []):
+                    _LOG.error("Couldn't redrive message", failure=failure)
+            # Only what's been sent, or isn't needed, leaves the dead letter queue
+            self._delete(sent + duplicates)
+            with self._lock:
+                self.stats.sent += len(sent)
+                self.stats.duplicates += len(duplicates)
+                self.stats.failed += len(unique) - len(sent)
+
+
+def redrive(
+    dead_queue,
+    alive_queue,
+    limit: Optional[int] = None,
+    threads: int = 1,
+    dedupe: bool = False,
+    visibility_timeout: int = 600,
+    report_every: float = 10.0,
+) -> RedriveStats:
+    """
+    Move the messages of ``dead_queue`` to ``alive_queue``, returning how many were
+    sent, dropped as duplicates or failed, and how long it took.
+
+    Each of ``threads`` threads receives, sends and deletes ten messages at a time,
+    so a redrive costs a tenth of the requests of one message at a time, and runs
+    that many at once. A message is only deleted once it has been sent: any that
+    fail stay in ``dead_queue``, and are received again when ``visibility_timeout``
+    passes. With ``dedupe``, only the first message for each dataset ID (or group
+    of them) is sent, and the rest are deleted.
+
+    Progress is logged every ``report_every`` seconds.
+    """
+    state = _Redrive(dead_queue, alive_queue, limit, dedupe, visibility_timeout)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads, thread_name_prefix="redrive") as pool:
+        running = {pool.submit(state.run) for _ in range(threads)}
+        while running:
+            done, running = wait(running, timeout=report_every)
+            for future in done:
+                if future.exception() is not None:
+                    # The other threads stop after their current batch
+                    state.stopped = True
+                    raise future.exception()
+            state.stats.seconds = time.perf_counter() - start
+            if running:
+                _LOG.info(
+                    "Redriving",
+                    rate=round(state.stats.rate, 1),
+                    **attr.asdict(state.stats),
+                )
+    state.stats.seconds = time.perf_counter() - start
+    return state.stats
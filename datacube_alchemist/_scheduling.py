@@ -0,0 +1,102 @@
+"""Splitting and ordering datasets for processing
+- parse_shard
+- shard_datasets
+- order_datasets
+- group_datasets
+"""
+
+import calendar
+import hashlib
+from collections.abc import Iterable, Iterator
+
+from datacube.model import Dataset
+
+from datacube_alchemist._utils import _guess_region_code
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a shard spec like ``3/16`` into ``(3, 16)``, counting from zero"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard should look like i/N, not {value!r}") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index should be from 0 to {count - 1}, not {index}")
+    return index, count
+
+
+def region_code(dataset: Dataset) -> str:
+    """The dataset's region code, or its ID if it doesn't have one"""
+    try:
+        code = _guess_region_code(dataset)
+    except (KeyError, ValueError):
+        code = None
+    # eo3 datasets without odc:region_code have a None one, which mustn't put all
+    # of them in the same shard and message group
+    return str(dataset.id) if code is None else str(code)
+
+
+def _stable_hash(key: str) -> int:
+    # Python's hash() is salted per process, so it can't be shared between jobs
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def shard_datasets(
+    datasets: Iterable[Dataset], index: int, count: int, by: str = "id"
+) -> Iterator[Dataset]:
+    """
+    The datasets that belong to shard ``index`` of ``count``. Every job that sees the
+    same datasets agrees on the split, so the shards are disjoint and cover them all.
+
+    Sharding ``by="region"`` keeps all the scenes of a tile in the same shard.
+    """
+    key = region_code if by == "region" else (lambda dataset: str(dataset.id))
+    for dataset in datasets:
+        if _stable_hash(key(dataset)) % count == index:
+            yield dataset
+
+
+def order_datasets(datasets: Iterable[Dataset], by: str = "region") -> list[Dataset]:
+    """
+    The datasets sorted by region code and then time, so that consecutive tasks read
+    the same ancillary tiles and find them in warm caches.
+
+    This has to see every dataset before it can return the first.
+    """
+    if by != "region":
+        return list(datasets)
+    return sorted(
+        datasets,
+        key=lambda dataset: (
+            region_code(dataset),
+            str(dataset.center_time),
+            str(dataset.id),
+        ),
+    )
+
+
+def _window(dataset: Dataset, window_days: float) -> int:
+    # Naive times are UTC, as they are in the index
+    seconds = calendar.timegm(dataset.center_time.utctimetuple())
+    return int(seconds // (window_days * 24 * 60 * 60))
+
+
+def group_datasets(
+    datasets: Iterable[Dataset], window_days: float
+) -> list[list[Dataset]]:
+    """
+    The datasets grouped by region code and by which window of ``window_days``
+    their time falls in, counting from 1970-01-01 so that every job that sees the
+    same datasets groups them the same way. Each group is in time order, and the
+    groups are in the order of their first datasets.
+
+    This has to see every dataset before it can return the first group.
+    """
+    groups: dict[tuple[str, int], list[Dataset]] = {}
+    for dataset in datasets:
+        key = (region_code(dataset), _window(dataset, window_days))
+        groups.setdefault(key, []).append(dataset)
+    return [
+        sorted(group, key=lambda dataset: (dataset.center_time, str(dataset.id)))
+        for group in groups.values()
+    ]
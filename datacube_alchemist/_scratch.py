@@ -0,0 +1,99 @@
+"""Disk space admission control for scratch storage
+- reserve_space
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+# Reservations live in the scratch directory itself, so every worker process on a
+# node that shares the scratch directory sees them. They're named for the host and
+# PID that made them, as on a shared filesystem other nodes' PIDs mean nothing here.
+_RESERVATIONS = ".alchemist-reservations"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _reserved_bytes(reservations: Path) -> int:
+    reserved = 0
+    host = socket.gethostname()
+    for path in reservations.glob("*.reservation"):
+        owner, _, rest = path.name.rpartition("@")
+        pid = int(rest.split("-", 1)[0])
+        if owner == host and not _pid_alive(pid):
+            # Left behind by a worker that was killed
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            reserved += int(path.read_text())
+        except (OSError, ValueError):
+            continue
+    return reserved
+
+
+@contextmanager
+def reserve_space(directory: Path, nbytes: int, timeout: float, poll: float = 5.0):
+    """
+    Wait until ``directory`` has ``nbytes`` free that no other worker has reserved,
+    then hold that reservation for the enclosed block.
+
+    Raises an ``ENOSPC`` ``OSError`` if the space doesn't become available within
+    ``timeout`` seconds, before any work has been wasted on the task.
+    """
+    reservations = Path(directory) / _RESERVATIONS
+    reservations.mkdir(parents=True, exist_ok=True)
+    lock_path = reservations / ".lock"
+    reservation = (
+        reservations
+        / f"{socket.gethostname()}@{os.getpid()}-{uuid.uuid4().hex}.reservation"
+    )
+
+    deadline = time.monotonic() + timeout
+    waited = False
+    while True:
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            available = shutil.disk_usage(directory).free - _reserved_bytes(
+                reservations
+            )
+            if available >= nbytes:
+                reservation.write_text(str(nbytes))
+                break
+        if time.monotonic() >= deadline:
+            raise OSError(
+                errno.ENOSPC,
+                f"Needed {nbytes} bytes of scratch but only {available} are available",
+                str(directory),
+            )
+        if not waited:
+            _LOG.info(
+                "Waiting for scratch space",
+                directory=str(directory),
+                needed=nbytes,
+                available=available,
+            )
+            waited = True
+        time.sleep(poll)
+
+    try:
+        yield
+    finally:
+        reservation.unlink(missing_ok=True)
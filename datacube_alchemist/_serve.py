@@ -0,0 +1,154 @@
+"""A long-lived worker that takes tasks over a local socket
+- AlchemistServer
+- serve
+- submit
+"""
+
+import errno
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+from collections.abc import Sequence
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+
+import structlog
+
+_LOG = structlog.get_logger()
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    # Only a socket left behind by a server that died is removed: anything else at
+    # the path, including the socket of a server that's still running, is an error
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket", socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise OSError(errno.EADDRINUSE, "A server is already listening", socket_path)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One JSON document per line in, one JSON result per line out
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            result = self.server.run(line)
+            self.wfile.write(json.dumps(result).encode() + b"\n")
+            self.wfile.flush()
+
+
+class AlchemistServer(socketserver.UnixStreamServer):
+    """
+    Runs each task sent to a unix socket with a warm Alchemist, whose index
+    connection, products, transform and caches outlive the tasks.
+
+    Each line sent is what a queue message would hold: a dataset ID as
+    ``{"id": ...}``, a group as ``{"group": [...]}``, or a STAC item. Each gets a
+    line back, either ``{"ok": true, "outputs": [[id, metadata_path], ...]}`` or
+    ``{"ok": false, "error": ...}``. Tasks are run one at a time, in the order they
+    arrive, as the compute is what they're waiting for.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        executor,
+        alchemist,
+        dryrun: bool = False,
+        sns_arn: Optional[str] = None,
+    ):
+        # A socket left behind by a server that died would refuse the bind
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.socket_path = socket_path
+        self.executor = executor
+        self.alchemist = alchemist
+        self.dryrun = dryrun
+        self.sns_arn = sns_arn
+
+    def run(self, line: bytes) -> dict:
+        """Run the task a line describes, returning its outputs or its error"""
+        start = time.perf_counter()
+        try:
+            task = self.alchemist.generate_task_from_message(json.loads(line))
+            if task is None:
+                return {"ok": False, "error": "No task for the message"}
+            result = self.executor.execute_task(task, self.dryrun, self.sns_arn)
+            # A task isn't done until its STAC has been sent
+            for future in task.published:
+                future.result()
+        except Exception as e:
+            _LOG.exception("Task failed", error=str(e))
+            return {"ok": False, "error": str(e)}
+        # A group of configs has a result for each of them
+        outputs = result if isinstance(result, list) else [result]
+        return {
+            "ok": True,
+            "outputs": [[str(id_), str(path)] for id_, path in outputs],
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+    def server_close(self):
+        super().server_close()
+        with suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+
+def serve(
+    socket_path: str,
+    executor,
+    alchemists: Sequence,
+    dryrun: bool = False,
+    sns_arn: Optional[str] = None,
+) -> None:
+    """
+    Warm up the Alchemists and run the tasks sent to ``socket_path`` until
+    interrupted or terminated, with the first of them finding each task's datasets.
+    Outputs still being published when it stops are sent before returning.
+    """
+    for alchemist in alchemists:
+        alchemist.warm_up()
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        # Stop on SIGTERM, as from Kubernetes or systemd, just as on an interrupt
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        with AlchemistServer(
+            socket_path, executor, alchemists[0], dryrun=dryrun, sns_arn=sns_arn
+        ) as server:
+            _LOG.info("Serving", socket=socket_path)
+            with suppress(KeyboardInterrupt):
+                server.serve_forever()
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+    if sns_arn:
+        from datacube_alchemist._publish import flush
+
+        flush()
+
+
+def submit(socket_path: str, message: dict, timeout: Optional[float] = None) -> dict:
+    """Send a task to a server and wait for its result"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(Path(socket_path)))
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(message).encode() + b"\n")
+            stream.flush()
+            return json.loads(stream.readline())
@@ -0,0 +1,259 @@
+"""Per-band statistics and valid-data footprints, summarised block by block
+- BandSummary
+- summarise
+- footprint
+- raster_band
+"""
+
+import math
+from typing import Any, Optional, Union
+
+import attr
+import dask
+import numpy as np
+import shapely
+import shapely.affinity
+import xarray as xr
+from eodatasets3.images import GridSpec
+from shapely.geometry import CAP_STYLE, JOIN_STYLE, box
+from shapely.geometry.base import BaseGeometry
+
+# Integer types narrow enough to count every value, so histograms are exact
+_COUNTABLE = ("uint8", "int8", "uint16", "int16")
+
+HISTOGRAM_BUCKETS = 256
+
+
+@attr.s(auto_attribs=True)
+class BandSummary:
+    """
+    The valid pixels of a band: their statistics, if they were asked for, and the
+    first and last valid column of each row, for the footprint.
+    """
+
+    shape: tuple[int, int]
+    # Per row, the first valid column (or the width if there are none) and the last
+    first: np.ndarray
+    last: np.ndarray
+    count: int = 0
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+    total: float = 0.0
+    total_squares: float = 0.0
+    # For countable types, how many pixels have each value from the dtype's minimum
+    values: Optional[np.ndarray] = None
+
+    @property
+    def mean(self) -> Optional[float]:
+        return float(self.total / self.count) if self.count else None
+
+    @property
+    def stddev(self) -> Optional[float]:
+        if not self.count:
+            return None
+        return math.sqrt(max(self.total_squares / self.count - self.mean**2, 0.0))
+
+
+def _valid_pixels(block: np.ndarray, nodata) -> np.ndarray:
+    # The same as eodatasets3 uses for its valid-data geometry
+    if nodata is None:
+        nodata = float("nan") if np.issubdtype(block.dtype, np.floating) else 0
+    if math.isnan(nodata):
+        return np.isfinite(block)
+    return block != nodata
+
+
+def _summarise_block(
+    block: np.ndarray, nodata, offset: tuple[int, int], statistics: bool
+) -> tuple:
+    valid = _valid_pixels(block, nodata)
+    width = valid.shape[1]
+    any_valid = valid.any(axis=1)
+    first = np.where(
+        any_valid, valid.argmax(axis=1) + offset[1], np.iinfo(np.int64).max
+    )
+    last = np.where(
+        any_valid, width - 1 - valid[:, ::-1].argmax(axis=1) + offset[1], -1
+    )
+    if not statistics:
+        return offset, first, last, None
+
+    values = block[valid]
+    stats = {"count": values.size}
+    if values.size:
+        as_float = values.astype(np.float64)
+        stats.update(
+            minimum=values.min(),
+            maximum=values.max(),
+            total=as_float.sum(),
+            total_squares=np.dot(as_float, as_float),
+        )
+    if block.dtype.name in _COUNTABLE:
+        info = np.iinfo(block.dtype)
+        stats["values"] = np.bincount(
+            (values.astype(np.int64) - info.min), minlength=info.max - info.min + 1
+        )
+    return offset, first, last, stats
+
+
+def _merge(shape: tuple[int, int], partials) -> BandSummary:
+    summary = BandSummary(
+        shape=shape,
+        first=np.full(shape[0], shape[1], dtype=np.int64),
+        last=np.full(shape[0], -1, dtype=np.int64),
+    )
+    for (row, _), first, last, stats in partials:
+        rows = slice(row, row + len(first))
+        np.minimum(summary.first[rows], first, out=summary.first[rows])
+        np.maximum(summary.last[rows], last, out=summary.last[rows])
+        if stats is None or not stats["count"]:
+            continue
+        summary.count += stats["count"]
+        summary.total += stats["total"]
+        summary.total_squares += stats["total_squares"]
+        summary.minimum = (
+            stats["minimum"]
+            if summary.minimum is None
+            else min(summary.minimum, stats["minimum"])
+        )
+        summary.maximum = (
+            stats["maximum"]
+            if summary.maximum is None
+            else max(summary.maximum, stats["maximum"])
+        )
+        if "values" in stats:
+            summary.values = (
+                stats["values"]
+                if summary.values is None
+                else summary.values + stats["values"]
+            )
+    return summary
+
+
+def summarise(
+    output_data: xr.Dataset, nodata=None, statistics: bool = False
+) -> dict[str, Union[BandSummary, Any]]:
+    """
+    Summarise each band of the (possibly lazy) output: the valid pixels of each row
+    and, if ``statistics``, their counts, range, moments and histogram.
+
+    Bands backed by dask are summarised block by block as delayed tasks on the
+    band's own blocks, so computing them along with the output shares its blocks
+    rather than being another pass over the data.
+
+    Only 2D bands can be summarised, so there are no summaries if any aren't.
+    """
+    if any(dataarray.ndim != 2 for dataarray in output_data.data_vars.values()):
+        return {}
+
+    summaries = {}
+    for name, dataarray in output_data.data_vars.items():
+        band_nodata = dataarray.attrs.get("nodata") if nodata is None else nodata
+        data = dataarray.data
+        shape = data.shape
+        if not dask.is_dask_collection(data):
+            block = np.asarray(data)
+            summaries[name] = _merge(
+                shape, [_summarise_block(block, band_nodata, (0, 0), statistics)]
+            )
+            continue
+
+        row_offsets = np.cumsum((0, *data.chunks[0][:-1]))
+        col_offsets = np.cumsum((0, *data.chunks[1][:-1]))
+        blocks = data.to_delayed()
+        partials = [
+            dask.delayed(_summarise_block)(
+                blocks[i, j],
+                band_nodata,
+                (int(row_offsets[i]), int(col_offsets[j])),
+                statistics,
+            )
+            for i in range(blocks.shape[0])
+            for j in range(blocks.shape[1])
+        ]
+        summaries[name] = dask.delayed(_merge)(shape, partials)
+    return summaries
+
+
+def footprint(summaries, grid: GridSpec) -> BaseGeometry:
+    """
+    The valid-data geometry of the summarised bands, as eodatasets3's ``thorough``
+    method would make it: the convex hull of every valid pixel, buffered and
+    simplified by a pixel. As it's only the convex hull, the first and last valid
+    pixel of each row are enough, rather than polygonising all of them.
+
+    Without any valid pixels it's the grid's bounds, as a dataset needs a geometry
+    for its STAC item.
+    """
+    summaries = list(summaries)
+    first = np.minimum.reduce([s.first for s in summaries])
+    last = np.maximum.reduce([s.last for s in summaries])
+    rows = np.flatnonzero(first <= last)
+    height, width = summaries[0].shape
+    bounds = box(0, 0, width, height)
+    if rows.size:
+        # The corners of the first and last pixels of each row
+        left, right = first[rows], last[rows] + 1
+        corners = np.concatenate(
+            [
+                np.column_stack([left, rows]),
+                np.column_stack([left, rows + 1]),
+                np.column_stack([right, rows]),
+                np.column_stack([right, rows + 1]),
+            ]
+        )
+        geom = shapely.multipoints(corners).convex_hull
+        geom = geom.buffer(1, cap_style=CAP_STYLE.square, join_style=JOIN_STYLE.bevel)
+        geom = geom.simplify(1).intersection(bounds)
+    else:
+        geom = bounds
+    transform = grid.transform
+    return shapely.affinity.affine_transform(
+        geom,
+        (
+            transform.a,
+            transform.b,
+            transform.d,
+            transform.e,
+            transform.xoff,
+            transform.yoff,
+        ),
+    )
+
+
+def raster_band(summary: BandSummary, dtype, nodata=None) -> dict:
+    """
+    The STAC ``raster:bands`` entry of a summarised band, with a histogram for the
+    integer types that are narrow enough to count
+    """
+    dtype = np.dtype(dtype)
+    band = {"data_type": dtype.name}
+    if nodata is not None:
+        band["nodata"] = "nan" if math.isnan(nodata) else nodata
+    pixels = summary.shape[0] * summary.shape[1]
+    statistics = {"valid_percent": 100 * summary.count / pixels if pixels else 0.0}
+    if summary.count:
+        statistics.update(
+            minimum=summary.minimum.item(),
+            maximum=summary.maximum.item(),
+            mean=summary.mean,
+            stddev=summary.stddev,
+        )
+    band["statistics"] = statistics
+
+    if summary.values is not None and summary.count:
+        offset = np.iinfo(dtype).min
+        present = np.flatnonzero(summary.values)
+        buckets, _ = np.histogram(
+            present + offset,
+            bins=HISTOGRAM_BUCKETS,
+            range=(summary.minimum.item(), summary.maximum.item()),
+            weights=summary.values[present],
+        )
+        band["histogram"] = {
+            "count": HISTOGRAM_BUCKETS,
+            "min": summary.minimum.item(),
+            "max": summary.maximum.item(),
+            "buckets": buckets.astype(int).tolist(),
+        }
+    return band
@@ -0,0 +1,205 @@
+"""Thumbnails rendered from computed arrays rather than from the written files
+- colourise
+- write_thumbnail
+- write_thumbnail_singleband
+"""
+
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import rasterio
+from affine import Affine
+from eodatasets3.images import GridSpec, rescale_intensity
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.warp import calculate_default_transform, reproject
+
+from datacube_alchemist._assemble import write_hashed
+from datacube_alchemist._cog import _is_valid, overview_levels
+
+
+def colourise(
+    array: np.ndarray, lookup_table: Mapping[int, Sequence[int]]
+) -> list[np.ndarray]:
+    """
+    Colour a classified array with a ``{value: (r, g, b)}`` lookup table, returning
+    red, green and blue uint8 arrays. Values not in the table are black.
+    """
+    lookup_table = {int(value): colour for value, colour in lookup_table.items()}
+    values = np.array(sorted(lookup_table))
+    colours = np.array([lookup_table[value] for value in values], dtype=np.uint8)
+    position = np.searchsorted(values, array).clip(0, len(values) - 1)
+    rgb = np.where((values[position] == array)[..., None], colours[position], 0)
+    return [rgb[..., band].astype(np.uint8) for band in range(3)]
+
+
+def _reduction(scale_factor: int) -> int:
+    # The largest power of two overview that's no smaller than the thumbnail
+    factor = 1
+    while factor * 2 <= scale_factor:
+        factor *= 2
+    return factor
+
+
+def _stretch_range(bands, valid, percentile_stretch) -> tuple:
+    # Like eodatasets3, the narrowest of the bands' percentile ranges
+    low, high = -np.inf, np.inf
+    for band in bands:
+        data = band[valid]
+        if data.any():
+            band_low, band_high = np.percentile(
+                data, percentile_stretch, method="nearest"
+            )
+            low, high = max(low, band_low), min(high, band_high)
+    # Anything will do when there's nothing valid to stretch, as it's all nodata
+    return (low, high) if np.isfinite([low, high]).all() else (0, 1)
+
+
+def _write_jpeg(
+    path: Path,
+    bands: Sequence[np.ndarray],
+    valid: np.ndarray,
+    grid: GridSpec,
+    in_range: tuple,
+    resampling: Resampling,
+    scale_factor: int,
+    compress_quality: int,
+) -> str:
+    # The bands may be reduced from the full resolution grid, but the thumbnail
+    # grid is worked out from that grid, just as eodatasets3 does
+    height, width = bands[0].shape
+    source_transform = grid.transform * Affine.scale(
+        grid.shape[1] / width, grid.shape[0] / height
+    )
+    wgs84 = CRS.from_epsg(4326)
+    transform, full_width, full_height = calculate_default_transform(
+        grid.crs, wgs84, grid.shape[1], grid.shape[0], *grid.bounds
+    )
+    full_grid = GridSpec((full_height, full_width), transform, crs=wgs84)
+    thumb_transform, thumb_width, thumb_height = calculate_default_transform(
+        wgs84,
+        wgs84,
+        full_width,
+        full_height,
+        *full_grid.bounds,
+        dst_width=full_width // scale_factor,
+        dst_height=full_height // scale_factor,
+    )
+
+    with (
+        rasterio.Env(GDAL_PAM_ENABLED=False),
+        MemoryFile() as memory_file,
+    ):
+        with memory_file.open(
+            driver="JPEG",
+            quality=compress_quality,
+            height=thumb_height,
+            width=thumb_width,
+            count=3,
+            dtype="uint8",
+            nodata=0,
+            transform=thumb_transform,
+            crs=wgs84,
+        ) as thumbnail:
+            for index, band in enumerate(bands, start=1):
+                thumb = np.zeros((thumb_height, thumb_width), dtype=np.uint8)
+                reproject(
+                    rescale_intensity(
+                        band,
+                        in_range=in_range,
+                        out_range=(1, 255),
+                        image_null_mask=~valid,
+                    ),
+                    thumb,
+                    src_crs=grid.crs,
+                    src_transform=source_transform,
+                    src_nodata=0,
+                    dst_crs=wgs84,
+                    dst_transform=thumb_transform,
+                    dst_nodata=0,
+                    resampling=resampling,
+                )
+                thumbnail.write(thumb, index)
+        return write_hashed(path, memory_file.getbuffer())
+
+
+def write_thumbnail(
+    path: Path,
+    bands: Sequence[np.ndarray],
+    grid: GridSpec,
+    nodata=None,
+    resampling: Resampling = Resampling.average,
+    static_stretch: Optional[tuple] = None,
+    percentile_stretch: tuple = (2, 98),
+    scale_factor: int = 10,
+    compress_quality: int = 85,
+) -> str:
+    """
+    Write a JPEG thumbnail of three 2D arrays as red, green and blue, like
+    ``DatasetAssembler.write_thumbnail``: stretched to 1-255 with nodata as 0,
+    reprojected to WGS84 and ``scale_factor`` times smaller.
+
+    The arrays are first averaged in memory to the nearest power of two overview,
+    so only that is stretched and reprojected.
+
+    :returns: the SHA1 of the written file
+    """
+    factor = _reduction(scale_factor)
+    if factor > 1:
+        bands = [
+            overview_levels(band, (factor,), Resampling.average, nodata)[0]
+            for band in bands
+        ]
+    valid = np.logical_and.reduce([_is_valid(band, nodata) for band in bands])
+    in_range = static_stretch or _stretch_range(bands, valid, percentile_stretch)
+    return _write_jpeg(
+        path, bands, valid, grid, in_range, resampling, scale_factor, compress_quality
+    )
+
+
+def write_thumbnail_singleband(
+    path: Path,
+    array: np.ndarray,
+    grid: GridSpec,
+    nodata=None,
+    bit: Optional[int] = None,
+    lookup_table: Optional[Mapping[int, Sequence[int]]] = None,
+    scale_factor: int = 10,
+    compress_quality: int = 85,
+) -> str:
+    """
+    Write a JPEG thumbnail of a classified 2D array, like
+    ``DatasetAssembler.write_thumbnail_singleband``: either pixels equal to ``bit``
+    are white and the rest black, or each class is coloured by ``lookup_table``.
+
+    The classes are reduced to the nearest power of two overview by their mode
+    before they're coloured, so the colouring only sees that.
+
+    :returns: the SHA1 of the written file
+    """
+    if (bit is None) == (lookup_table is None):
+        raise ValueError("Please set one of bit or lookup_table")
+
+    factor = _reduction(scale_factor)
+    if factor > 1:
+        array = overview_levels(array, (factor,), Resampling.mode, nodata)[0]
+    valid = _is_valid(array, nodata)
+    if bit is not None:
+        bands = [np.where(array == bit, bit, 0)] * 3
+        in_range = (0, bit)
+    else:
+        bands = colourise(array, lookup_table)
+        in_range = (0, 255)
+    return _write_jpeg(
+        path,
+        bands,
+        valid,
+        grid,
+        in_range,
+        Resampling.average,
+        scale_factor,
+        compress_quality,
+    )
@@ -1,18 +1,20 @@
-import json
+import errno
 import re
+import shutil
+import uuid
 from pathlib import Path
+from typing import Optional
 
-import boto3
-import structlog
+import numpy as np
 from datacube.model import Dataset
 from datacube.virtual import Measurement, Transformation
-from eodatasets3 import DatasetAssembler, serialise
+from eodatasets3 import DatasetAssembler
+from eodatasets3.images import GridSpec
 from eodatasets3.model import DatasetDoc, ProductDoc
 from eodatasets3.properties import StacPropertyView
-from eodatasets3.scripts.tostac import dc_to_stac, json_fallback
-from eodatasets3.verify import PackageChecksum
-from toolz.dicttoolz import get_in
 
+from datacube_alchemist._publish import publisher
+from datacube_alchemist._thumbnail import write_thumbnail, write_thumbnail_singleband
 from datacube_alchemist.settings import AlchemistTask
 
 # Regex for extracting region codes from tile IDs.
@@ -31,118 +33,92 @@ class FakeTransformation(Transformation):
         return data
 
 
-def _configure_logger():
-    processors = [
-        structlog.stdlib.add_log_level,
-        structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S"),
-        structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
-        structlog.dev.ConsoleRenderer(),
-    ]
-
-    structlog.configure(
-        processors=processors,
-        context_class=dict,
-        cache_logger_on_first_use=True,
-        logger_factory=structlog.PrintLoggerFactory(),
+def _thumbnail_path(
+    task: AlchemistTask, dataset_assembler: DatasetAssembler
+) -> Optional[tuple[Path, Optional[str]]]:
+    """The path and kind of the configured thumbnail, or None if there isn't one"""
+    output = task.settings.output
+    settings = output.preview_image or output.preview_image_singleband
+    if settings is None:
+        return None
+    kind = settings.get("kind")
+    path = dataset_assembler._work_path / (  # noqa: SLF001
+        settings.get("path") or dataset_assembler.names.thumbnail_filename(kind=kind)
     )
+    return path, kind
 
 
-def _write_thumbnail(task: AlchemistTask, dataset_assembler: DatasetAssembler):
-    if task.settings.output.preview_image is not None:
-        dataset_assembler.write_thumbnail(**task.settings.output.preview_image)
-    elif task.settings.output.preview_image_singleband is not None:
-        dataset_assembler.write_thumbnail_singleband(
-            **task.settings.output.preview_image_singleband
-        )
+def _write_thumbnail(task: AlchemistTask, path: Path, output_data) -> str:
+    """
+    Render the configured thumbnail from the computed output, rather than from the
+    written measurements, so that it can be done while they're being written.
 
+    :returns: the SHA1 of the thumbnail
+    """
+    output = task.settings.output
+    grid = GridSpec.from_odc_xarray(output_data)
 
-def _write_stac(
-    metadata_path: Path,
-    destination_path: str,
-    explorer_url: str,
-    dataset_assembler: DatasetAssembler,
-):
-    out_dataset = serialise.from_path(metadata_path)
-    stac_path = Path(str(metadata_path).replace("odc-metadata.yaml", "stac-item.json"))
-
-    # Make sure destination path has a / at the end. Clumsy, but necessary.
-    stac = dc_to_stac(
-        out_dataset,
-        metadata_path,
-        stac_path,
-        destination_path.rstrip("/") + "/",
-        explorer_url,
-        False,
-    )
+    def band(name):
+        dataarray = output_data[name]
+        nodata = (
+            dataarray.attrs.get("nodata") if output.nodata is None else output.nodata
+        )
+        array = np.asarray(dataarray.data)
+        return (array.astype("uint8") if array.dtype == bool else array), nodata
+
+    if output.preview_image is not None:
+        settings = {
+            k: v for k, v in output.preview_image.items() if k not in ("kind", "path")
+        }
+        bands = [band(settings.pop(colour)) for colour in ("red", "green", "blue")]
+        return write_thumbnail(
+            path, [array for array, _ in bands], grid, nodata=bands[0][1], **settings
+        )
+    settings = {k: v for k, v in output.preview_image_singleband.items() if k != "kind"}
+    array, nodata = band(settings.pop("measurement"))
+    return write_thumbnail_singleband(path, array, grid, nodata=nodata, **settings)
 
-    with stac_path.open("w") as f:
-        json.dump(stac, f, default=json_fallback)
-    dataset_assembler.add_accessory_file("metadata:stac", stac_path)
 
-    checksummer = PackageChecksum()
-    checksum_file = (
-        Path(dataset_assembler.names.dataset_location.lstrip("file:"))
-        / dataset_assembler._accessories["checksum:sha1"].name  # noqa: SLF001
-    )
+def _move_into_place(source: Path, destination: Path) -> None:
+    """
+    Move a finished dataset folder to its destination, replacing any existing one.
 
-    checksummer.read(checksum_file)
-    checksummer.add_file(stac_path)
-    checksummer.write(checksum_file)
-    return stac
+    This is a rename when both are on the same filesystem. Otherwise the folder is
+    copied next to the destination first, so the step that publishes it is still a
+    rename and a partly written dataset is never visible.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    suffix = uuid.uuid4().hex
+    staged = destination.with_name(f".{destination.name}.{suffix}")
+    try:
+        source.rename(staged)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        try:
+            shutil.copytree(source, staged)
+        except BaseException:
+            shutil.rmtree(staged, ignore_errors=True)
+            raise
+
+    # A directory can't be renamed over a non-empty one, so move the old one aside
+    replaced = destination.with_name(f".{destination.name}.{suffix}.replaced")
+    if destination.exists():
+        destination.rename(replaced)
+    try:
+        staged.rename(destination)
+    except OSError:
+        if replaced.exists():
+            replaced.rename(destination)
+        raise
+    shutil.rmtree(replaced, ignore_errors=True)
 
 
 def _stac_to_sns(sns_arn, stac):
     """
-    Publish our STAC document to an SNS
+    Publish our STAC document to an SNS, waiting for it to be sent
     """
-    bbox = stac["bbox"]
-    link_ref = next(
-        filter(lambda x: x.get("rel", "") == "self", get_in(["links"], stac, [])), {}
-    ).get("href", "")
-
-    product_name = get_in(["properties", "odc:product"], stac, None)
-    if product_name is None:
-        product_name = stac.get("collection", None)
-
-    if product_name is None:
-        raise ValueError("No 'odc:product_name' or 'collection' found in STAC doc")
-
-    attributes = {
-        "action": {"DataType": "String", "StringValue": "ADDED"},
-        "datetime": {
-            "DataType": "String",
-            "StringValue": str(get_in(["properties", "datetime"], stac)),
-        },
-        "product": {
-            "DataType": "String",
-            "StringValue": product_name,
-        },
-        "version": {
-            "DataType": "String",
-            "StringValue": str(get_in(["properties", "odc:dataset_version"], stac, "")),
-        },
-        "path": {
-            "DataType": "String",
-            "StringValue": link_ref,
-        },
-        "bbox.ll_lon": {"DataType": "Number", "StringValue": str(bbox[0])},
-        "bbox.ll_lat": {"DataType": "Number", "StringValue": str(bbox[1])},
-        "bbox.ur_lon": {"DataType": "Number", "StringValue": str(bbox[2])},
-        "bbox.ur_lat": {"DataType": "Number", "StringValue": str(bbox[3])},
-    }
-
-    maturity = get_in(["properties", "dea:dataset_maturity"], stac)
-
-    if maturity is not None:
-        attributes["maturity"] = {"DataType": "String", "StringValue": maturity}
-
-    client = boto3.client("sns")
-    client.publish(
-        TopicArn=sns_arn,
-        Message=json.dumps(stac, indent=4, default=json_fallback),
-        MessageAttributes=attributes,
-    )
+    publisher(sns_arn).publish(stac).result()
 
 
 def _munge_dataset_to_eo3(ds: Dataset) -> DatasetDoc:
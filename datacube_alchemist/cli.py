@@ -1,23 +1,29 @@
 #!/usr/bin/env python
 import sys
 import time
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
 from subprocess import CalledProcessError
 
 import click
 import structlog
-from botocore.exceptions import ClientError
-from datacube.ui import click as ui
-from odc.aws.queue import get_messages, get_queue
 
 from datacube_alchemist import __version__
-from datacube_alchemist._utils import _configure_logger
-from datacube_alchemist.worker import Alchemist
+from datacube_alchemist._logging import _configure_logger
+from datacube_alchemist._profiling import PROFILERS, profile_task
 
+# Only lightweight modules are imported up here, so that --help, --version and the
+# queue-only commands start quickly. The worker pulls in datacube, eodatasets3,
+# boto3 and friends, so each command imports it when it needs it.
 _LOG = structlog.get_logger()
 
 # Define common options for all the commands
 queue_option = click.option(
-    "--queue", "-q", help="Name of an AWS SQS Message Queue", required=True
+    "--queue",
+    "-q",
+    help="Name of an AWS SQS Message Queue, or sqlite:///path/to/queues.db?queue=name for a local queue",
+    required=True,
 )
 uuid_option = click.option(
     "--uuid", "-u", required=True, help="UUID of the scene to be processed"
@@ -49,6 +55,12 @@ config_file_option = click.option(
     required=True,
     help="The path (URI or file) to a config file to use for the job",
 )
+with_config_file_option = click.option(
+    "--with-config-file",
+    "with_config_files",
+    multiple=True,
+    help="Another config file to run over the same datasets, sharing each load. Can be repeated.",
+)
 dryrun_option = click.option(
     "--dryrun",
     "--no-dryrun",
@@ -61,6 +73,182 @@ sns_arn_option = click.option(
     default=None,
     help="Publish resulting STAC document to an SNS",
 )
+prefetch_option = click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Download the source files of this many upcoming tasks to local scratch while the current one runs",
+)
+order_option = click.option(
+    "--order",
+    type=click.Choice(["index", "region"]),
+    default="index",
+    help="Order datasets as the index returns them, or by region code and time so tasks share ancillary tiles",
+)
+profile_dir_option = click.option(
+    "--profile-dir",
+    default=None,
+    help="Profile tasks and write the results, named by dataset ID, to this local directory or S3 prefix",
+)
+profile_rate_option = click.option(
+    "--profile-rate",
+    type=click.FloatRange(0, 1),
+    default=1.0,
+    help="Fraction of tasks to profile when --profile-dir is set, e.g. 0.01 for 1%",
+)
+profiler_option = click.option(
+    "--profiler",
+    type=click.Choice(PROFILERS),
+    default="cprofile",
+    help="cprofile, or the pyinstrument sampling profiler if it's installed",
+)
+
+
+# Copied from datacube.ui.click, for use in the command help
+_EXPRESSIONS_HELP = """
+    EXPRESSIONS
+
+    Select datasets using [EXPRESSIONS] to filter by date, product type,
+    spatial extents or other searchable fields.
+
+    \b
+        FIELD = VALUE
+        FIELD in DATE-RANGE
+        FIELD in [START, END]
+        TIME < DATE
+        TIME > DATE
+
+    \b
+    START and END can be either numbers or dates
+    Dates follow YYYY, YYYY-MM, or YYYY-MM-DD format
+
+    FIELD: x, y, lat, lon, time, product, ...
+
+    \b
+    eg. 'time in [1996-01-01, 1996-12-31]'
+        'time in 1996'
+        'time > 2020-01'
+        'lon in [130, 140]' 'lat in [-40, -30]'
+        product=ls5_nbar_albers
+
+    """
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+
+    from datacube_alchemist._scheduling import parse_shard
+
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e)) from e
+
+
+def parsed_search_expressions(f):
+    """
+    A lazy version of ``datacube.ui.click.parsed_search_expressions``, which
+    only imports datacube once there are expressions to parse.
+    """
+    f.__doc__ = (f.__doc__ or "") + _EXPRESSIONS_HELP
+
+    def parse(ctx, param, value):
+        from datacube.ui.expression import parse_expressions
+
+        return parse_expressions(*list(value))
+
+    return click.argument("expressions", callback=parse, nargs=-1)(f)
+
+
+def _executor(alchemist, with_config_files):
+    """The Alchemist itself, or a group that shares its loads with other configs"""
+    if not with_config_files:
+        return alchemist
+
+    from datacube_alchemist.worker import AlchemistGroup
+
+    return AlchemistGroup.with_config_files(alchemist, with_config_files)
+
+
+def _execute_serially(
+    executor, tasks_and_messages, dryrun, sns_arn, profile_dir, profile_rate, profiler
+):
+    """Execute tasks one at a time, yielding (task, message, error) like the pool does"""
+    for task, message in tasks_and_messages:
+        try:
+            with profile_task(task.dataset.id, profile_dir, profile_rate, profiler):
+                executor.execute_task(task, dryrun, sns_arn)
+        except Exception as e:  # noqa: PERF203
+            yield task, message, e
+        else:
+            yield task, message, None
+
+
+def _publish_result(task, message):
+    # Waits for the task's STAC documents to be sent
+    for future in task.published:
+        error = future.exception()
+        if error is not None:
+            return task, message, error
+    return task, message, None
+
+
+def _published(results):
+    """
+    Hold back each successful task's result until its STAC documents have been
+    sent, with the error that stopped one in place of its success. The documents
+    are sent while the next task runs.
+    """
+    waiting = deque()
+    try:
+        for task, message, error in results:
+            if error is None and task.published:
+                waiting.append((task, message))
+            else:
+                yield task, message, error
+            while waiting and all(f.done() for f in waiting[0][0].published):
+                yield _publish_result(*waiting.popleft())
+        while waiting:
+            yield _publish_result(*waiting.popleft())
+    finally:
+        results.close()
+
+
+def _prefetched(alchemist, tasks_and_messages, depth, stack, visibility_timeout=None):
+    """Prefetch the sources of the next ``depth`` tasks, returning tasks and a release"""
+    if not depth:
+        return tasks_and_messages, lambda task: None
+
+    from datacube_alchemist._prefetch import Prefetcher
+
+    prefetcher = stack.enter_context(
+        Prefetcher(
+            depth,
+            directory=alchemist.config.processing.scratch_dir,
+            aws_unsigned=alchemist.config.specification.aws_unsigned,
+        )
+    )
+    return (
+        prefetcher.prefetch(tasks_and_messages, visibility_timeout),
+        prefetcher.release,
+    )
+
+
+def _leased(alchemist, tasks_and_messages, leases, ttl):
+    """
+    Take a lease on each task's output before it runs, deleting the message of a
+    task another worker holds the lease for
+    """
+    for task, message in tasks_and_messages:
+        if leases.acquire_lease(str(alchemist.output_uuid(task)), ttl):
+            yield task, message
+            continue
+        _LOG.info(
+            "Another worker is running this task, deleting its message",
+            dataset_id=str(task.dataset.id),
+        )
+        message.delete()
 
 
 def cli_with_envvar_handling():
@@ -82,16 +270,26 @@ def cli(version):
 
 @cli.command()
 @config_file_option
+@with_config_file_option
 @uuid_option
 @dryrun_option
-def run_one(config_file, uuid, dryrun):
+@profile_dir_option
+@profile_rate_option
+@profiler_option
+def run_one(
+    config_file, with_config_files, uuid, dryrun, profile_dir, profile_rate, profiler
+):
     """
     Run with the config file for one input_dataset (by UUID)
     """
+    from datacube_alchemist.worker import Alchemist
+
     alchemist = Alchemist(config_file=config_file)
+    executor = _executor(alchemist, with_config_files)
     task = alchemist.generate_task_by_uuid(uuid)
     if task:
-        alchemist.execute_task(task, dryrun)
+        with profile_task(task.dataset.id, profile_dir, profile_rate, profiler):
+            executor.execute_task(task, dryrun)
     else:
         _LOG.error(f"Failed to generate a task for UUID {uuid}")
         sys.exit(1)
@@ -99,23 +297,65 @@ def run_one(config_file, uuid, dryrun):
 
 @cli.command()
 @config_file_option
-@ui.parsed_search_expressions
+@with_config_file_option
+@parsed_search_expressions
 @limit_option
+@click.option(
+    "--shard",
+    callback=_parse_shard,
+    default=None,
+    help="Only process shard i/N of the datasets, counting from 0, e.g. $PBS_ARRAY_INDEX/16",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(["id", "region"]),
+    default="id",
+    help="Split shards by dataset ID, or by region code to keep each tile's scenes together",
+)
+@order_option
 @dryrun_option
-def run_many(config_file, expressions, limit, dryrun):
+@prefetch_option
+@profile_dir_option
+@profile_rate_option
+@profiler_option
+def run_many(
+    config_file,
+    with_config_files,
+    expressions,
+    limit,
+    shard,
+    shard_by,
+    order,
+    dryrun,
+    prefetch,
+    profile_dir,
+    profile_rate,
+    profiler,
+):
     """
     Run Alchemist with the config file on all the Datasets matching an ODC query expression
     """
+    from datacube_alchemist.worker import Alchemist
+
     # Load Configuration file
     alchemist = Alchemist(config_file=config_file)
+    executor = _executor(alchemist, with_config_files)
 
-    tasks = alchemist.generate_tasks(expressions, limit=limit)
+    tasks = alchemist.generate_tasks(
+        expressions, limit=limit, shard=shard, shard_by=shard_by, order=order
+    )
 
     executed = 0
 
-    for task in tasks:
-        alchemist.execute_task(task, dryrun)
-        executed += 1
+    with ExitStack() as stack:
+        tasks_and_messages, release = _prefetched(
+            alchemist, ((task, None) for task in tasks), prefetch, stack
+        )
+        for task, _ in tasks_and_messages:
+            with profile_task(task.dataset.id, profile_dir, profile_rate, profiler):
+                executor.execute_task(task, dryrun)
+            release(task)
+            executed += 1
 
     if executed == 0:
         _LOG.error("Failed to generate any tasks")
@@ -124,40 +364,140 @@ def run_many(config_file, expressions, limit, dryrun):
 
 @cli.command()
 @config_file_option
+@with_config_file_option
 @queue_option
 @limit_option
 @queue_timeout
 @dryrun_option
 @sns_arn_option
-def run_from_queue(config_file, queue, limit, queue_timeout, dryrun, sns_arn):
+@click.option(
+    "--lease/--no-lease",
+    default=False,
+    help="Lease each task's output, in a sqlite:// queue's database or the output location, "
+    "so other workers drop their copies of a task while it runs",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes to execute tasks on. This process polls the queue and deletes messages.",
+)
+@prefetch_option
+@profile_dir_option
+@profile_rate_option
+@profiler_option
+def run_from_queue(
+    config_file,
+    with_config_files,
+    queue,
+    limit,
+    queue_timeout,
+    dryrun,
+    sns_arn,
+    lease,
+    workers,
+    prefetch,
+    profile_dir,
+    profile_rate,
+    profiler,
+):
     """
     Process messages from the given queue
     """
+    from botocore.exceptions import ClientError
 
-    alchemist = Alchemist(config_file=config_file)
+    from datacube_alchemist.worker import Alchemist
 
-    tasks_and_messages = alchemist.get_tasks_from_queue(queue, limit, queue_timeout)
+    alchemist = Alchemist(config_file=config_file)
+    executor = _executor(alchemist, with_config_files)
+
+    leases = None
+    if lease and not dryrun:
+        from datacube_alchemist._lease import get_leases
+
+        leases = get_leases(queue, alchemist.config.output.location)
+
+    def received():
+        tasks_and_messages = alchemist.get_tasks_from_queue(queue, limit, queue_timeout)
+        if leases is None:
+            return tasks_and_messages
+        # Leased before they're prefetched, so another worker's tasks aren't
+        # downloaded for nothing. A lease lasts while a task waits its turn behind
+        # the prefetched ones, each of which is given the queue timeout to run.
+        ttl = queue_timeout * (prefetch + 1)
+        return _leased(alchemist, tasks_and_messages, leases, ttl)
+
+    with ExitStack() as stack:
+        if workers > 1:
+            from datacube_alchemist._pool import execute_in_pool
+
+            # The pool takes a message each time a worker is free, so receive them
+            # one at a time rather than leaving a batch waiting out its timeout
+            tasks_and_messages, release = _prefetched(
+                alchemist, received(), prefetch, stack, queue_timeout
+            )
+            configs = [alchemist.config]
+            if with_config_files:
+                configs = [a.config for a in executor.alchemists]
+            results = execute_in_pool(
+                tasks_and_messages,
+                configs,
+                workers,
+                dryrun=dryrun,
+                sns_arn=sns_arn,
+                profile_dir=profile_dir,
+                profile_rate=profile_rate,
+                profiler=profiler,
+            )
+        else:
+            tasks_and_messages, release = _prefetched(
+                alchemist, received(), prefetch, stack, queue_timeout
+            )
+            results = _execute_serially(
+                executor,
+                tasks_and_messages,
+                dryrun,
+                sns_arn,
+                profile_dir,
+                profile_rate,
+                profiler,
+            )
 
-    errors = 0
-    successes = 0
+        results = _published(results)
+        errors = 0
+        successes = 0
 
-    for task, message in tasks_and_messages:
-        try:
-            alchemist.execute_task(task, dryrun, sns_arn)
-            message.delete()
-            successes += 1
+        # Messages are only deleted here, so a failed task goes back on the queue
+        for task, message, error in results:
+            release(task)
+            if leases is not None:
+                leases.release_lease(str(alchemist.output_uuid(task)))
+            if error is None:
+                message.delete()
+                successes += 1
+                continue
 
-        # CalledProcessError from aws cli subprocess and ClientError from sns publishing
-        # if these happen, we don't want to continue, because we might have access issues.
-        except (CalledProcessError, ClientError):  # noqa: PERF203
             errors += 1
-            _LOG.exception("Access denied or other AWS error, stopping execution")
-            break
-        # Ignore other exceptions, but log them
-        except Exception as e:
-            errors += 1
-            _LOG.exception(
-                f"Failed to run transform {alchemist.transform_name} on dataset {task.dataset.id} with error {e}"
+            # CalledProcessError from aws cli subprocess and ClientError from sns publishing
+            # if these happen, we don't want to continue, because we might have access issues.
+            if isinstance(error, (CalledProcessError, ClientError)):
+                _LOG.error(
+                    "Access denied or other AWS error, stopping execution",
+                    exc_info=error,
+                )
+                results.close()
+                break
+            # A worker process died, or couldn't start, so the rest would fail too
+            if isinstance(error, BrokenProcessPool):
+                _LOG.error(
+                    "The worker pool is broken, stopping execution", exc_info=error
+                )
+                results.close()
+                break
+            # Ignore other exceptions, but log them
+            _LOG.error(
+                f"Failed to run transform {alchemist.transform_name} on dataset {task.dataset.id} with error {error}",
+                exc_info=error,
             )
 
     if errors > 0:
@@ -170,23 +510,54 @@ def run_from_queue(config_file, queue, limit, queue_timeout, dryrun, sns_arn):
         )
 
 
+@cli.command()
+@config_file_option
+@with_config_file_option
+@click.option(
+    "--socket",
+    "socket_path",
+    required=True,
+    help="Path of the unix socket to take tasks from",
+)
+@dryrun_option
+@sns_arn_option
+def serve(config_file, with_config_files, socket_path, dryrun, sns_arn):
+    """
+    Keep a warm Alchemist running, taking tasks over a unix socket
+
+    Send a line of JSON for each task, as a queue message would hold it, such as
+    '{"id": "<dataset uuid>"}' or a STAC item, and read a line of JSON back with
+    its outputs or error. The index connection, products, transform and caches are
+    set up once, so each task only waits for its own work.
+    """
+    from datacube_alchemist._serve import serve as serve_socket
+    from datacube_alchemist.worker import Alchemist
+
+    alchemist = Alchemist(config_file=config_file)
+    executor = _executor(alchemist, with_config_files)
+    alchemists = executor.alchemists if with_config_files else [alchemist]
+    serve_socket(socket_path, executor, alchemists, dryrun=dryrun, sns_arn=sns_arn)
+
+
 @cli.command()
 @config_file_option
 @queue_option
-@ui.parsed_search_expressions
+@parsed_search_expressions
 @limit_option
 @product_limit_option
+@order_option
 @dryrun_option
-def add_to_queue(config_file, queue, expressions, limit, product_limit, dryrun):
+def add_to_queue(config_file, queue, expressions, limit, product_limit, order, dryrun):
     """
     Search for Datasets and enqueue Tasks into an AWS SQS Queue for later processing.
     """
+    from datacube_alchemist.worker import Alchemist
 
     start_time = time.time()
 
     alchemist = Alchemist(config_file=config_file)
     n_messages = alchemist.enqueue_datasets(
-        queue, expressions, limit, product_limit, dryrun
+        queue, expressions, limit, product_limit, dryrun, order=order
     )
 
     if not dryrun:
@@ -204,6 +575,8 @@ def add_ids_to_queue(config_file, queue, dryrun, ids):
     """
     Add Datasets by ID to the queue.
     """
+    from datacube_alchemist.worker import Alchemist
+
     _LOG.info(f"Adding {len(ids)} Datasets to the queue.")
 
     start_time = time.time()
@@ -226,26 +599,38 @@ def add_ids_to_queue(config_file, queue, dryrun, ids):
 )
 @config_file_option
 @queue_option
+@order_option
 @dryrun_option
-def add_missing_to_queue(config_file, queue, predicate, dryrun):
+def add_missing_to_queue(config_file, queue, predicate, order, dryrun):
     """
     Search for datasets that don't have a target product dataset and add them to the queue
 
-    If a predicate is supplied, datasets which do not match are filtered out.
+    Datasets are filtered by the config's specification.filter, and if a predicate
+    is supplied, datasets which do not match it are filtered out too.
 
     Example predicate:
      - 'd.metadata.gqa_iterative_mean_xy <= 1'
     """
+    from datacube_alchemist.worker import Alchemist
 
     alchemist = Alchemist(config_file=config_file)
 
     datasets = alchemist.find_unprocessed_datasets(queue, dryrun)
 
+    if alchemist.dataset_filter is not None:
+        datasets = list(alchemist.filter_datasets(datasets))
+        _LOG.info(f"After the specification's filter, {len(datasets)} remain.")
+
     if predicate:
         code_obj = compile(predicate, "<string>", "eval")
         datasets = [d for d in datasets if eval(code_obj)]
         _LOG.info(f'After filtering with "{predicate}", {len(datasets)} remain.')
 
+    if order != "index":
+        from datacube_alchemist._scheduling import order_datasets
+
+        datasets = order_datasets(datasets, by=order)
+
     if not dryrun:
         alchemist.datasets_to_queue(queue, datasets)
         _LOG.info(f"Pushed {len(datasets)} items.")
@@ -258,12 +643,29 @@ def add_missing_to_queue(config_file, queue, predicate, dryrun):
 @cli.command()
 @queue_option
 @limit_option
-@click.option("--to-queue", "-t", help="Url of SQS Queue to move to", required=False)
+@click.option(
+    "--to-queue",
+    "-t",
+    help="Name of SQS Queue, or sqlite:// URL of a local queue, to move to",
+    required=False,
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of threads receiving, sending and deleting batches of messages",
+)
+@click.option(
+    "--dedupe/--no-dedupe",
+    default=False,
+    help="Only send the first message for each dataset ID, deleting the others",
+)
 @dryrun_option
-def redrive_to_queue(queue, to_queue, limit, dryrun):
+def redrive_to_queue(queue, to_queue, limit, threads, dedupe, dryrun):
     """
     Redrives all the messages from the given sqs queue to their source, or the target queue
     """
+    from datacube_alchemist._queue import get_queue, redrive
 
     dead_queue = get_queue(queue)
     if to_queue:
@@ -275,11 +677,8 @@ def redrive_to_queue(queue, to_queue, limit, dryrun):
                     "Deadletter queue has more than one source, please specify the target queue name."
                 )
             alive_queue = q
-    messages = get_messages(dead_queue)
-
-    count = 0
 
-    count_messages = dead_queue.attributes.get("ApproximateNumberOfMessages")
+    count_messages = int(dead_queue.attributes.get("ApproximateNumberOfMessages", 0))
 
     if count_messages == 0:
         _LOG.info("No messages to redrive")
@@ -287,18 +686,21 @@ def redrive_to_queue(queue, to_queue, limit, dryrun):
 
     _LOG.info(f"Commencing pusing messages from {dead_queue.url} to {alive_queue.url}")
     if not dryrun:
-        for message in messages:
-            response = alive_queue.send_message(MessageBody=message.body)
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                message.delete()
-                count += 1
-                if limit and count >= limit:
-                    break
-            else:
-                _LOG.error(
-                    f"Unable to send message {message} to queue {alive_queue.url}"
-                )
-        _LOG.info(f"Completed sending {count} messages to the queue {alive_queue.url}")
+        stats = redrive(
+            dead_queue, alive_queue, limit=limit, threads=threads, dedupe=dedupe
+        )
+        _LOG.info(
+            f"Completed sending {stats.sent} messages to the queue {alive_queue.url}",
+            duplicates=stats.duplicates,
+            failed=stats.failed,
+            seconds=round(stats.seconds, 1),
+            rate=round(stats.rate, 1),
+        )
+        if stats.failed:
+            _LOG.error(
+                f"Unable to send {stats.failed} messages to queue {alive_queue.url}, "
+                "they'll stay in the dead letter queue"
+            )
     else:
         _LOG.warning(
             f"DRYRUN enabled, would have pushed approx {count_messages} messages to the queue {alive_queue.url}"
@@ -6,6 +6,8 @@ import cattr
 from datacube.model import Dataset
 from rasterio.enums import Resampling
 
+from datacube_alchemist._metrics import TaskMetrics
+
 
 def _convert_union_mapping(obj, typ):
     # ignore typ, check obj behaves correctly
@@ -43,10 +45,28 @@ class OutputSettings:
     properties: Optional[Mapping[str, str]] = None
     reference_source_dataset: bool = attr.ib(default=True)
     write_stac: Optional[bool] = False
+    band_statistics: bool = attr.ib(default=False)
     inherit_geometry: bool = attr.ib(default=True)
     explorer_url: Optional[str] = None
 
 
+@attr.s(auto_attribs=True)
+class FilterSettings:
+    # Search expressions, as add-to-queue takes them, such as "cloud_cover in [0, 50]"
+    expressions: Sequence[str] = attr.ib(factory=list)
+    # A GeoJSON file (path or URL) of the area of interest, in WGS84 unless it says
+    # otherwise. Datasets whose footprints miss it aren't queued.
+    aoi: Optional[str] = None
+
+
+@attr.s(auto_attribs=True)
+class GroupSettings:
+    # Scenes of the same tile (region code) whose times fall in the same window of
+    # this many days, counted from 1970-01-01, are one task. They're loaded together
+    # along time, and the last of them names the output.
+    window_days: float
+
+
 @attr.s(auto_attribs=True)
 class Specification:
     measurements: Sequence[str]
@@ -61,12 +81,92 @@ class Specification:
     override_product_family: Optional[str] = attr.ib(default=None)
     basis: Optional[str] = attr.ib(default=None)
     aws_unsigned: Optional[bool] = True
+    # Which of the products' datasets are worth queueing
+    filter: Optional[FilterSettings] = None
+    # How to group the datasets into tasks of several scenes, for temporal transforms
+    group: Optional[GroupSettings] = None
+
+
+@attr.s(auto_attribs=True)
+class ReadSettings:
+    """GDAL options for reading source data, applied locally and on Dask workers"""
+
+    # GDAL_CACHEMAX, the raster block cache, which outlives each task
+    block_cache_mb: Optional[int] = None
+    # VSI_CACHE and VSI_CACHE_SIZE, a per-file cache of raw bytes read
+    vsi_cache_mb: Optional[int] = None
+    # CPL_VSIL_CURL_CACHE_SIZE, the global cache of HTTP/S3 ranges read
+    curl_cache_mb: Optional[int] = None
+    # GDAL_HTTP_VERSION=2 and GDAL_HTTP_MULTIPLEX, several requests per connection
+    http_multiplex: bool = False
+    # GDAL_HTTP_MERGE_CONSECUTIVE_RANGES, one request for adjacent blocks
+    merge_consecutive_ranges: bool = False
+    # GDAL_HTTP_TCP_KEEPALIVE, keep pooled connections open between tasks
+    keep_alive: bool = False
+    # GDAL_MAX_DATASET_POOL_SIZE, how many source files are kept open
+    dataset_pool_size: Optional[int] = None
+    # Any other GDAL config options, these take precedence
+    gdal_options: Mapping[str, Any] = attr.ib(factory=dict)
+
+    def to_gdal_options(self) -> dict[str, Any]:
+        # rasterio converts these, and needs GDAL_CACHEMAX to be an int
+        options = {}
+        if self.block_cache_mb is not None:
+            options["GDAL_CACHEMAX"] = self.block_cache_mb
+        if self.vsi_cache_mb is not None:
+            options["VSI_CACHE"] = True
+            options["VSI_CACHE_SIZE"] = self.vsi_cache_mb * 2**20
+        if self.curl_cache_mb is not None:
+            options["CPL_VSIL_CURL_CACHE_SIZE"] = self.curl_cache_mb * 2**20
+        if self.http_multiplex:
+            options["GDAL_HTTP_VERSION"] = "2"
+            options["GDAL_HTTP_MULTIPLEX"] = True
+        if self.merge_consecutive_ranges:
+            options["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"] = True
+        if self.keep_alive:
+            options["GDAL_HTTP_TCP_KEEPALIVE"] = True
+        if self.dataset_pool_size is not None:
+            options["GDAL_MAX_DATASET_POOL_SIZE"] = self.dataset_pool_size
+        options.update(self.gdal_options)
+        return options
+
+
+@attr.s(auto_attribs=True)
+class PrecheckSettings:
+    # What to do with a dataset that fails a check: "skip" it, or write an "empty"
+    # output of nodata without loading or transforming anything
+    action: str = attr.ib(
+        default="skip", validator=attr.validators.in_(("skip", "empty"))
+    )
+    # The highest eo:cloud_cover percentage worth processing
+    max_cloud_cover: Optional[float] = None
+    # The smallest fraction of its grid the dataset's valid-data geometry can cover
+    min_valid_fraction: Optional[float] = None
+    # A mask band, such as oa_fmask, read at a fraction of its resolution, and the
+    # values of it that are usable. Datasets with no more than min_usable_fraction
+    # of usable pixels fail.
+    mask_measurement: Optional[str] = None
+    mask_usable_values: Sequence[int] = attr.ib(factory=list)
+    min_usable_fraction: float = 0.0
+    mask_decimation: int = 10
 
 
 @attr.s(auto_attribs=True)
 class ProcessingSettings:
     dask_chunks: Mapping[str, int] = attr.ib(default={})
     dask_client: Optional[Mapping[str, Any]] = attr.ib(default={})
+    # Write per-task metrics here for the Prometheus node exporter's textfile collector
+    metrics_textfile: Optional[str] = None
+    # Where to assemble S3 outputs. Defaults to the system temporary directory.
+    # Local outputs ignore it and are staged inside the output location, unless
+    # that can't be created.
+    scratch_dir: Optional[str] = None
+    # Seconds to wait for enough free scratch space before failing a task. When
+    # unset, tasks start without checking.
+    scratch_admission_timeout: Optional[float] = None
+    read: ReadSettings = attr.ib(factory=ReadSettings)
+    # Cheap checks of each dataset, to skip the empty or cloudy ones
+    precheck: Optional[PrecheckSettings] = None
 
 
 @attr.s(auto_attribs=True)
@@ -80,3 +180,15 @@ class AlchemistSettings:
 class AlchemistTask:
     dataset: Dataset
     settings: AlchemistSettings
+    metrics: TaskMetrics = attr.ib(factory=TaskMetrics, eq=False, repr=False)
+    # A grouped task's source datasets in time order, which ``dataset`` is the last
+    # of. Empty when the task is just ``dataset``.
+    group: Sequence[Dataset] = attr.ib(factory=list)
+    # Futures of the STAC documents published for the task, which are sent in the
+    # background. Its message mustn't be deleted until they're done.
+    published: list = attr.ib(factory=list, eq=False, repr=False)
+
+    @property
+    def datasets(self) -> list[Dataset]:
+        """Every source dataset of the task"""
+        return list(self.group) or [self.dataset]
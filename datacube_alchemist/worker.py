@@ -1,15 +1,24 @@
+import hashlib
 import importlib
+import itertools
 import json
-import shutil
+import os
 import subprocess
 import sys
 import tempfile
-from collections.abc import Iterable, Mapping
+import time
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timezone
+from functools import cached_property
 from pathlib import Path
 from typing import Optional, Union
+from uuid import UUID
 
 import cattr
+import dask
 import datacube
 import fsspec
 import numpy as np
@@ -19,18 +28,39 @@ import yaml
 from datacube.model import Dataset
 from datacube.testutils.io import native_geobox, native_load
 from datacube.utils.aws import configure_s3_access
-from datacube.virtual import Transformation
+from datacube.virtual import Measurement, Transformation
 from eodatasets3.assemble import DatasetAssembler
+from eodatasets3.images import GridSpec
 from odc.apps.dc_tools._docs import odc_uuid
 from odc.apps.dc_tools._stac import stac_transform
 from odc.aws import s3_url_parse
-from odc.aws.queue import get_messages, get_queue
+from odc.aws.queue import get_messages
 
 from datacube_alchemist import __version__
+from datacube_alchemist._assemble import Assembler
+from datacube_alchemist._cog import write_measurements
+from datacube_alchemist._filter import DatasetFilter
+from datacube_alchemist._metrics import (
+    TaskMetrics,
+    directory_size,
+    textfile_path,
+    write_prometheus_textfile,
+)
+from datacube_alchemist._precheck import empty_output, precheck
+from datacube_alchemist._publish import publisher
+from datacube_alchemist._queue import SQLITE_SCHEME, get_queue
+from datacube_alchemist._scheduling import (
+    group_datasets,
+    order_datasets,
+    region_code,
+    shard_datasets,
+)
+from datacube_alchemist._scratch import reserve_space
+from datacube_alchemist._stats import footprint, raster_band, summarise
 from datacube_alchemist._utils import (
+    _move_into_place,
     _munge_dataset_to_eo3,
-    _stac_to_sns,
-    _write_stac,
+    _thumbnail_path,
     _write_thumbnail,
 )
 from datacube_alchemist.settings import AlchemistSettings, AlchemistTask
@@ -38,37 +68,141 @@ from datacube_alchemist.settings import AlchemistSettings, AlchemistTask
 _LOG = structlog.get_logger()
 cattr.register_structure_hook(np.dtype, np.dtype)
 
+# Overviews at 1/2, 1/4, ... add up to a third on top of the full resolution data
+_OVERVIEW_OVERHEAD = 4 / 3
+
+# How many transform instances, each with its own arguments, an Alchemist keeps
+_TRANSFORM_POOL_SIZE = 8
+
+
+def _distributed_client():
+    """The current Dask distributed client, or None when using the local scheduler"""
+    try:
+        from distributed import default_client
+    except ImportError:
+        return None
+    try:
+        return default_client()
+    except ValueError:
+        return None
+
+
+def _writable_dtypes(output_data):
+    # Because"/env/lib/python3.6/site-packages/eodatasets3/images.py", line 489, in write_from_ndarray
+    # raise TypeError("Datatype not supported: {dt}".format(dt=dtype))
+    # TODO: investigate if this is ok
+    dtypes = {str(v.dtype) for v in output_data.data_vars.values()}
+    if "int8" in dtypes:
+        _LOG.info("Found dtype=int8 in output data, converting to uint8 for geotiffs")
+        output_data = output_data.astype("uint8", copy=False)
+    return output_data
+
+
+def _is_s3_url(location: str) -> bool:
+    try:
+        s3_url_parse(location)
+    except ValueError:
+        return False
+    return True
+
+
+@contextmanager
+def _reserve_scratch(needs: Sequence[tuple[AlchemistTask, Optional[tuple]]]):
+    """
+    Hold a single reservation per staging directory for the summed ``scratch_needed``
+    of the tasks, timing the wait as the first task's ``admit`` stage
+    """
+    totals = {}
+    for _, need in needs:
+        if need is not None:
+            root, nbytes, timeout = need
+            total, longest = totals.get(root, (0, 0))
+            totals[root] = (total + nbytes, max(longest, timeout))
+    if not totals:
+        yield
+        return
+
+    first = needs[0][0]
+    with ExitStack() as stack:
+        with first.metrics.stage("admit"):
+            for root, (nbytes, timeout) in sorted(totals.items()):
+                stack.enter_context(reserve_space(root, nbytes, timeout))
+        for task, _ in needs[1:]:
+            task.metrics.stages["admit"] = first.metrics.stages["admit"]
+        yield
+
 
 class Alchemist:
-    def __init__(self, *, config=None, config_file=None, dc_env=None):
+    def __init__(self, *, config=None, config_file=None, dc_env=None, dc=None):
         if config is not None:
             self.config = config
         else:
             with fsspec.open(config_file, mode="r") as f:
                 self.config = cattr.structure(yaml.safe_load(f), AlchemistSettings)
 
-        # Connect to the ODC Index
-        self.dc = datacube.Datacube(env=dc_env)
-        self.input_products = []
+        # The ODC index connection and rasterio environment are set up on first use,
+        # so that commands which never touch them don't pay for them.
+        self._dc = dc
+        self._dc_env = dc_env
+        self._s3_configured = False
+        self._output_measurements_by_product: dict[str, Optional[dict]] = {}
+        # Transform instances by their arguments, most recently used last
+        self._transforms: OrderedDict[str, Transformation] = OrderedDict()
+        # How many tasks have been written, written empty or skipped
+        self.outcomes: Counter = Counter()
 
         if self.config.specification.product and self.config.specification.products:
             _LOG.warning(
                 "Both `product` and `products` are defined, only using product."
             )
 
-        # Store the products that we're allowing as inputs
+    @property
+    def dc(self) -> datacube.Datacube:
+        if self._dc is None:
+            # Connect to the ODC Index
+            self._dc = datacube.Datacube(env=self._dc_env)
+        return self._dc
+
+    @cached_property
+    def input_products(self) -> list:
+        # The products that we're allowing as inputs
         if self.config.specification.product:
-            self.input_products.append(
+            return [
                 self.dc.index.products.get_by_name(self.config.specification.product)
-            )
-        elif self.config.specification.products:
-            for product in self.config.specification.products:
-                self.input_products.append(self.dc.index.products.get_by_name(product))
-
+            ]
+        if self.config.specification.products:
+            return [
+                self.dc.index.products.get_by_name(product)
+                for product in self.config.specification.products
+            ]
+        return []
+
+    @cached_property
+    def dataset_filter(self) -> Optional[DatasetFilter]:
+        # The specification's filter of datasets worth queueing, if it has one
+        if self.config.specification.filter is None:
+            return None
+        return DatasetFilter(self.config.specification.filter)
+
+    def _configure_s3_access(self) -> None:
         # Rasterio environment activation
-        configure_s3_access(
-            cloud_defaults=True, aws_unsigned=self.config.specification.aws_unsigned
-        )
+        if not self._s3_configured:
+            gdal_options = self.config.processing.read.to_gdal_options()
+            configure_s3_access(
+                cloud_defaults=True,
+                aws_unsigned=self.config.specification.aws_unsigned,
+                **gdal_options,
+            )
+            # Dask workers read the source data too, so they need the same settings
+            client = _distributed_client()
+            if client is not None:
+                configure_s3_access(
+                    cloud_defaults=True,
+                    aws_unsigned=self.config.specification.aws_unsigned,
+                    client=client,
+                    **gdal_options,
+                )
+            self._s3_configured = True
 
     @property
     def transform_name(self) -> str:
@@ -78,7 +212,7 @@ class Alchemist:
     def resampling(self) -> Union[str, Mapping[str, str]]:
         return self.config.specification.resampling
 
-    @property
+    @cached_property
     def transform(self) -> type[Transformation]:
         module_name, class_name = self.transform_name.rsplit(".", maxsplit=1)
         module = importlib.import_module(name=module_name)
@@ -105,9 +239,21 @@ class Alchemist:
             transform_args = task.settings.specification.transform_args_per_product.get(
                 task.dataset.type.name
             )
-        if transform_args is not None:
-            return self.transform(**transform_args)
-        return self.transform()
+
+        # Transforms can load models or open ancillary data when they're made, so
+        # tasks with the same arguments share an instance. Products with the same
+        # arguments would make the same transform, so they share one too.
+        key = json.dumps(transform_args, sort_keys=True, default=str)
+        transform = self._transforms.get(key)
+        if transform is not None:
+            self._transforms.move_to_end(key)
+            return transform
+
+        transform = self.transform(**(transform_args or {}))
+        self._transforms[key] = transform
+        if len(self._transforms) > _TRANSFORM_POOL_SIZE:
+            self._transforms.popitem(last=False)
+        return transform
 
     def _find_dataset(self, uuid: str) -> Dataset:
         # Find a dataset for a given UUID from within the available
@@ -184,7 +330,7 @@ class Alchemist:
         uuid = odc_uuid(
             algorithm=task.settings.specification.transform,
             algorithm_version=algorithm_version,
-            sources=[task.dataset.id],
+            sources=[dataset.id for dataset in task.datasets],
             **other_tags,
         )
 
@@ -195,12 +341,12 @@ class Alchemist:
 
         return uuid, uuid_values
 
-    def _get_transform_info(self):
-        """
-        Given a transform return version and url info of the transform.
-        :param transform:
-        :return:
-        """
+    def output_uuid(self, task: AlchemistTask) -> UUID:
+        """The deterministic ID of the dataset a task writes"""
+        return self._deterministic_uuid(task)[0]
+
+    @cached_property
+    def _transform_info(self) -> dict:
         version = ""
         version_major_minor = ""
         try:
@@ -217,8 +363,19 @@ class Alchemist:
             "url": self.config.specification.transform_url,
         }
 
+    def _get_transform_info(self):
+        """
+        Given a transform return version and url info of the transform.
+        It's looked up once, as importing the transform's package again for every
+        task would be wasted work.
+        :return:
+        """
+        return self._transform_info
+
     def datasets_to_queue(self, queue, datasets):
         alive_queue = get_queue(queue)
+        # FIFO queues deliver each message group in order, to one consumer at a time
+        grouped = alive_queue.url.endswith(".fifo") or queue.startswith(SQLITE_SCHEME)
 
         def post_messages(messages, count):
             alive_queue.send_messages(Entries=messages)
@@ -228,13 +385,19 @@ class Alchemist:
         count = 0
         messages = []
         sys.stdout.write("\rAdding messages...")
-        for dataset in datasets:
-            message = {
-                "Id": str(count),
-                "MessageBody": json.dumps(
-                    {"id": str(dataset.id), "transform": self.transform_name}
-                ),
-            }
+        for group in self._grouped(datasets):
+            # A group of datasets is one message, named by the last of them
+            dataset = group[-1]
+            body = {"id": str(dataset.id), "transform": self.transform_name}
+            if self.config.specification.group is not None:
+                body["group"] = [str(member.id) for member in group]
+            body = json.dumps(body)
+            message = {"Id": str(count), "MessageBody": body}
+            if grouped:
+                message["MessageGroupId"] = region_code(dataset)
+                message["MessageDeduplicationId"] = hashlib.sha256(
+                    body.encode()
+                ).hexdigest()
             messages.append(message)
 
             count += 1
@@ -248,31 +411,102 @@ class Alchemist:
 
         return count
 
+    def _grouped(self, datasets: Iterable[Dataset]) -> Iterable[list[Dataset]]:
+        # The specification's groups of datasets, or each dataset on its own
+        if self.config.specification.group is None:
+            return ([dataset] for dataset in datasets)
+        return group_datasets(datasets, self.config.specification.group.window_days)
+
     # Task related functions
-    def generate_task(self, dataset) -> AlchemistTask:
-        return AlchemistTask(dataset=dataset, settings=self.config)
+    def generate_task(self, dataset, group: Sequence[Dataset] = ()) -> AlchemistTask:
+        # A group of one is the same as a task of just that dataset
+        return AlchemistTask(
+            dataset=dataset,
+            settings=self.config,
+            group=list(group) if len(group) > 1 else [],
+        )
 
     def generate_task_by_uuid(self, uuid: str) -> AlchemistTask:
         # Retrieve a task based on a UUID, or none if it doesn't exist for input product(s)
-        dataset = self._find_dataset(uuid)
-        if dataset:
-            return AlchemistTask(dataset=dataset, settings=self.config)
+        return self.generate_task_by_uuids([uuid])
+
+    def generate_task_by_uuids(self, uuids: Sequence[str]) -> Optional[AlchemistTask]:
+        """
+        A task of a group of datasets, in time order, or None if any of them don't
+        exist for the input product(s)
+        """
+        metrics = TaskMetrics()
+        with metrics.stage("lookup"):
+            datasets = [self._find_dataset(uuid) for uuid in uuids]
+        if all(datasets):
+            task = self.generate_task(datasets[-1], datasets)
+            task.metrics = metrics
+            return task
         return None
 
-    def generate_tasks(self, query, limit=None) -> Iterable[AlchemistTask]:
+    def generate_tasks(
+        self,
+        query,
+        limit=None,
+        shard: Optional[tuple[int, int]] = None,
+        shard_by: str = "id",
+        order: str = "index",
+    ) -> Iterable[AlchemistTask]:
         # Find which datasets needs to be processed
-        datasets = self._find_datasets(query, limit)
+        if shard is None:
+            datasets = self._find_datasets(query, limit)
+        else:
+            # Groups are within a tile, so sharding by tile keeps them whole
+            if self.config.specification.group is not None:
+                shard_by = "region"
+            # The limit applies to this shard, not to the whole search
+            datasets = itertools.islice(
+                shard_datasets(self._find_datasets(query), *shard, by=shard_by), limit
+            )
+        if order != "index":
+            datasets = order_datasets(datasets, by=order)
 
-        return (self.generate_task(ds) for ds in datasets)
+        return (
+            self.generate_task(group[-1], group) for group in self._grouped(datasets)
+        )
 
     # Queue related functions
+    def filter_datasets(
+        self, datasets: Iterable[Dataset], searched: Optional[Mapping] = None
+    ) -> Iterable[Dataset]:
+        """
+        The datasets that pass the specification's filter, if it has one
+
+        :param searched: the filter's search query that the datasets were found with
+        """
+        if self.dataset_filter is None:
+            return datasets
+        return self.dataset_filter(datasets, searched=searched)
+
+    def _log_filtered(self) -> None:
+        if self.dataset_filter is not None:
+            dropped = self.dataset_filter.dropped
+            _LOG.info(f"Filtered out {sum(dropped.values())} datasets", **dict(dropped))
+
     def enqueue_datasets(
-        self, queue, query, limit=None, product_limit=None, dryrun=False
+        self, queue, query, limit=None, product_limit=None, dryrun=False, order="index"
     ):
-        datasets = self._find_datasets(query, limit, product_limit)
-        if not dryrun:
-            return self.datasets_to_queue(queue, datasets)
-        return sum(1 for _ in datasets)
+        # The filter's terms go in the search, so the index drops most datasets
+        if self.dataset_filter is not None:
+            query = self.dataset_filter.search_query(query)
+        datasets = self.filter_datasets(
+            self._find_datasets(query, limit, product_limit),
+            searched=query if self.dataset_filter is not None else None,
+        )
+        if order != "index":
+            datasets = order_datasets(datasets, by=order)
+        count = (
+            sum(1 for _ in datasets)
+            if dryrun
+            else self.datasets_to_queue(queue, datasets)
+        )
+        self._log_filtered()
+        return count
 
     def find_unprocessed_datasets(self, queue, dryrun):
         """
@@ -352,111 +586,292 @@ class Alchemist:
             dataset_assembler.cancel()
         return output_product
 
-    def get_tasks_from_queue(self, queue, limit, queue_timeout):
+    def get_tasks_from_queue(
+        self, queue, limit, queue_timeout, messages_per_request: int = 1
+    ):
         """Retrieve messages from the named queue, returning an iterable of (AlchemistTasks, SQS Messages)"""
         alive_queue = get_queue(queue)
-        messages = get_messages(alive_queue, limit, visibility_timeout=queue_timeout)
+        messages = get_messages(
+            alive_queue,
+            limit,
+            visibility_timeout=queue_timeout,
+            messages_per_request=messages_per_request,
+        )
 
+        # The message each output was first taken from, as standard SQS queues and
+        # re-enqueueing can deliver the same dataset more than once
+        taken = {}
         for message in messages:
-            message_body = json.loads(message.body)
-            uuid = message_body.get("id", None)
-            if uuid is None:
-                # This is probably a message created from an SNS, so it's double
-                # JSON dumped
-                message_body = json.loads(message_body["Message"])
-            transform = message_body.get("transform", None)
-
-            if transform and transform != self.transform_name:
-                _LOG.error(
-                    f"Your transform doesn't match the transform in the message. Ignoring {uuid}"
+            task = self.generate_task_from_message(json.loads(message.body))
+            if not task:
+                continue
+            output_uuid = self.output_uuid(task)
+            first = taken.setdefault(output_uuid, message.message_id)
+            if first != message.message_id:
+                _LOG.info(
+                    "Deleting a duplicate message",
+                    dataset_id=str(task.dataset.id),
+                    output_uuid=str(output_uuid),
                 )
+                message.delete()
                 continue
+            yield task, message
 
-            try:
-                # First try the simple case that the JSON object has an ODC ID
-                task = self.generate_task_by_uuid(message_body["id"])
-            except ValueError:
-                # If that fails, try doing a standard STAC transform and getting an ID from that
-                _LOG.info("Couldn't find dataset by UUID, trying another way")
-                message_transformed = stac_transform(message_body)
-                task = self.generate_task_by_uuid(message_transformed["id"])
-            if task:
-                yield task, message
+    def generate_task_from_message(self, message_body: dict) -> Optional[AlchemistTask]:
+        """
+        The task for a message: a dataset ID, the IDs of a group, or a STAC item,
+        perhaps wrapped in an SNS notification. None if there's no such task.
+        """
+        uuid = message_body.get("id")
+        if uuid is None:
+            # This is probably a message created from an SNS, so it's double
+            # JSON dumped
+            message_body = json.loads(message_body["Message"])
+        transform = message_body.get("transform")
+
+        if transform and transform != self.transform_name:
+            _LOG.error(
+                f"Your transform doesn't match the transform in the message. Ignoring {uuid}"
+            )
+            return None
+
+        try:
+            # First try the simple case that the JSON object has an ODC ID, or
+            # the IDs of a group
+            return self.generate_task_by_uuids(
+                message_body.get("group") or [message_body["id"]]
+            )
+        except ValueError:
+            # If that fails, try doing a standard STAC transform and getting an ID from that
+            _LOG.info("Couldn't find dataset by UUID, trying another way")
+            message_transformed = stac_transform(message_body)
+            return self.generate_task_by_uuid(message_transformed["id"])
+
+    def warm_up(self) -> None:
+        """
+        Connect to the index, look up the input products, import the transform and
+        set up reading, so that the first task doesn't wait for any of them
+        """
+        _ = self.input_products
+        _ = self.transform
+        _ = self._transform_info
+        self._configure_s3_access()
 
     # Task execution
-    def execute_task(
-        self, task: AlchemistTask, dryrun: bool = False, sns_arn: Optional[str] = None
+    def accepts(self, dataset: Dataset) -> bool:
+        """Whether the dataset belongs to one of this Alchemist's input products"""
+        spec = self.config.specification
+        names = [spec.product] if spec.product else list(spec.products or [])
+        return dataset.type.name in names
+
+    def accepts_task(self, task: AlchemistTask) -> bool:
+        """Whether every source dataset of the task is one of this Alchemist's inputs"""
+        return all(self.accepts(dataset) for dataset in task.datasets)
+
+    def load_data(
+        self,
+        task: AlchemistTask,
+        dryrun: bool = False,
+        measurements: Optional[Sequence[str]] = None,
     ):
-        log = _LOG.bind(task=task.dataset.id)
-        log.info("Task commencing", task=task)
+        """Lazily load the task's source data, timed as the "load" stage"""
+        if measurements is None:
+            measurements = task.settings.specification.measurements
+
+        self._configure_s3_access()
 
+        # Load and process data in a decimated array
+        with task.metrics.stage("load"):
+            if dryrun:
+                res_by_ten = self._native_resolution(task) * 10
+                return self.dc.load(
+                    datasets=task.datasets,
+                    measurements=measurements,
+                    output_crs=task.dataset.crs,
+                    resolution=(-1 * res_by_ten, res_by_ten),
+                    resampling=task.settings.specification.resampling,
+                )
+            if not task.group:
+                return native_load(
+                    task.dataset,
+                    measurements=measurements,
+                    dask_chunks=task.settings.processing.dask_chunks,
+                    basis=task.settings.specification.basis,
+                    resampling=task.settings.specification.resampling,
+                )
+            # A group is on the grid of its last dataset, and loaded in one go with
+            # a time dimension. Scenes of a tile share its grid, so nothing is
+            # reprojected and each file is only opened once.
+            return datacube.Datacube.load_data(
+                datacube.Datacube.group_datasets(task.group, "time"),
+                native_geobox(
+                    task.dataset,
+                    measurements,
+                    basis=task.settings.specification.basis,
+                ),
+                measurements=task.dataset.product.lookup_measurements(measurements),
+                dask_chunks=task.settings.processing.dask_chunks,
+                resampling=task.settings.specification.resampling,
+            )
+
+    def prepare_transform(self, task: AlchemistTask, data):
+        """Prepare the transform's lazy output from the loaded source data"""
         # Make sure our task makes sense and store it
         if task.settings.specification.transform != self.transform_name:
             raise ValueError("Task transform is different to the Alchemist transform")
         transform = self._transform_with_args(task)
 
-        # Ensure output path exists, this should be fine for file or s3 paths
-        s3_destination = False
-        try:
-            s3_url_parse(task.settings.output.location)
-            s3_destination = True
-        except ValueError:
-            pass
+        data = data.rename(task.settings.specification.measurement_renames)
+        # Data is lazy, so this is the decoded size of what compute will read
+        task.metrics.bytes_read = data.nbytes
 
-        # Load and process data in a decimated array
-        if dryrun:
-            res_by_ten = self._native_resolution(task) * 10
-            data = self.dc.load(
-                product=task.dataset.type.name,
-                id=task.dataset.id,
-                measurements=task.settings.specification.measurements,
-                output_crs=task.dataset.crs,
-                resolution=(-1 * res_by_ten, res_by_ten),
-                resampling=task.settings.specification.resampling,
-            )
-        else:
-            data = native_load(
-                task.dataset,
-                measurements=task.settings.specification.measurements,
-                dask_chunks=task.settings.processing.dask_chunks,
-                basis=task.settings.specification.basis,
-                resampling=task.settings.specification.resampling,
+        with task.metrics.stage("graph"):
+            output_data = transform.compute(data)
+            if "time" in output_data.dims:
+                output_data = output_data.squeeze("time")
+            # Before it's summarised, so the statistics are of what's written
+            return _writable_dtypes(output_data)
+
+    def summarise(self, task: AlchemistTask, output_data) -> dict:
+        """
+        Summarise the bands of the lazy output, to compute along with it, for the
+        valid-data footprint and, if they're wanted, their statistics
+        """
+        return summarise(
+            output_data,
+            nodata=task.settings.output.nodata,
+            statistics=task.settings.output.band_statistics,
+        )
+
+    def precheck(self, task: AlchemistTask) -> Optional[str]:
+        """
+        Why the task's dataset fails ``processing.precheck``, such as being too
+        cloudy, or None if it passes or there isn't one
+        """
+        settings = task.settings.processing.precheck
+        if settings is None:
+            return None
+        self._configure_s3_access()
+        with task.metrics.stage("precheck"):
+            return precheck(
+                task.dataset, settings, basis=task.settings.specification.basis
             )
-        data = data.rename(task.settings.specification.measurement_renames)
 
-        log.info("Data loaded")
+    def short_circuit(
+        self,
+        task: AlchemistTask,
+        reason: str,
+        dryrun: bool = False,
+        sns_arn: Optional[str] = None,
+    ) -> tuple:
+        """
+        Deal with a task that failed its precheck, by skipping it or writing an
+        output of nodata, without loading or transforming its source. Skipped tasks
+        have a ``(None, None)`` result.
+        """
+        log = _LOG.bind(task=task.dataset.id, reason=reason)
+        measurements = self._output_measurements(task)
+        if task.settings.processing.precheck.action == "empty":
+            if measurements is not None:
+                log.info("Writing an empty output")
+                output_data = _writable_dtypes(
+                    empty_output(
+                        task.dataset,
+                        measurements,
+                        task.settings.specification.measurements,
+                        basis=task.settings.specification.basis,
+                    )
+                )
+                task.metrics.outcome = "empty"
+                # Without waiting for scratch space, as nodata compresses to
+                # next to nothing
+                return self.write_output(
+                    task,
+                    output_data,
+                    output_data.crs,
+                    dryrun=dryrun,
+                    sns_arn=sns_arn,
+                    summaries=summarise(output_data, task.settings.output.nodata),
+                )
+            log.warning("The transform can't describe an empty output, so skipping")
+
+        log.info("Skipping task")
+        task.metrics.outcome = "skipped"
+        return None, None
+
+    def execute_task(
+        self, task: AlchemistTask, dryrun: bool = False, sns_arn: Optional[str] = None
+    ):
+        log = _LOG.bind(task=task.dataset.id)
+        log.info("Task commencing", task=task)
+        task.metrics.begin()
+
+        reason = self.precheck(task)
+        if reason is not None:
+            result = self.short_circuit(task, reason, dryrun, sns_arn)
+            self.record_metrics(task, log)
+            return result
 
-        output_data = transform.compute(data)
-        if "time" in output_data.dims:
-            output_data = output_data.squeeze("time")
+        # Wait for room to write the output before spending anything on the task
+        with self.reserve_scratch(task, dryrun):
+            data = self.load_data(task, dryrun)
+            log.info("Data loaded")
 
-        log.info("Prepared lazy transformation", output_data=output_data)
+            output_data = self.prepare_transform(task, data)
+            log.info("Prepared lazy transformation", output_data=output_data)
 
-        output_data = output_data.compute()
-        crs = data.attrs["crs"]
+            with task.metrics.stage("compute"):
+                output_data, summaries = dask.compute(
+                    output_data, self.summarise(task, output_data)
+                )
+            crs = data.attrs["crs"]
 
-        del data
-        log.info("Loaded and transformed")
+            del data
+            log.info("Loaded and transformed")
 
-        # Because"/env/lib/python3.6/site-packages/eodatasets3/images.py", line 489, in write_from_ndarray
-        # raise TypeError("Datatype not supported: {dt}".format(dt=dtype))
-        # TODO: investigate if this is ok
-        dtypes = {str(v.dtype) for v in output_data.data_vars.values()}
-        if "int8" in dtypes:
-            log.info(
-                "Found dtype=int8 in output data, converting to uint8 for geotiffs"
+            dataset_id, metadata_path = self.write_output(
+                task,
+                output_data,
+                crs,
+                dryrun=dryrun,
+                sns_arn=sns_arn,
+                summaries=summaries,
             )
-            output_data = output_data.astype("uint8", copy=False)
+        self.record_metrics(task, log)
+        return dataset_id, metadata_path
+
+    def write_output(
+        self,
+        task: AlchemistTask,
+        output_data,
+        crs,
+        dryrun: bool = False,
+        sns_arn: Optional[str] = None,
+        summaries: Optional[dict] = None,
+    ):
+        """
+        Assemble computed output data as a dataset and move it into place, using
+        the bands' ``summaries`` from ``summarise`` for the valid-data footprint
+        and statistics if they're given
+        """
+        log = _LOG.bind(task=task.dataset.id)
+        metrics = task.metrics
+
+        s3_destination = _is_s3_url(task.settings.output.location)
+
+        output_data = _writable_dtypes(output_data)
 
         if "crs" not in output_data.attrs:
             output_data.attrs["crs"] = crs
 
         uuid, _ = self._deterministic_uuid(task)
 
-        # Write it all to a tempdir root, and then either shift or s3 sync it into place
+        # Write it all to a tempdir root, and then either rename or s3 sync it into place
         with (
-            tempfile.TemporaryDirectory() as temp_dir,
-            DatasetAssembler(
+            tempfile.TemporaryDirectory(
+                prefix=".alchemist-", dir=self._staging_root(task, dryrun)
+            ) as temp_dir,
+            Assembler(
                 collection_location=Path(temp_dir),
                 naming_conventions=self.naming_convention,
                 dataset_id=uuid,
@@ -466,6 +881,12 @@ class Alchemist:
             # Organise metadata
             #
             if task.settings.output.reference_source_dataset:
+                # The lineage is every source, but only the last is inherited from
+                for source in task.group[:-1]:
+                    dataset_assembler.add_source_dataset(
+                        _munge_dataset_to_eo3(source),
+                        classifier=task.settings.specification.override_product_family,
+                    )
                 source_doc = _munge_dataset_to_eo3(task.dataset)
                 dataset_assembler.add_source_dataset(
                     source_doc,
@@ -509,20 +930,50 @@ class Alchemist:
             #
             # Write out the data and ancillaries
             #
-            dataset_assembler.write_measurements_odc_xarray(
-                output_data,
-                nodata=task.settings.output.nodata,
-                **task.settings.output.write_data_settings,
-            )
-            log.info("Finished writing measurements")
+            write_data_settings = dict(task.settings.output.write_data_settings)
+            if summaries and write_data_settings.get("expand_valid_data", True):
+                # The footprint's already known, so the assembler needn't work
+                # it out from every band
+                write_data_settings["expand_valid_data"] = False
+                if dataset_assembler.geometry is None:
+                    dataset_assembler.geometry = footprint(
+                        summaries.values(), GridSpec.from_odc_xarray(output_data)
+                    )
+            if summaries and task.settings.output.band_statistics:
+                nodata = task.settings.output.nodata
+                for name, summary in summaries.items():
+                    dataarray = output_data[name]
+                    dataset_assembler.note_raster_band(
+                        name,
+                        raster_band(
+                            summary,
+                            "uint8" if dataarray.dtype == bool else dataarray.dtype,
+                            dataarray.attrs.get("nodata") if nodata is None else nodata,
+                        ),
+                    )
 
-            # Write out the thumbnail
-            _write_thumbnail(task, dataset_assembler)
-            log.info("Wrote thumbnail")
+            thumbnail = _thumbnail_path(task, dataset_assembler)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # The thumbnail is rendered from the computed data while the
+                # measurements are encoded, and only noted once they're done
+                rendering = thumbnail and executor.submit(
+                    _write_thumbnail, task, thumbnail[0], output_data
+                )
+                with metrics.stage("encode"):
+                    write_measurements(
+                        dataset_assembler,
+                        output_data,
+                        nodata=task.settings.output.nodata,
+                        **write_data_settings,
+                    )
+                log.info("Finished writing measurements")
 
-            # Do all the deferred work from above
-            dataset_id, metadata_path = dataset_assembler.done()
-            log.info("Assembled dataset", metadata_path=metadata_path)
+                if rendering:
+                    # Only the time spent waiting for it after the encoding
+                    with metrics.stage("thumbnail"):
+                        dataset_assembler.note_hash(thumbnail[0], rendering.result())
+                    dataset_assembler.note_thumbnail(*thumbnail)
+                    log.info("Wrote thumbnail")
 
             #
             # Organise paths for final output information
@@ -533,17 +984,18 @@ class Alchemist:
                 f"{task.settings.output.location.rstrip('/')}/{relative_path}"
             )
 
-            # Write STAC, because it depends on this being .done()
-            # Conveniently, this also checks that files are there!
-            stac = None
+            # The STAC item is made from the metadata as it's written, and is
+            # checksummed along with everything else
             if task.settings.output.write_stac:
-                stac = _write_stac(
-                    metadata_path,
-                    destination_path,
-                    task.settings.output.explorer_url,
-                    dataset_assembler,
+                dataset_assembler.note_stac(
+                    destination_path, task.settings.output.explorer_url
                 )
-                log.info("STAC file written")
+
+            with metrics.stage("metadata"):
+                dataset_id, metadata_path = dataset_assembler.done()
+            log.info("Assembled dataset", metadata_path=metadata_path)
+            stac = dataset_assembler.stac
+            metrics.bytes_written = directory_size(dataset_location)
 
             if s3_destination:
                 s3_command = [
@@ -566,15 +1018,15 @@ class Alchemist:
                     )
 
                 log.info("Writing files to s3", location=destination_path)
-                subprocess.run(" ".join(s3_command), shell=True, check=True)
+                with metrics.stage("upload"):
+                    subprocess.run(" ".join(s3_command), shell=True, check=True)
             else:
                 destination_path = Path(destination_path)
                 if not dryrun:
                     log.info("Writing files to disk", location=destination_path)
                     # This should perhaps be couched in a warning as it delete important files
-                    if destination_path.exists():
-                        shutil.rmtree(destination_path)
-                    shutil.copytree(dataset_location, destination_path)
+                    with metrics.stage("upload"):
+                        _move_into_place(dataset_location, destination_path)
                 else:
                     log.warning(
                         f"DRYRUN: not moving data from {dataset_location} to {destination_path}"
@@ -583,8 +1035,327 @@ class Alchemist:
             log.info("Task complete")
             if stac is not None and sns_arn:
                 if not dryrun:
-                    _stac_to_sns(sns_arn, stac)
+                    # It's sent in the background, so the next task can start
+                    with metrics.stage("publish"):
+                        task.published.append(publisher(sns_arn).publish(stac))
             elif sns_arn:
                 _LOG.error("Not posting to SNS because there's no STAC to post")
 
         return dataset_id, metadata_path
+
+    def _staging_root(self, task: AlchemistTask, dryrun: bool) -> Path:
+        """
+        Where to assemble the dataset. Local outputs are staged on the same filesystem
+        as the output location, so they can be renamed into place rather than copied.
+        """
+        if not dryrun and not _is_s3_url(task.settings.output.location):
+            location = Path(task.settings.output.location)
+            try:
+                location.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                _LOG.warning(
+                    "Can't stage next to the output location, using scratch instead",
+                    task=task.dataset.id,
+                    error=str(e),
+                )
+            else:
+                return location
+        scratch = Path(task.settings.processing.scratch_dir or tempfile.gettempdir())
+        scratch.mkdir(parents=True, exist_ok=True)
+        return scratch
+
+    def _input_measurements(self, task: AlchemistTask) -> dict[str, Measurement]:
+        """The source measurements the transform gets, by their renamed names"""
+        spec = task.settings.specification
+        product_measurements = task.dataset.type.measurements
+        return {
+            (spec.measurement_renames or {}).get(name, name): product_measurements[name]
+            for name in spec.measurements
+            if name in product_measurements
+        }
+
+    def _output_measurements(
+        self, task: AlchemistTask
+    ) -> Optional[dict[str, Measurement]]:
+        """
+        The measurements of the task's output, or None if the transform can't
+        describe them without data
+        """
+        # Transform arguments only vary by product, so neither does the output
+        product = task.dataset.type.name
+        if product not in self._output_measurements_by_product:
+            try:
+                measurements = self._transform_with_args(task).measurements(
+                    self._input_measurements(task)
+                )
+            except (NotImplementedError, KeyError, AttributeError):
+                measurements = None
+            self._output_measurements_by_product[product] = measurements
+        return self._output_measurements_by_product[product]
+
+    def _output_pixel_bytes(self, task: AlchemistTask) -> int:
+        """The bytes per pixel of the task's output, across all its measurements"""
+        # Not every transform can describe its output without data, so fall back
+        # to the size of its input
+        measurements = self._output_measurements(task) or self._input_measurements(task)
+        return sum(np.dtype(m.dtype).itemsize for m in measurements.values())
+
+    def _estimate_output_bytes(self, task: AlchemistTask) -> int:
+        """
+        The uncompressed size of the task's output and its overviews, which is an
+        upper bound on what assembling it will write to scratch
+        """
+        spec = task.settings.specification
+        basis = spec.basis or next(iter(task.dataset.measurements.keys()))
+        geobox = native_geobox(task.dataset, basis=basis)
+        return int(
+            geobox.width
+            * geobox.height
+            * self._output_pixel_bytes(task)
+            * _OVERVIEW_OVERHEAD
+        )
+
+    def scratch_needed(
+        self, task: AlchemistTask, dryrun: bool = False
+    ) -> Optional[tuple[Path, int, float]]:
+        """
+        Where the task's output is assembled, how many bytes it needs there and how
+        long to wait for them, or None if ``processing.scratch_admission_timeout``
+        isn't set
+        """
+        timeout = task.settings.processing.scratch_admission_timeout
+        if timeout is None:
+            return None
+        return (
+            self._staging_root(task, dryrun),
+            self._estimate_output_bytes(task),
+            timeout,
+        )
+
+    def reserve_scratch(self, task: AlchemistTask, dryrun: bool = False):
+        """
+        Hold a reservation of scratch space for the task's output while it runs, if
+        ``processing.scratch_admission_timeout`` is set
+        """
+        return _reserve_scratch([(task, self.scratch_needed(task, dryrun))])
+
+    def record_metrics(self, task: AlchemistTask, log) -> None:
+        self.outcomes[task.metrics.outcome] += 1
+        summary = task.metrics.summary()
+        log.info("Task summary", **summary)
+
+        if task.settings.processing.metrics_textfile:
+            write_prometheus_textfile(
+                textfile_path(
+                    task.settings.processing.metrics_textfile, self.transform_name
+                ),
+                task.metrics,
+                labels={
+                    "transform": self.transform_name,
+                    "product": task.dataset.type.name,
+                    "pid": os.getpid(),
+                },
+                outcomes=self.outcomes,
+            )
+
+
+class AlchemistGroup:
+    """
+    Several Alchemists which run over the same source datasets, such as WOfS and FC
+    over Landsat ARD.
+
+    Each source dataset is loaded once with the union of the measurements every
+    transform needs, all the transforms are computed together on that shared data,
+    and then each output is assembled and published separately.
+    """
+
+    def __init__(self, alchemists: Sequence[Alchemist]):
+        if not alchemists:
+            raise ValueError("An AlchemistGroup needs at least one Alchemist")
+        self.alchemists = list(alchemists)
+
+    @classmethod
+    def with_config_files(
+        cls, primary: Alchemist, config_files: Sequence[str]
+    ) -> "AlchemistGroup":
+        """Group the primary Alchemist with others, which share its index connection"""
+        others = [
+            # Share the connection if there is one, but don't connect just for this
+            Alchemist(config_file=config_file, dc=primary._dc)  # noqa: SLF001
+            for config_file in config_files
+        ]
+        return cls([primary, *others])
+
+    @property
+    def primary(self) -> Alchemist:
+        """The Alchemist that finds datasets and reads the queue for the group"""
+        return self.alchemists[0]
+
+    def _tasks_for(self, task: AlchemistTask) -> list[tuple[Alchemist, AlchemistTask]]:
+        pairs = [(self.primary, task)]
+        for alchemist in self.alchemists[1:]:
+            if alchemist.accepts_task(task):
+                pairs.append(
+                    (alchemist, alchemist.generate_task(task.dataset, task.group))
+                )
+            else:
+                _LOG.info(
+                    "Dataset is not an input of transform, skipping it",
+                    task=task.dataset.id,
+                    transform=alchemist.transform_name,
+                )
+        return pairs
+
+    @staticmethod
+    def _load_key(task: AlchemistTask) -> str:
+        # Tasks can only share a load if they'd load the same pixels
+        return json.dumps(
+            [
+                task.settings.specification.basis,
+                task.settings.specification.resampling,
+                task.settings.processing.dask_chunks,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+    def execute_task(
+        self, task: AlchemistTask, dryrun: bool = False, sns_arn: Optional[str] = None
+    ) -> list[tuple]:
+        """
+        Run a task of the primary Alchemist and the equivalent task of every other
+        Alchemist that accepts its dataset, returning their ``(dataset_id,
+        metadata_path)`` in order. If any fail, the others still run and the first
+        error is raised at the end.
+        """
+        log = _LOG.bind(task=task.dataset.id)
+        pairs = self._tasks_for(task)
+        log.info("Group task commencing", transforms=len(pairs))
+        for _, pair_task in pairs:
+            pair_task.metrics.begin()
+
+        results = {}
+        errors = []
+        remaining = self._precheck_pairs(pairs, dryrun, sns_arn, log, results, errors)
+        # One reservation for all the outputs, so concurrent groups can't each hold
+        # some of the space while waiting on the rest
+        needs = [
+            (pair_task, alchemist.scratch_needed(pair_task, dryrun))
+            for alchemist, pair_task in remaining
+        ]
+        with _reserve_scratch(needs):
+            self._execute_pairs(remaining, dryrun, sns_arn, log, results, errors)
+
+        # The caller only has the primary task to wait on
+        for _, pair_task in pairs[1:]:
+            task.published.extend(pair_task.published)
+        if errors:
+            raise errors[0]
+        return [results[id(pair_task)] for _, pair_task in pairs]
+
+    def _precheck_pairs(self, pairs, dryrun, sns_arn, log, results, errors) -> list:
+        """
+        Short circuit the pairs that fail their precheck, returning the rest, and
+        collecting results and errors as it goes
+        """
+        remaining = []
+        for alchemist, pair_task in pairs:
+            transform_log = log.bind(transform=alchemist.transform_name)
+            try:
+                reason = alchemist.precheck(pair_task)
+                if reason is None:
+                    remaining.append((alchemist, pair_task))
+                    continue
+                results[id(pair_task)] = alchemist.short_circuit(
+                    pair_task, reason, dryrun=dryrun, sns_arn=sns_arn
+                )
+            except Exception as e:
+                transform_log.exception("Failed to precheck")
+                errors.append(e)
+                continue
+            alchemist.record_metrics(pair_task, transform_log)
+        return remaining
+
+    def _execute_pairs(self, pairs, dryrun, sns_arn, log, results, errors) -> None:
+        """Load, compute and write the pairs, collecting results and errors as it goes"""
+        loads = {}
+        for pair in pairs:
+            loads.setdefault(self._load_key(pair[1]), []).append(pair)
+
+        for group in loads.values():
+            measurements = list(
+                dict.fromkeys(
+                    m
+                    for _, pair_task in group
+                    for m in pair_task.settings.specification.measurements
+                )
+            )
+            first_alchemist, first_task = group[0]
+            try:
+                data = first_alchemist.load_data(first_task, dryrun, measurements)
+            except Exception as e:
+                log.exception("Failed to load data", measurements=measurements)
+                errors.append(e)
+                continue
+            log.info("Data loaded", measurements=measurements)
+            crs = data.attrs["crs"]
+
+            prepared = []
+            for alchemist, pair_task in group:
+                # Every task in the group shares the one load
+                pair_task.metrics.stages["load"] = first_task.metrics.stages["load"]
+                subset = data[list(pair_task.settings.specification.measurements)]
+                try:
+                    prepared.append(
+                        (
+                            alchemist,
+                            pair_task,
+                            alchemist.prepare_transform(pair_task, subset),
+                        )
+                    )
+                except Exception as e:
+                    log.exception(
+                        "Failed to prepare transform",
+                        transform=alchemist.transform_name,
+                    )
+                    errors.append(e)
+            del data
+
+            # Computing the outputs together means the source chunks are read once
+            start = time.perf_counter()
+            try:
+                computed = dask.compute(
+                    *(
+                        (output, alchemist.summarise(pair_task, output))
+                        for alchemist, pair_task, output in prepared
+                    )
+                )
+            except Exception as e:
+                log.exception("Failed to compute transforms")
+                errors.append(e)
+                continue
+            elapsed = time.perf_counter() - start
+            log.info("Loaded and transformed", transforms=len(prepared))
+
+            for (alchemist, pair_task, _), (output_data, summaries) in zip(
+                prepared, computed
+            ):
+                pair_task.metrics.stages["compute"] = elapsed
+                try:
+                    results[id(pair_task)] = alchemist.write_output(
+                        pair_task,
+                        output_data,
+                        crs,
+                        dryrun=dryrun,
+                        sns_arn=sns_arn,
+                        summaries=summaries,
+                    )
+                except Exception as e:
+                    log.exception(
+                        "Failed to write output", transform=alchemist.transform_name
+                    )
+                    errors.append(e)
+                    continue
+                alchemist.record_metrics(
+                    pair_task, log.bind(transform=alchemist.transform_name)
+                )
@@ -2,10 +2,18 @@ import json
 from collections.abc import Sequence
 from pathlib import Path
 
+import datacube
 import pytest
 from click.testing import CliRunner
 
 import datacube_alchemist.cli
+from benchmarks.synthetic import (
+    alchemist_settings,
+    index_synthetic_datasets,
+    memory_index_config,
+    write_synthetic_datasets,
+)
+from datacube_alchemist.worker import Alchemist
 
 
 @pytest.fixture
@@ -66,3 +74,32 @@ def config_file_bai_s2be():
 @pytest.fixture
 def config_file_3band_s2be():
     return Path(__file__).absolute().parent / "c3_config_dnbr_3band_s2be.yaml"
+
+
+@pytest.fixture
+def synthetic_alchemist(tmp_path):
+    """
+    A factory for an Alchemist over synthetic datasets in an in-memory index,
+    returning it along with the indexed datasets. Inputs are written to
+    ``tmp_path / "inputs"``, which ``location`` replaces in dataset URIs.
+    """
+
+    def _make(
+        count=1, size=64, bands=1, measurements=None, output="out", location=None
+    ):
+        inputs = tmp_path / "inputs"
+        docs = write_synthetic_datasets(inputs, count=count, size=size, bands=bands)
+        if location is not None:
+            docs = [
+                {**doc, "location": doc["location"].replace(inputs.as_uri(), location)}
+                for doc in docs
+            ]
+        dc = datacube.Datacube(
+            config=str(memory_index_config(tmp_path)), env="benchmark"
+        )
+        datasets = index_synthetic_datasets(dc, docs, bands=bands, dtype="uint16")
+        names = measurements or list(datasets[0].measurements)
+        config = alchemist_settings(tmp_path / output, names, chunk=size)
+        return Alchemist(config=config, dc=dc), datasets
+
+    return _make
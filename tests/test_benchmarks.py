@@ -0,0 +1,52 @@
+import json
+
+import structlog
+
+from benchmarks.bench_execute_task import main
+from benchmarks.bench_read_io import main as read_io_main
+
+
+def test_execute_task_benchmark(run_alchemist, tmp_path):
+    logging_config = structlog.get_config()
+    try:
+        result = run_alchemist(
+            [
+                "--size=256",
+                "--count=1",
+                f"--workdir={tmp_path}",
+                f"--json-output={tmp_path / 'results.json'}",
+            ],
+            cli_method=main,
+        )
+        # The benchmark silences logging while it runs, but mustn't leave it off
+        assert structlog.get_config()["processors"] == logging_config["processors"]
+    finally:
+        structlog.configure(**logging_config)
+
+    assert "Peak RSS" in result.output
+    assert (tmp_path / "results.json").exists()
+    assert list((tmp_path / "outputs").rglob("*.stac-item.json"))
+
+
+def test_read_io_benchmark(run_alchemist, tmp_path):
+    result = run_alchemist(
+        [
+            "--size=256",
+            "--count=1",
+            "--repeats=1",
+            "--latency=0",
+            f"--workdir={tmp_path}",
+            f"--json-output={tmp_path / 'results.json'}",
+        ],
+        cli_method=read_io_main,
+    )
+
+    assert "requests" in result.output
+    results = json.loads((tmp_path / "results.json").read_text())
+    assert {(r["source"], r["profile"]) for r in results} == {
+        ("file", "default"),
+        ("file", "tuned"),
+        ("http", "default"),
+        ("http", "tuned"),
+    }
+    assert all(r["requests"] > 0 for r in results if r["source"] == "http")
@@ -1,8 +1,84 @@
+import copy
+import errno
+import inspect
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
 import boto3
+import dask.array
+import numpy as np
+import pytest
+import rasterio
+import xarray as xr
+from affine import Affine
+from botocore.exceptions import ClientError
+from datacube import Datacube
+from datacube.model import Dataset, Range
+from datacube.testutils.io import native_load
+from eodatasets3 import DatasetAssembler, serialise
+from eodatasets3.images import FileWrite, GridSpec, MeasurementBundler
+from eodatasets3.scripts.tostac import dc_to_stac, json_fallback
+from eodatasets3.verify import PackageChecksum
 from moto import mock_aws
+from odc.aws.queue import get_messages
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from shapely.geometry import box, mapping
 
-from datacube_alchemist._utils import _stac_to_sns
-from datacube_alchemist.worker import Alchemist
+from benchmarks.bench_read_io import serve
+from benchmarks.synthetic import (
+    alchemist_settings,
+    index_synthetic_datasets,
+    memory_index_config,
+    write_synthetic_datasets,
+)
+from datacube_alchemist import worker
+from datacube_alchemist._assemble import RASTER_EXTENSION, Assembler
+from datacube_alchemist._cog import write_cog
+from datacube_alchemist._filter import DatasetFilter
+from datacube_alchemist._lease import FileLeases, S3Leases
+from datacube_alchemist._metrics import (
+    TaskMetrics,
+    textfile_path,
+    write_prometheus_textfile,
+)
+from datacube_alchemist._pool import execute_in_pool
+from datacube_alchemist._precheck import precheck, usable_fraction, valid_fraction
+from datacube_alchemist._prefetch import Prefetcher
+from datacube_alchemist._profiling import profile_task
+from datacube_alchemist._publish import SnsPublisher
+from datacube_alchemist._queue import get_queue, redrive
+from datacube_alchemist._scheduling import parse_shard, region_code
+from datacube_alchemist._scratch import reserve_space
+from datacube_alchemist._serve import AlchemistServer, submit
+from datacube_alchemist._serve import serve as serve_socket
+from datacube_alchemist._stats import footprint, raster_band, summarise
+from datacube_alchemist._thumbnail import colourise, write_thumbnail
+from datacube_alchemist._utils import (
+    FakeTransformation,
+    _move_into_place,
+    _stac_to_sns,
+)
+from datacube_alchemist.cli import _leased, _published
+from datacube_alchemist.settings import (
+    FilterSettings,
+    GroupSettings,
+    PrecheckSettings,
+)
+from datacube_alchemist.worker import Alchemist, AlchemistGroup
 
 TEST_QUEUE_NAME = "alchemist-test-queue"
 
@@ -35,7 +111,82 @@ def test_message_publish(stac_example):
         _stac_to_sns(topic_arn, stac_example)
 
 
-def test_empty_queue(run_alchemist, config_file):
+def test_sns_publisher_batches(stac_example, monkeypatch):
+    with mock_aws():
+        topic_arn = boto3.client("sns").create_topic(Name="test-topic")["TopicArn"]
+        sns_publisher = SnsPublisher(topic_arn, backoff=0)
+        client = sns_publisher._sns()  # noqa: SLF001
+        publish_batch = client.publish_batch
+        sending, sent = threading.Event(), threading.Event()
+        batches, messages = [], []
+        # The first entry of the second batch fails once, the third is rejected
+        failures = [{}, {"2": False}, {}, {"12": True}]
+
+        def flaky_publish_batch(TopicArn, PublishBatchRequestEntries):  # noqa: N803
+            sent.set()
+            sending.wait(10)
+            failing = failures.pop(0) if failures else {}
+            batches.append([entry["Id"] for entry in PublishBatchRequestEntries])
+            messages.extend(entry["Message"] for entry in PublishBatchRequestEntries)
+            response = publish_batch(
+                TopicArn=TopicArn,
+                PublishBatchRequestEntries=[
+                    entry
+                    for entry in PublishBatchRequestEntries
+                    if entry["Id"] not in failing
+                ],
+            )
+            response["Failed"] = [
+                {"Id": id_, "Code": "Failed", "SenderFault": sender_fault}
+                for id_, sender_fault in failing.items()
+            ]
+            return response
+
+        monkeypatch.setattr(client, "publish_batch", flaky_publish_batch)
+        # Documents published while the first is being sent are batched
+        futures = [sns_publisher.publish(stac_example)]
+        sent.wait(10)
+        futures += [sns_publisher.publish(stac_example) for _ in range(11)]
+        sending.set()
+        sns_publisher.flush()
+
+        assert batches == [
+            ["1"],
+            [str(i) for i in range(2, 12)],
+            ["2"],
+            ["12"],
+        ]
+        assert json.loads(messages[0]) == stac_example
+        assert "\n" not in messages[0] and ", " not in messages[0]
+        # Each document's future has its own outcome, so its task can be failed
+        assert all(future.result() for future in futures[:-1])
+        with pytest.raises(ClientError):
+            futures[-1].result()
+
+
+def test_published_results():
+    sent, failed, sending = Future(), Future(), Future()
+    sent.set_result("1")
+    failed.set_exception(ValueError("rejected"))
+    tasks = [SimpleNamespace(published=futures) for futures in ([sent], [failed], [])]
+    tasks.append(SimpleNamespace(published=[sending]))
+    error = RuntimeError("task failed")
+    results = [(task, None, None) for task in tasks] + [(tasks[2], None, error)]
+
+    published = _published(result for result in results)
+    # A result is held back until its documents are sent, and then has their error
+    assert [next(published)[0] for _ in range(3)] == tasks[:3]
+    assert next(published)[2] is error
+    sending.set_result("2")
+    assert next(published) == (tasks[3], None, None)
+    assert [result[2] for result in _published(r for r in results[:2])] == [
+        None,
+        failed.exception(),
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_empty_queue(run_alchemist, config_file, workers):
     with mock_aws():
         sqs = boto3.resource("sqs")
         sqs.create_queue(QueueName=TEST_QUEUE_NAME)
@@ -45,6 +196,7 @@ def test_empty_queue(run_alchemist, config_file):
                 "run-from-queue",
                 f"--config-file={config_file}",
                 f"--queue={TEST_QUEUE_NAME}",
+                f"--workers={workers}",
             ]
         )
         print(result)
@@ -68,3 +220,975 @@ def test_help_message(run_alchemist):
 
     result = run_alchemist(["redrive-to-queue", "--help"])
     print(result)
+
+    result = run_alchemist(["serve", "--help"])
+    print(result)
+
+
+def test_prometheus_textfile(tmp_path):
+    metrics = TaskMetrics()
+    metrics.begin()
+    with metrics.stage("load"):
+        pass
+    metrics.bytes_read = 1024
+
+    textfile = tmp_path / "alchemist.prom"
+    write_prometheus_textfile(
+        textfile,
+        metrics,
+        labels={"product": "ga_ls_wo_3"},
+        outcomes={"written": 3, "skipped": 2},
+    )
+
+    contents = textfile.read_text()
+    assert 'alchemist_task_stage_seconds{product="ga_ls_wo_3",stage="load"}' in contents
+    assert 'alchemist_task_bytes_read{product="ga_ls_wo_3"} 1024' in contents
+    assert 'alchemist_tasks_total{product="ga_ls_wo_3",outcome="skipped"} 2' in contents
+
+
+def test_textfile_path_per_process_and_transform():
+    wofs = textfile_path(
+        "/metrics/alchemist.prom", "wofs.virtualproduct.WOfSClassifier"
+    )
+    fc = textfile_path("/metrics/alchemist.prom", "fc.virtualproduct.FractionalCover")
+    assert wofs != fc
+    assert wofs.parent == fc.parent == Path("/metrics")
+    assert (
+        wofs.name == f"alchemist.wofs_virtualproduct_WOfSClassifier.{os.getpid()}.prom"
+    )
+
+
+def test_profile_task(tmp_path):
+    with profile_task("never-sampled", str(tmp_path), rate=0):
+        pass
+    assert not list(tmp_path.iterdir())
+
+    with profile_task("some-dataset-id", str(tmp_path / "profiles")):
+        sum(range(1000))
+    assert (tmp_path / "profiles" / "some-dataset-id.prof").exists()
+
+
+def test_cli_import_is_lightweight():
+    # Keep CLI startup fast: heavy dependencies are only imported by the commands
+    # that use them.
+    heavy = [
+        "datacube",
+        "eodatasets3",
+        "odc.apps.dc_tools",
+        "boto3",
+        "fsspec",
+        "psycopg2",
+    ]
+    script = f"import sys, datacube_alchemist.cli; print([m for m in {heavy!r} if m in sys.modules])"
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_alchemist_defers_index_connection(config_file):
+    alchemist = Alchemist(config_file=config_file)
+    assert alchemist._dc is None  # noqa: SLF001
+
+
+def test_alchemist_group_shares_load(synthetic_alchemist, tmp_path):
+    first, [dataset] = synthetic_alchemist(bands=3, output="a")
+    second_config = alchemist_settings(tmp_path / "b", ["band_01"], 64)
+    second_config.output.metadata = {
+        **second_config.output.metadata,
+        "product_family": "second",
+    }
+    second = Alchemist(config=second_config, dc=first.dc)
+
+    results = AlchemistGroup([first, second]).execute_task(first.generate_task(dataset))
+
+    assert len(results) == 2
+    assert len(list((tmp_path / "a").rglob("*.tif"))) == 3
+    assert len(list((tmp_path / "b").rglob("*.tif"))) == 1
+
+
+def test_alchemist_group_reserves_once(synthetic_alchemist, tmp_path, monkeypatch):
+    first, [dataset] = synthetic_alchemist(bands=2, output="a")
+    second_config = alchemist_settings(tmp_path / "a", ["band_02"], 64)
+    second_config.output.metadata = {
+        **second_config.output.metadata,
+        "product_family": "second",
+    }
+    second = Alchemist(config=second_config, dc=first.dc)
+    for alchemist in (first, second):
+        alchemist.config.processing.scratch_admission_timeout = 0
+
+    reservations = []
+
+    @contextmanager
+    def record(directory, nbytes, timeout):
+        reservations.append(nbytes)
+        yield
+
+    monkeypatch.setattr(worker, "reserve_space", record)
+    task = first.generate_task(dataset)
+    AlchemistGroup([first, second]).execute_task(task)
+
+    # Both outputs are staged next to the same location, so share one reservation
+    assert reservations == [
+        first.scratch_needed(task)[1]
+        + second.scratch_needed(second.generate_task(dataset))[1]
+    ]
+
+
+def test_execute_in_pool(synthetic_alchemist, tmp_path):
+    alchemist, datasets = synthetic_alchemist(count=3)
+    tasks_and_messages = [(alchemist.generate_task(ds), ds.id) for ds in datasets]
+
+    results = list(execute_in_pool(tasks_and_messages, [alchemist.config], workers=2))
+
+    assert sorted(message for _, message, _ in results) == sorted(
+        ds.id for ds in datasets
+    )
+    assert all(error is None for _, _, error in results)
+    assert len(list((tmp_path / "out").rglob("*.tif"))) == 3
+
+
+def test_execute_in_pool_broken(synthetic_alchemist):
+    alchemist, [dataset] = synthetic_alchemist()
+    tasks_and_messages = iter([(alchemist.generate_task(dataset), "m")] * 3)
+
+    # A worker that can't build its Alchemist breaks the pool
+    results = list(execute_in_pool(tasks_and_messages, [None], workers=1))
+
+    assert [message for _, message, _ in results] == ["m"]
+    assert isinstance(results[0][2], BrokenProcessPool)
+    # No more tasks are taken once it's broken
+    assert len(list(tasks_and_messages)) == 2
+
+
+def test_move_into_place_replaces_existing(tmp_path):
+    source = tmp_path / "staging" / "dataset"
+    source.mkdir(parents=True)
+    (source / "new.tif").write_text("new")
+    destination = tmp_path / "output" / "dataset"
+    destination.mkdir(parents=True)
+    (destination / "old.tif").write_text("old")
+
+    _move_into_place(source, destination)
+
+    assert not source.exists()
+    assert [p.name for p in destination.iterdir()] == ["new.tif"]
+    # Nothing left behind from the swap
+    assert [p.name for p in destination.parent.iterdir()] == ["dataset"]
+
+
+def test_reserve_space(tmp_path):
+    with reserve_space(tmp_path, 1024, timeout=0):
+        assert len(list(tmp_path.rglob("*.reservation"))) == 1
+        # Reservations count against the space that's left for other workers
+        with (
+            pytest.raises(OSError) as excinfo,
+            reserve_space(tmp_path, 2**62, timeout=0),
+        ):
+            pass
+    assert excinfo.value.errno == errno.ENOSPC
+    assert not list(tmp_path.rglob("*.reservation"))
+
+
+def test_reserve_space_only_prunes_own_host(tmp_path):
+    reservations = tmp_path / ".alchemist-reservations"
+    reservations.mkdir()
+    # No such PID here, but it might be alive on the node that made it
+    other = reservations / "another-node@4194304-0.reservation"
+    other.write_text(str(2**62))
+    dead = reservations / f"{socket.gethostname()}@4194304-1.reservation"
+    dead.write_text(str(2**62))
+
+    with pytest.raises(OSError), reserve_space(tmp_path, 1024, timeout=0):
+        pass
+    assert other.exists()
+    assert not dead.exists()
+
+
+def test_serve(synthetic_alchemist, tmp_path):
+    alchemist, [dataset] = synthetic_alchemist(size=8)
+    path = str(tmp_path / "alchemist.sock")
+
+    with AlchemistServer(path, alchemist, alchemist) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            result = submit(path, {"id": str(dataset.id)}, timeout=60)
+            assert result["ok"]
+            expected, _ = alchemist._deterministic_uuid(  # noqa: SLF001
+                alchemist.generate_task(dataset)
+            )
+            assert [output_id for output_id, _ in result["outputs"]] == [str(expected)]
+            assert list((tmp_path / "out").rglob("*.odc-metadata.yaml"))
+
+            # A failed task is reported, and the server carries on
+            missing = submit(path, {"id": str(uuid.uuid4())}, timeout=60)
+            assert not missing["ok"] and missing["error"]
+            assert submit(path, {"id": str(dataset.id)}, timeout=60)["ok"]
+        finally:
+            server.shutdown()
+            thread.join()
+    assert not Path(path).exists()
+
+
+def test_serve_socket_path(synthetic_alchemist, tmp_path):
+    alchemist, _ = synthetic_alchemist(size=8)
+    path = tmp_path / "alchemist.sock"
+
+    # Nothing but a socket is replaced
+    path.write_text("not a socket")
+    with pytest.raises(FileExistsError):
+        AlchemistServer(str(path), alchemist, alchemist)
+    assert path.read_text() == "not a socket"
+    path.unlink()
+
+    # Nor is the socket of a server that's still running
+    with (
+        AlchemistServer(str(path), alchemist, alchemist),
+        pytest.raises(OSError, match="already listening"),
+    ):
+        AlchemistServer(str(path), alchemist, alchemist)
+
+    # But one left by a server that died is
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    with AlchemistServer(str(path), alchemist, alchemist):
+        pass
+
+
+def test_serve_stops_on_sigterm(synthetic_alchemist, tmp_path, monkeypatch):
+    alchemist, _ = synthetic_alchemist(size=8)
+    path = tmp_path / "alchemist.sock"
+    flushed = []
+    monkeypatch.setattr("datacube_alchemist._publish.flush", lambda: flushed.append(1))
+    timer = threading.Timer(2, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        serve_socket(str(path), alchemist, [alchemist], sns_arn="arn:topic")
+    finally:
+        timer.cancel()
+    assert flushed
+    assert not path.exists()
+    assert signal.getsignal(signal.SIGTERM) is not signal.default_int_handler
+
+
+def test_transforms_reused(synthetic_alchemist, monkeypatch):
+    alchemist, datasets = synthetic_alchemist(count=2, size=8)
+    made = []
+
+    class Recorded(FakeTransformation):
+        def __init__(self, **kwargs):
+            made.append(kwargs)
+
+    alchemist.transform = Recorded
+    tasks = [alchemist.generate_task(ds) for ds in datasets]
+    first = alchemist._transform_with_args(tasks[0])  # noqa: SLF001
+    assert alchemist._transform_with_args(tasks[1]) is first  # noqa: SLF001
+    assert made == [{}]
+
+    # Each set of arguments has its own, up to the size of the pool
+    for i in range(worker._TRANSFORM_POOL_SIZE + 1):  # noqa: SLF001
+        alchemist.config.specification.transform_args = {"index": i}
+        alchemist._transform_with_args(tasks[0])  # noqa: SLF001
+    assert len(made) == worker._TRANSFORM_POOL_SIZE + 2  # noqa: SLF001
+    assert len(alchemist._transforms) == worker._TRANSFORM_POOL_SIZE  # noqa: SLF001
+    # The least recently used went first
+    assert json.dumps({"index": 0}) not in alchemist._transforms  # noqa: SLF001
+
+    imported = []
+    monkeypatch.setattr(
+        worker.importlib, "import_module", lambda name: imported.append(name)
+    )
+    for task in tasks:
+        alchemist._deterministic_uuid(task)  # noqa: SLF001
+    assert imported == ["datacube_alchemist"]
+
+
+def test_prefetcher(synthetic_alchemist, tmp_path):
+    inputs = tmp_path / "inputs"
+    server = serve(inputs, latency=0)
+    alchemist, datasets = synthetic_alchemist(
+        count=2,
+        bands=2,
+        measurements=["band_01"],
+        location=f"http://127.0.0.1:{server.server_port}",
+    )
+
+    with Prefetcher(depth=1, directory=str(tmp_path / "scratch")) as prefetcher:
+        tasks = [(alchemist.generate_task(ds), None) for ds in datasets]
+        for (original, _), (task, _) in zip(tasks, prefetcher.prefetch(tasks)):
+            # Only the configured measurement is fetched
+            assert task.dataset.measurements["band_01"]["path"].startswith("file://")
+            assert task.dataset.measurements["band_02"]["path"] == "band_02.tif"
+            # GDAL would hold the GIL while reading from the in-process server
+            source = inputs / Path(original.dataset.uris[0]).parent.name / "band_01.tif"
+            with rasterio.open(source) as src:
+                expected = src.read(1)
+            local = native_load(task.dataset, measurements=["band_01"])
+            assert (local.band_01 == expected).all()
+            prefetcher.release(task)
+        assert not list((tmp_path / "scratch").rglob("*.tif"))
+    server.shutdown()
+
+
+def test_prefetcher_extends_visibility(synthetic_alchemist, tmp_path):
+    alchemist, datasets = synthetic_alchemist(count=3, size=8)
+    queue = get_queue(f"sqlite://{tmp_path / 'queues.db'}?queue=work")
+    queue.send_messages(
+        Entries=[{"Id": str(i), "MessageBody": str(i)} for i in range(3)]
+    )
+    # As if they'd been waiting for longer than their timeout
+    messages = queue.receive_messages(MaxNumberOfMessages=3, VisibilityTimeout=0)
+    tasks = [(alchemist.generate_task(ds), m) for ds, m in zip(datasets, messages)]
+
+    with Prefetcher(depth=2, directory=str(tmp_path / "scratch")) as prefetcher:
+        prefetched = prefetcher.prefetch(tasks, visibility_timeout=60)
+        next(prefetched)
+        assert not queue.receive_messages(MaxNumberOfMessages=3)
+
+
+def test_sqlite_queue(tmp_path):
+    url = (
+        f"sqlite://{tmp_path / 'queues.db'}?queue=work&dead_letter=dead&max_receives=2"
+    )
+    queue = get_queue(url)
+    queue.send_messages(
+        Entries=[{"Id": str(i), "MessageBody": f"body-{i}"} for i in range(3)]
+    )
+    assert queue.attributes["ApproximateNumberOfMessages"] == "3"
+
+    first, second = get_messages(queue, limit=2, visibility_timeout=60)
+    assert (first.body, second.body) == ("body-0", "body-1")
+    first.delete()
+    # Received messages are invisible until their visibility timeout passes
+    second.change_visibility(VisibilityTimeout=0)
+    received = queue.receive_messages(MaxNumberOfMessages=10, VisibilityTimeout=0)
+    assert [m.body for m in received] == ["body-1", "body-2"]
+    received = queue.receive_messages(MaxNumberOfMessages=10, VisibilityTimeout=0)
+    assert [m.body for m in received] == ["body-2"]
+
+    # Both have now been received twice without being deleted
+    assert not queue.receive_messages(MaxNumberOfMessages=10)
+    dead = get_queue(f"sqlite://{tmp_path / 'queues.db'}?queue=dead")
+    assert dead.attributes["ApproximateNumberOfMessages"] == "2"
+    assert [q.name for q in dead.dead_letter_source_queues.all()] == ["work"]
+
+
+def test_redrive_sqlite_queue(run_alchemist, tmp_path):
+    database = tmp_path / "queues.db"
+    get_queue(f"sqlite://{database}?queue=work&dead_letter=dead")
+    dead = get_queue(f"sqlite://{database}?queue=dead")
+    dead.send_messages(Entries=[{"Id": "0", "MessageBody": "{}"}])
+
+    run_alchemist(["redrive-to-queue", f"--queue=sqlite://{database}?queue=dead"])
+
+    work = get_queue(f"sqlite://{database}?queue=work")
+    assert work.attributes["ApproximateNumberOfMessages"] == "1"
+    assert dead.attributes["ApproximateNumberOfMessages"] == "0"
+
+
+def test_redrive_batches(tmp_path):
+    database = tmp_path / "queues.db"
+    work = get_queue(f"sqlite://{database}?queue=work")
+    dead = get_queue(f"sqlite://{database}?queue=dead")
+    # 25 datasets, with the first five dead-lettered twice
+    bodies = [json.dumps({"id": str(uuid.UUID(int=i))}) for i in range(25)]
+    bodies += bodies[:5]
+    dead.send_messages(
+        Entries=[{"Id": str(i), "MessageBody": body} for i, body in enumerate(bodies)]
+    )
+    sends = []
+    send_messages = work.send_messages
+
+    def counted_send_messages(Entries):  # noqa: N803
+        sends.append(len(Entries))
+        return send_messages(Entries=Entries)
+
+    work.send_messages = counted_send_messages
+
+    stats = redrive(dead, work, limit=12, threads=3)
+    assert (stats.sent, stats.duplicates, stats.failed) == (12, 0, 0)
+    assert dead.attributes["ApproximateNumberOfMessages"] == "18"
+
+    stats = redrive(dead, work, threads=3)
+    assert (stats.sent, stats.duplicates, stats.failed) == (18, 0, 0)
+    assert all(0 < count <= 10 for count in sends)
+    assert len(work.receive_messages(MaxNumberOfMessages=100)) == 30
+
+    # Deduplicated, only the first message for each dataset is sent
+    dead.send_messages(
+        Entries=[{"Id": str(i), "MessageBody": body} for i, body in enumerate(bodies)]
+    )
+    stats = redrive(dead, work, threads=3, dedupe=True)
+    assert (stats.sent, stats.duplicates, stats.failed) == (25, 5, 0)
+    assert stats.rate > 0
+    redriven = work.receive_messages(MaxNumberOfMessages=100)
+    assert sorted(m.body for m in redriven) == sorted(bodies[:25])
+    assert dead.attributes["ApproximateNumberOfMessages"] == "0"
+
+
+def test_duplicate_messages(synthetic_alchemist, tmp_path):
+    alchemist, datasets = synthetic_alchemist(count=3, size=8)
+    url = f"sqlite://{tmp_path / 'queues.db'}?queue=work"
+    queue = get_queue(url)
+    queue.send_messages(
+        Entries=[
+            {"Id": str(i), "MessageBody": json.dumps({"id": str(datasets[n].id)})}
+            for i, n in enumerate([0, 1, 0, 2, 1])
+        ]
+    )
+
+    received = alchemist.get_tasks_from_queue(url, None, 60, messages_per_request=10)
+    assert [task.dataset.id for task, _ in received] == [ds.id for ds in datasets]
+    # The duplicates were deleted, and the rest are in flight
+    assert queue.attributes == {
+        "ApproximateNumberOfMessages": "0",
+        "ApproximateNumberOfMessagesNotVisible": "3",
+    }
+
+
+@contextmanager
+def _leases(backend, tmp_path):
+    if backend == "file":
+        yield lambda: FileLeases(tmp_path / "leases")
+    elif backend == "sqlite":
+        yield lambda: get_queue(f"sqlite://{tmp_path / 'queues.db'}?queue=work")
+    else:
+        with mock_aws():
+            s3 = boto3.client("s3")
+            s3.create_bucket(
+                Bucket="test-bucket",
+                CreateBucketConfiguration={"LocationConstraint": s3.meta.region_name},
+            )
+            yield lambda: S3Leases("s3://test-bucket/out/.alchemist-leases")
+
+
+@pytest.mark.parametrize("backend", ["file", "sqlite", "s3"])
+def test_leases(backend, tmp_path):
+    with _leases(backend, tmp_path) as leases:
+        first, second = leases(), leases()
+        assert first.acquire_lease("a", 60)
+        assert not second.acquire_lease("a", 60)
+        # Only the holder can release it
+        second.release_lease("a")
+        assert not second.acquire_lease("a", 60)
+        first.release_lease("a")
+        assert second.acquire_lease("a", 60)
+
+        # An expired lease was left by a worker that died
+        assert first.acquire_lease("b", 0)
+        assert second.acquire_lease("b", 60)
+        assert not first.acquire_lease("b", 60)
+
+
+def test_leased_tasks(synthetic_alchemist, tmp_path):
+    alchemist, datasets = synthetic_alchemist(count=2, size=8)
+    url = f"sqlite://{tmp_path / 'queues.db'}?queue=work"
+    assert alchemist.enqueue_datasets(url, {}) == 2
+    tasks = list(alchemist.generate_tasks({}))
+    # Another worker is running the first task
+    assert get_queue(url).acquire_lease(str(alchemist.output_uuid(tasks[0])), 60)
+
+    leased = _leased(
+        alchemist, alchemist.get_tasks_from_queue(url, None, 60), get_queue(url), 60
+    )
+    assert [task.dataset.id for task, _ in leased] == [datasets[1].id]
+    # The losing worker's message is deleted rather than left to be retried
+    assert get_queue(url).attributes["ApproximateNumberOfMessagesNotVisible"] == "1"
+
+
+def test_shard_tasks(synthetic_alchemist):
+    alchemist, datasets = synthetic_alchemist(count=20, size=8)
+
+    for by, key in (("id", lambda ds: ds.id), ("region", region_code)):
+        shards = [
+            [
+                task.dataset
+                for task in alchemist.generate_tasks({}, shard=(i, 3), shard_by=by)
+            ]
+            for i in range(3)
+        ]
+        # Disjoint, and together they're everything
+        assert sorted(ds.id for shard in shards for ds in shard) == sorted(
+            ds.id for ds in datasets
+        )
+        keys = [{key(ds) for ds in shard} for shard in shards]
+        assert not keys[0] & keys[1] and not keys[1] & keys[2] and not keys[0] & keys[2]
+
+    assert len(list(alchemist.generate_tasks({}, limit=2, shard=(0, 2)))) == 2
+    assert parse_shard("3/16") == (3, 16)
+    with pytest.raises(ValueError):
+        parse_shard("16/16")
+
+
+def test_region_code_without_one(synthetic_alchemist):
+    _, datasets = synthetic_alchemist(count=2, size=8)
+    assert region_code(datasets[1]) == "001000"
+
+    without = []
+    for dataset in datasets:
+        doc = copy.deepcopy(dataset.metadata_doc)
+        del doc["properties"]["odc:region_code"]
+        without.append(Dataset(dataset.product, doc, uris=dataset.uris))
+
+    # Each falls back to its own ID, rather than all sharing "None"
+    assert [region_code(ds) for ds in without] == [str(ds.id) for ds in datasets]
+
+
+def test_spatial_order(synthetic_alchemist, tmp_path):
+    alchemist, _ = synthetic_alchemist(count=12, size=8)
+
+    regions = [
+        region_code(task.dataset)
+        for task in alchemist.generate_tasks({}, order="region")
+    ]
+    assert len(regions) == 12
+    assert regions == sorted(regions)
+
+    url = f"sqlite://{tmp_path / 'queues.db'}?queue=work"
+    assert alchemist.enqueue_datasets(url, {}, order="region") == 12
+    received = get_queue(url).receive_messages(MaxNumberOfMessages=12)
+    assert [m.attributes["MessageGroupId"] for m in received] == regions
+
+    # A batch is filled from the oldest message's group first
+    queue = get_queue(f"sqlite://{tmp_path / 'queues.db'}?queue=groups")
+    queue.send_messages(
+        Entries=[
+            {"Id": str(i), "MessageBody": str(i), "MessageGroupId": group}
+            for i, group in enumerate("abab")
+        ]
+    )
+    assert [m.body for m in queue.receive_messages(MaxNumberOfMessages=2)] == [
+        "0",
+        "2",
+    ]
+
+
+def test_grouped_tasks(tmp_path, monkeypatch):
+    docs = write_synthetic_datasets(tmp_path / "inputs", count=4, size=8)
+    # Four scenes of one tile, 16 days apart
+    for doc in docs:
+        doc["properties"]["odc:region_code"] = "000000"
+    dc = Datacube(config=str(memory_index_config(tmp_path)), env="benchmark")
+    datasets = index_synthetic_datasets(dc, docs, bands=1, dtype="uint16")
+    config = alchemist_settings(tmp_path / "out", ["band_01"], chunk=8)
+    single = Alchemist(config=copy.deepcopy(config), dc=dc)
+    config.specification.group = GroupSettings(window_days=32)
+    alchemist = Alchemist(config=config, dc=dc)
+
+    # The windows count from 1970, so 2020-01-01 is near the end of one
+    tasks = list(alchemist.generate_tasks({}))
+    assert [[ds.id for ds in task.datasets] for task in tasks] == [
+        [datasets[0].id],
+        [datasets[1].id, datasets[2].id],
+        [datasets[3].id],
+    ]
+    assert not tasks[0].group
+    assert tasks[1].dataset.id == datasets[2].id
+
+    # Groups are queued as one message, and read back in order
+    url = f"sqlite://{tmp_path / 'queues.db'}?queue=work"
+    assert alchemist.enqueue_datasets(url, {}) == 3
+    received = [task for task, _ in alchemist.get_tasks_from_queue(url, 3, 60)]
+    assert [task.datasets for task in received] == [task.datasets for task in tasks]
+
+    # Loaded in one go along time
+    task = received[1]
+    data = alchemist.load_data(task)
+    assert data.sizes["time"] == 2
+    for i, dataset in enumerate(task.group):
+        expected = native_load(dataset, measurements=["band_01"]).band_01
+        assert (data.band_01.isel(time=i) == expected.isel(time=0)).all()
+
+    # A temporal transform reduces the time dimension, and the output's lineage
+    # and ID cover every source
+    monkeypatch.setattr(
+        FakeTransformation,
+        "compute",
+        lambda self, data: data.max("time", keep_attrs=True),
+    )
+    dataset_id, _ = alchemist.execute_task(task)
+    [metadata_path] = (tmp_path / "out").rglob("*.odc-metadata.yaml")
+    lineage = serialise.from_path(metadata_path).lineage
+    assert sorted(lineage["synthetic"]) == sorted(ds.id for ds in task.group)
+    ungrouped = single.output_uuid(single.generate_task(task.dataset))
+    assert dataset_id not in (None, ungrouped)
+
+
+def _with(dataset, shift=0, **properties):
+    doc = copy.deepcopy(dataset.metadata_doc)
+    for point in doc["grid_spatial"]["projection"]["valid_data"]["coordinates"][0]:
+        point[0] += shift
+    doc["properties"].update(properties)
+    return Dataset(dataset.product, doc, uris=dataset.uris)
+
+
+def _write_aoi(path, bounds):
+    feature = {"type": "Feature", "properties": {}, "geometry": mapping(box(*bounds))}
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [feature]}))
+    return str(path)
+
+
+def test_dataset_filter(synthetic_alchemist, tmp_path):
+    alchemist, datasets = synthetic_alchemist(count=4, size=8)
+    left, bottom, right, top = datasets[0].extent.to_crs("EPSG:4326").boundingbox
+    aoi = _write_aoi(tmp_path / "aoi.geojson", (left, bottom, right, top))
+
+    dataset_filter = DatasetFilter(
+        FilterSettings(expressions=["cloud_cover in [0, 50]"], aoi=aoi), batch_size=3
+    )
+    candidates = [
+        _with(datasets[0], **{"eo:cloud_cover": 10}),
+        _with(datasets[1], **{"eo:cloud_cover": 90}),
+        _with(datasets[2], shift=100_000, **{"eo:cloud_cover": 10}),
+        # Without a cloud cover, it can't match
+        datasets[3],
+    ]
+    assert [ds.id for ds in dataset_filter(candidates)] == [datasets[0].id]
+    assert dataset_filter.dropped == Counter(expressions=2, aoi=1)
+
+    query = dataset_filter.search_query({"product": "other"})
+    assert query["cloud_cover"] == Range(0, 50)
+    assert query["lon"] == Range(left, right) and query["lat"] == Range(bottom, top)
+    # A term of the caller's is narrowed by the filter's, rather than replacing it
+    query = dataset_filter.search_query({"cloud_cover": Range(20, 80)})
+    assert query["cloud_cover"] == Range(20, 50)
+    assert list(dataset_filter([candidates[0]], searched=query)) == [candidates[0]]
+    # And where they can't be combined, the filter's is still checked
+    query = dataset_filter.search_query({"cloud_cover": Range(60, 80)})
+    assert query["cloud_cover"] == Range(60, 80)
+    found = _with(datasets[0], **{"eo:cloud_cover": 70})
+    assert not list(dataset_filter([found], searched=query))
+
+    # When enqueueing, the index does the searching
+    url = f"sqlite://{tmp_path / 'queues.db'}?queue=work"
+    config = copy.deepcopy(alchemist.config)
+    for platform, count in (("landsat-8", 4), ("landsat-9", 0)):
+        config.specification.filter = FilterSettings([f"platform = {platform}"])
+        enqueuer = Alchemist(config=config, dc=alchemist.dc)
+        assert enqueuer.enqueue_datasets(url, {}) == count
+    assert get_queue(url).attributes["ApproximateNumberOfMessages"] == "4"
+    # Searching for another platform doesn't get around the filter
+    assert enqueuer.enqueue_datasets(url, {"platform": "landsat-8"}) == 0
+
+
+def _write_gdal_overviews(path, array, nodata, factors, resampling):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=array.shape[0],
+        width=array.shape[1],
+        count=1,
+        dtype=array.dtype,
+        nodata=nodata,
+    ) as dataset:
+        dataset.write(array, 1)
+        dataset.build_overviews(factors, resampling)
+
+
+def _overview_pairs(ours, gdal, levels):
+    for level in range(levels):
+        with (
+            rasterio.open(ours, overview_level=level) as ours_level,
+            rasterio.open(gdal, overview_level=level) as gdal_level,
+        ):
+            yield ours_level.read(1), gdal_level.read(1)
+
+
+OVERVIEW_CASES = [
+    ("uint8", 1, "mode"),
+    ("uint16", 0, "average"),
+    ("float32", float("nan"), "average"),
+    ("int16", -999, "nearest"),
+]
+
+
+@pytest.mark.parametrize("dtype, nodata, resampling", OVERVIEW_CASES)
+def test_in_memory_overviews(tmp_path, dtype, nodata, resampling):
+    resampling = Resampling[resampling]
+    rng = np.random.default_rng(0)
+    array = (rng.random((512, 768)) * 5).astype(dtype)
+    array[rng.random(array.shape) < 0.2] = nodata
+    grid = GridSpec(
+        shape=array.shape,
+        transform=Affine(30, 0, 0, 0, -30, 0),
+        crs=CRS.from_epsg(3577),
+    )
+    write_cog(tmp_path / "ours.tif", array, grid, nodata, (8, 16, 32), resampling)
+    _write_gdal_overviews(tmp_path / "gdal.tif", array, nodata, [8, 16, 32], resampling)
+
+    with rasterio.open(tmp_path / "ours.tif") as ours:
+        assert ours.overviews(1) == [8, 16, 32]
+        assert ours.crs == grid.crs and ours.transform == grid.transform
+        np.testing.assert_array_equal(ours.read(1), array)
+    for ours, gdal in _overview_pairs(tmp_path / "ours.tif", tmp_path / "gdal.tif", 3):
+        np.testing.assert_allclose(ours, gdal, rtol=1e-6)
+
+
+@pytest.mark.parametrize("dtype, nodata, resampling", OVERVIEW_CASES)
+def test_in_memory_overviews_uneven(tmp_path, dtype, nodata, resampling):
+    # Real scenes, such as 7611x7531, aren't a multiple of the overview factors
+    resampling = Resampling[resampling]
+    y, x = np.mgrid[0:761, 0:753]
+    if resampling == Resampling.mode:
+        array = ((y // 40 + x // 40) % 5).astype(dtype)
+    else:
+        array = (1000 + 500 * np.sin(y / 50) * np.cos(x / 70)).astype(dtype)
+    array[np.random.default_rng(0).random(array.shape) < 0.2] = nodata
+    grid = GridSpec(
+        shape=array.shape,
+        transform=Affine(30, 0, 0, 0, -30, 0),
+        crs=CRS.from_epsg(3577),
+    )
+    write_cog(tmp_path / "ours.tif", array, grid, nodata, (8, 16, 32), resampling)
+    _write_gdal_overviews(tmp_path / "gdal.tif", array, nodata, [8, 16, 32], resampling)
+
+    # The tolerances documented by overview_levels
+    for ours, gdal in _overview_pairs(tmp_path / "ours.tif", tmp_path / "gdal.tif", 3):
+        assert ours.shape == gdal.shape
+        if resampling == Resampling.nearest:
+            np.testing.assert_array_equal(ours, gdal)
+        elif resampling == Resampling.average:
+            difference = np.abs(ours.astype("float64") - gdal)
+            assert np.nanmean(difference) <= 0.01 * (
+                np.nanmax(array) - np.nanmin(array)
+            )
+        else:
+            assert (ours == gdal).mean() >= 0.9
+
+
+def test_colourise():
+    classes = np.array([[0, 1, 128], [7, 128, 0]], dtype="uint8")
+    red, green, blue = colourise(classes, {0: [150, 150, 110], 128: [79, 129, 189]})
+
+    np.testing.assert_array_equal(red, [[150, 0, 79], [0, 79, 150]])
+    np.testing.assert_array_equal(green, [[150, 0, 129], [0, 129, 150]])
+    np.testing.assert_array_equal(blue, [[110, 0, 189], [0, 189, 110]])
+    assert red.dtype == np.uint8
+
+
+def test_thumbnail_from_memory(tmp_path):
+    y, x = np.mgrid[0:1000, 0:1200]
+    bands = [
+        (1000 + 500 * np.sin(y / (50 + 10 * i)) * np.cos(x / 70)).astype("int16")
+        for i in range(3)
+    ]
+    for band in bands:
+        band[:100] = -999
+    grid = GridSpec(
+        shape=(1000, 1200),
+        transform=Affine(30, 0, 500_000, 0, -30, 7_000_000),
+        crs=CRS.from_epsg(32755),
+    )
+    write_thumbnail(tmp_path / "ours.jpg", bands, grid, nodata=-999)
+    theirs = FileWrite().create_thumbnail_from_numpy(
+        bands, input_geobox=grid, nodata=-999
+    )
+
+    with (
+        rasterio.open(tmp_path / "ours.jpg") as ours,
+        MemoryFile(theirs) as memfile,
+        memfile.open() as theirs,
+    ):
+        assert ours.shape == theirs.shape
+        difference = np.abs(ours.read().astype(int) - theirs.read())
+        assert difference.mean() < 3
+
+
+def test_precheck(synthetic_alchemist):
+    _, [dataset] = synthetic_alchemist(size=100)
+    dataset.metadata_doc["properties"]["eo:cloud_cover"] = 80.0
+
+    assert precheck(dataset, PrecheckSettings()) is None
+    assert precheck(dataset, PrecheckSettings(max_cloud_cover=50)) == "cloud_cover"
+    assert precheck(dataset, PrecheckSettings(max_cloud_cover=90)) is None
+    assert valid_fraction(dataset) == pytest.approx(1.0)
+    assert precheck(dataset, PrecheckSettings(min_valid_fraction=0.5)) is None
+
+    # The synthetic bands are random from 1 to 9999
+    usable = list(range(1, 5000))
+    expected = np.isin(native_load(dataset, ["band_01"]).band_01.values, usable).mean()
+    assert usable_fraction(dataset, "band_01", usable, 1) == pytest.approx(expected)
+    assert usable_fraction(dataset, "band_01", usable, 10) == pytest.approx(
+        0.5, abs=0.1
+    )
+    mask = PrecheckSettings(mask_measurement="band_01", mask_usable_values=usable)
+    assert precheck(dataset, mask) is None
+    mask.min_usable_fraction = 0.9
+    assert precheck(dataset, mask) == "mask"
+    # Other products' mask bands are ignored
+    mask.mask_measurement = "oa_fmask"
+    assert precheck(dataset, mask) is None
+
+
+@pytest.mark.parametrize("action", ["skip", "empty"])
+def test_precheck_short_circuits(synthetic_alchemist, tmp_path, action):
+    alchemist, [dataset] = synthetic_alchemist(bands=3)
+    alchemist.config.processing.precheck = PrecheckSettings(
+        action=action, mask_measurement="band_01"
+    )
+    alchemist.config.output.inherit_geometry = False
+    task = alchemist.generate_task(dataset)
+
+    dataset_id, _ = alchemist.execute_task(task)
+
+    assert "load" not in task.metrics.stages
+    assert alchemist.outcomes == {("skipped" if action == "skip" else "empty"): 1}
+    written = list((tmp_path / "out").rglob("*.tif"))
+    if action == "skip":
+        assert dataset_id is None
+        assert not written
+        return
+    assert len(written) == 3
+    for path in written:
+        with rasterio.open(path) as f:
+            assert f.dtypes[0] == "uint16"
+            assert not f.read().any()
+
+
+def test_summarise_matches_eodatasets3():
+    rng = np.random.default_rng(1)
+    rows, cols = np.mgrid[:301, :253]
+    integers = rng.integers(1, 3000, rows.shape, dtype="uint16")
+    integers[(cols * 0.8 + rows * 0.3 < 60) | (cols * 0.2 - rows * 0.9 > 10)] = 0
+    integers[rng.random(rows.shape) < 0.001] = 7
+    floats = np.where(integers == 0, np.nan, integers).astype("float32")
+    output_data = xr.Dataset(
+        {
+            "integers": (("y", "x"), dask.array.from_array(integers, chunks=64)),
+            "floats": (("y", "x"), dask.array.from_array(floats, chunks=(100, 90))),
+        }
+    )
+    grid = GridSpec(
+        shape=integers.shape,
+        transform=Affine(30.0, 0.0, 500000.0, 0.0, -30.0, 6000000.0),
+        crs=CRS.from_epsg(32755),
+    )
+
+    output_data.integers.attrs["nodata"] = 0
+    _, summaries = dask.compute(output_data, summarise(output_data, statistics=True))
+    bundler = MeasurementBundler()
+    bundler.record_image("integers", grid, "integers.tif", integers, nodata=0)
+    assert footprint([summaries["integers"]], grid).equals(
+        bundler.consume_and_get_valid_data()
+    )
+
+    valid = integers[integers != 0]
+    band = raster_band(summaries["integers"], "uint16", 0)
+    assert band["statistics"] == pytest.approx(
+        {
+            "valid_percent": 100 * valid.size / integers.size,
+            "minimum": valid.min(),
+            "maximum": valid.max(),
+            "mean": valid.mean(),
+            "stddev": valid.std(),
+        }
+    )
+    assert (
+        band["histogram"]["buckets"]
+        == np.histogram(valid, 256, (valid.min(), valid.max()))[0].tolist()
+    )
+    # NaN is the floats' nodata, and they're too wide to count for a histogram
+    band = raster_band(summaries["floats"], "float32")
+    assert band["statistics"]["valid_percent"] == 100 * valid.size / integers.size
+    assert "histogram" not in band
+
+
+def test_band_statistics_in_stac(synthetic_alchemist, tmp_path):
+    alchemist, [dataset] = synthetic_alchemist()
+    alchemist.config.output.band_statistics = True
+    alchemist.config.output.inherit_geometry = False
+    alchemist.execute_task(alchemist.generate_task(dataset))
+
+    [stac_path] = (tmp_path / "out").rglob("*.stac-item.json")
+    with stac_path.open() as f:
+        stac = json.load(f)
+    assert RASTER_EXTENSION in stac["stac_extensions"]
+    [band] = stac["assets"]["band_01"]["raster:bands"]
+    assert band["data_type"] == "uint16"
+    assert band["statistics"]["valid_percent"] == 100
+    assert sum(band["histogram"]["buckets"]) == 64 * 64
+
+
+def test_int8_statistics_match_written(synthetic_alchemist, tmp_path, monkeypatch):
+    alchemist, [dataset] = synthetic_alchemist(size=16)
+    alchemist.config.output.band_statistics = True
+    alchemist.config.output.inherit_geometry = False
+    # Negative int8 values are written as uint8, so they're what's summarised
+    monkeypatch.setattr(
+        FakeTransformation,
+        "compute",
+        lambda self, data: (data % 7 - 3).astype("int8"),
+    )
+    alchemist.execute_task(alchemist.generate_task(dataset))
+
+    [stac_path] = (tmp_path / "out").rglob("*.stac-item.json")
+    asset = json.loads(stac_path.read_text())["assets"]["band_01"]
+    [band] = asset["raster:bands"]
+    with rasterio.open(stac_path.parent / asset["href"]) as src:
+        written = src.read(1)
+        written = written[written != src.nodata]
+    assert band["data_type"] == "uint8"
+    assert band["statistics"]["minimum"] == written.min()
+    assert band["statistics"]["maximum"] == written.max()
+    assert sum(band["histogram"]["buckets"]) == written.size
+
+
+def test_assembler_internals(tmp_path):
+    # The private parts of DatasetAssembler that Assembler and write_cog_bands use,
+    # so that an eodatasets3 that changes them fails here rather than in production
+    with Assembler(collection_location=tmp_path) as assembler:
+        assert callable(assembler._checksum._append_hash)  # noqa: SLF001
+        assembler.cancel()
+    parameters = inspect.signature(DatasetAssembler._write_yaml).parameters  # noqa: SLF001
+    assert list(parameters) == ["self", "doc", "path", "allow_external_paths"]
+    # Assembler skips DatasetAssembler's note_accessory_file for the one below it
+    assert "note_accessory_file" in vars(DatasetAssembler)
+    assert hasattr(super(DatasetAssembler, assembler), "note_accessory_file")
+
+
+def test_outputs_checksummed_as_written(synthetic_alchemist, tmp_path, monkeypatch):
+    alchemist, [dataset] = synthetic_alchemist(bands=3)
+
+    def read_again(self, file_path):
+        raise AssertionError(f"Read {file_path} again to checksum it")
+
+    monkeypatch.setattr(PackageChecksum, "_checksum", read_again)
+    alchemist.execute_task(alchemist.generate_task(dataset))
+    monkeypatch.undo()
+
+    [checksum_file] = (tmp_path / "out").rglob("*.sha1")
+    checksums = PackageChecksum()
+    checksums.read(checksum_file)
+    assert {path.suffix for path, _ in checksums.items()} == {
+        ".tif",
+        ".jpg",
+        ".yaml",
+        ".json",
+    }
+    assert all(ok for _, ok in checksums.iteratively_verify())
+
+    # The same as it would be from the metadata on disk
+    [metadata_path] = (tmp_path / "out").rglob("*.odc-metadata.yaml")
+    stac_path = checksum_file.with_suffix(".stac-item.json")
+    with stac_path.open() as f:
+        stac = json.load(f)
+    assert stac == json.loads(
+        json.dumps(
+            dc_to_stac(
+                serialise.from_path(metadata_path),
+                metadata_path,
+                stac_path,
+                str(stac_path.parent).rstrip("/") + "/",
+                alchemist.config.output.explorer_url,
+                False,
+            ),
+            default=json_fallback,
+        )
+    )